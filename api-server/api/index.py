@@ -1,7 +1,10 @@
 import json
+import re
+import threading
+import time
 from flask import Flask, Request, Response, jsonify, request, make_response
 import dotenv
-from modules import db, llm, emb, instruments
+from modules import db, llm, emb, feedback, instruments, snapshot, sql_cache, table_summaries
 from modules.turbo4 import Turbo4
 
 import os
@@ -23,6 +26,45 @@ assert os.environ.get(
 
 DB_URL = os.environ.get("DATABASE_URL")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+# upper bound on table definition tokens sent per prompt, estimated at 4 characters per token
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET") or 4000)
+# schema snapshot file (poetry run export_snapshot), skips schema introspection when set
+SCHEMA_SNAPSHOT_PATH = os.environ.get("SCHEMA_SNAPSHOT_PATH")
+
+# loaded once per process, the live db is then only used for run_sql
+SCHEMA_SNAPSHOT = (
+    snapshot.load_snapshot(SCHEMA_SNAPSHOT_PATH) if SCHEMA_SNAPSHOT_PATH else None
+)
+# llm table descriptions written by 'poetry run enrich_tables', indexed by BM25
+TABLE_SUMMARIES_PATH = os.environ.get("TABLE_SUMMARIES_PATH")
+TABLE_SUMMARIES = (
+    table_summaries.TableSummaryStore(TABLE_SUMMARIES_PATH)
+    if TABLE_SUMMARIES_PATH
+    else None
+)
+# tables of past successful queries per prompt word, blended into retrieval
+FEEDBACK_STORE_PATH = os.environ.get("FEEDBACK_STORE_PATH")
+FEEDBACK = feedback.FeedbackStore(FEEDBACK_STORE_PATH) if FEEDBACK_STORE_PATH else None
+# SQL of past prompts, reused for near duplicate prompts - SQL_CACHE=0 turns it off
+SQL_CACHE = (
+    sql_cache.SemanticSQLCache(
+        path=os.environ.get("SQL_CACHE_PATH") or None,
+        threshold=float(os.environ.get("SQL_CACHE_THRESHOLD") or 0.9),
+    )
+    if os.environ.get("SQL_CACHE", "1") != "0"
+    else None
+)
+
+# "single": one forced run_sql tool call writes the SQL, "two_step": write the SQL, then a run_sql call
+# /prompt/stream always runs two steps, the SQL tokens are only streamed by the generation step
+PROMPT_MODE = os.environ.get("PROMPT_MODE") or "single"
+# fall back to two steps when the single round trip produces no SQL
+PROMPT_FALLBACK = os.environ.get("PROMPT_FALLBACK", "1") != "0"
+# per request latency and cost records (json lines), for comparing the modes
+PROMPT_METRICS_PATH = os.environ.get("PROMPT_METRICS_PATH")
+
+# table names of the packed table definitions, for stage events
+CREATE_TABLE_RE = re.compile(r"^CREATE TABLE (\S+) \(", re.MULTILINE)
 
 # ---------------- Cors Helper ----------------
 
@@ -36,6 +78,57 @@ def make_cors_response():
     return response
 
 
+# ---------------- Prompt Metrics ----------------
+
+# mode -> running totals of the requests answered in that mode
+map_mode_to_prompt_metrics = {}
+prompt_metrics_lock = threading.Lock()
+
+
+def record_prompt_metrics(metrics: dict):
+    """
+    Log a request's mode, latency, llm calls, tokens and estimated cost, and the running averages per mode.
+    """
+    with prompt_metrics_lock:
+        totals = map_mode_to_prompt_metrics.setdefault(
+            metrics["mode"], {"requests": 0, "latency_seconds": 0.0, "calls": 0, "cost": 0.0}
+        )
+        for name in totals:
+            totals[name] += 1 if name == "requests" else metrics[name]
+        averages = {
+            mode: {
+                "requests": totals["requests"],
+                **{
+                    f"avg_{name}": round(totals[name] / totals["requests"], 4)
+                    for name in ("latency_seconds", "calls", "cost")
+                },
+            }
+            for mode, totals in map_mode_to_prompt_metrics.items()
+        }
+
+        if PROMPT_METRICS_PATH:
+            with open(PROMPT_METRICS_PATH, "a") as f:
+                f.write(json.dumps({**metrics, "created_at": time.time()}) + "\n")
+
+    print("prompt metrics", metrics)
+    print("prompt metrics per mode", averages)
+
+
+def run_sql_succeeded(func_responses: list, agent_instruments) -> bool:
+    """
+    True when the run_sql tool calls returned without a timeout or error output and wrote the SQL file.
+    """
+    return (
+        bool(func_responses)
+        and not any(
+            isinstance(output, llm.ToolCallTimeout)
+            or (isinstance(output, str) and output.startswith("Error"))
+            for output in func_responses
+        )
+        and os.path.exists(agent_instruments.sql_query_file)
+    )
+
+
 # ---------------- Self Correcting Assistant ----------------
 
 
@@ -48,7 +141,7 @@ def self_correcting_assistant(
     # reset db - to unblock transactions
     db.roll_back()
 
-    all_table_definitions = db.get_table_definitions_for_prompt()
+    all_table_definitions = (SCHEMA_SNAPSHOT or db).get_table_definitions_for_prompt()
 
     print(f"Loaded all table definitions")
 
@@ -116,6 +209,237 @@ def self_correcting_assistant(
     pass
 
 
+# ---------------- Prompt Pipeline ----------------
+
+
+def run_prompt_pipeline(
+    base_prompt: str,
+    agent_instruments: instruments.PostgresAgentInstruments,
+    db: db.PostgresManager,
+    stream: bool = False,
+):
+    """
+    The /prompt pipeline as a generator of (event, data) pairs:
+    "stage" events as the pipeline progresses, "sql_token" events while the SQL
+    is generated (stream=True), then one "result" or "error" event.
+    """
+
+    started_at = time.time()
+
+    # ---------------- Build Prompt ----------------
+
+    # bm25 + word match - dropped embeddings for deployment size
+    database_embedder = emb.DatabaseEmbedder(
+        SCHEMA_SNAPSHOT or db,
+        context_token_budget=CONTEXT_TOKEN_BUDGET,
+        table_summaries=TABLE_SUMMARIES,
+        feedback=FEEDBACK,
+    )
+    schema_fingerprint = database_embedder.schema_fingerprint()
+
+    # ---------------- Semantic SQL Cache - Reuse SQL Of A Near Duplicate Prompt ----------------
+
+    cached_entry = (
+        SQL_CACHE.lookup(base_prompt, schema_fingerprint) if SQL_CACHE else None
+    )
+    if cached_entry:
+        try:
+            agent_instruments.run_sql(cached_entry["sql"])
+            print("sql cache", SQL_CACHE.stats())
+            record_prompt_metrics(
+                {
+                    "prompt": base_prompt,
+                    "mode": "sql_cache",
+                    "self_corrected": False,
+                    "latency_seconds": round(time.time() - started_at, 3),
+                    "calls": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "cached_tokens": 0,
+                    "cost": 0.0,
+                }
+            )
+            yield "stage", {"stage": "sql_cache_hit", "sql": cached_entry["sql"]}
+            yield from sql_results_events(agent_instruments, base_prompt)
+            return
+        except PostgresError as e:
+            db.roll_back()
+            SQL_CACHE.record_fallback(cached_entry, e)
+
+    similar_tables = database_embedder.get_similar_table_defs_for_prompt(base_prompt)
+
+    if len(similar_tables) == 0:
+        print(f"No similar tables found for prompt: {base_prompt}")
+        yield "error", {"status": 400, "message": "No similar tables found."}
+        return
+
+    print("similar_tables", similar_tables)
+    yield "stage", {
+        "stage": "tables_retrieved",
+        "tables": CREATE_TABLE_RE.findall(similar_tables),
+    }
+
+    print(f"base_prompt: {base_prompt}")
+
+    prompt = f"Fulfill this database query: {base_prompt}. "
+    prompt = llm.add_cap_ref_prefix(
+        prompt,
+        f"Use these TABLE_DEFINITIONS to satisfy the database query.",
+        "TABLE_DEFINITIONS",
+        similar_tables,
+    )
+
+    # ---------------- Generate SQL & Results ----------------
+
+    tools = [
+        TurboTool(
+            "run_sql",
+            llm.run_sql_tool_config,
+            agent_instruments.run_sql,
+            agent_instruments.cancel_run_sql,
+        ),
+    ]
+
+    mode = "two_step" if stream else PROMPT_MODE
+    self_corrected = False
+
+    with llm.track_usage() as usage, llm.usage_context(
+        session=agent_instruments.session_id, team="SQL Generation"
+    ):
+        try:
+            if mode == "single":
+                # 1 round trip: a forced run_sql call carries the SQL, run locally
+                try:
+                    func_responses = llm.prompt_func(
+                        prompt,
+                        model="gpt-4-1106-preview",
+                        instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
+                        turbo_tools=tools,
+                        temperature=0,
+                    )
+                except (ValueError, TypeError) as e:
+                    # unparsable or incomplete tool call arguments
+                    print(f"Single round trip failed: {e}")
+                    func_responses = []
+
+                if run_sql_succeeded(func_responses, agent_instruments):
+                    yield "stage", {
+                        "stage": "sql_generated",
+                        "sql": open(agent_instruments.sql_query_file).read(),
+                    }
+                elif PROMPT_FALLBACK:
+                    print(
+                        f"No SQL from the single round trip ({func_responses}), falling back to two steps"
+                    )
+                    mode = "two_step_fallback"
+                else:
+                    yield "error", {"status": 500, "message": "No SQL generated."}
+                    return
+
+            if mode != "single":
+                # ---------------- Run 2 Agent Team - Generate SQL, Then Run It Through run_sql ----------------
+                if stream:
+                    sql_response = ""
+                    for token in llm.prompt(
+                        prompt,
+                        model="gpt-4-1106-preview",
+                        instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
+                        stream=True,
+                        temperature=0,
+                        store_response=False,
+                    ):
+                        sql_response += token
+                        yield "sql_token", {"token": token}
+                else:
+                    sql_response = llm.prompt(
+                        prompt,
+                        model="gpt-4-1106-preview",
+                        instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
+                        temperature=0,
+                        store_response=False,
+                    )
+                yield "stage", {"stage": "sql_generated", "sql": sql_response}
+
+                llm.prompt_func(
+                    "Use the run_sql function to run the SQL you've just generated: "
+                    + sql_response,
+                    model="gpt-4-1106-preview",
+                    instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
+                    turbo_tools=tools,
+                    temperature=0,
+                )
+            sql_ran, _ = agent_instruments.validate_run_sql()
+            if mode != "single" and sql_ran:
+                # cache the generated SQL only now that it ran, a failing query is never replayed
+                llm.store_prompt_response(
+                    prompt,
+                    sql_response,
+                    model="gpt-4-1106-preview",
+                    instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
+                    temperature=0,
+                )
+        except PostgresError as e:
+            print(
+                f"Received PostgresError -> Running Self Correction Team To Resolve: {e}"
+            )
+            yield "stage", {"stage": "self_correcting", "error": str(e)}
+
+            # ---------------- Run Self Correction Team - Diagnosis, Generate New SQL, Retry ----------------
+            self_correcting_assistant(db, agent_instruments, tools, e)
+            self_corrected = True
+
+            print(f"Self Correction Team Complete.")
+
+    record_prompt_metrics(
+        {
+            "prompt": base_prompt,
+            "mode": mode,
+            "self_corrected": self_corrected,
+            "latency_seconds": round(time.time() - started_at, 3),
+            **usage,
+        }
+    )
+
+    # ---------------- Read result files and respond ----------------
+
+    sql_ran, _ = agent_instruments.validate_run_sql()
+    if sql_ran:
+        sql_query = open(agent_instruments.sql_query_file).read()
+        database_embedder.record_feedback(base_prompt, sql_query)
+        if SQL_CACHE:
+            SQL_CACHE.store(base_prompt, sql_query, schema_fingerprint)
+
+    print("prompt cache usage", llm.get_prompt_cache_stats())
+    print("response cache", llm.get_response_cache_stats())
+    if llm.LLM_HEDGE:
+        print("hedging", llm.get_hedge_stats())
+    if SQL_CACHE:
+        print("sql cache", SQL_CACHE.stats())
+
+    yield from sql_results_events(agent_instruments, base_prompt)
+
+
+def sql_results_events(agent_instruments, base_prompt):
+    sql_query = open(agent_instruments.sql_query_file).read()
+    yield "stage", {"stage": "sql_executed", "sql": sql_query}
+
+    sql_query_results = open(agent_instruments.run_sql_results_file).read()
+    yield "stage", {
+        "stage": "rows_available",
+        "rows": len(json.loads(sql_query_results)) if sql_query_results else 0,
+    }
+
+    response_obj = {
+        "prompt": base_prompt,
+        "results": sql_query_results,
+        "sql": sql_query,
+    }
+
+    print("response_obj", response_obj)
+
+    yield "result", response_obj
+
+
 # ---------------- Primary Endpoint ----------------
 
 
@@ -126,85 +450,85 @@ def prompt():
     if request.method == "OPTIONS":
         return response
 
+    base_prompt = request.json["prompt"]
+
     # Get access to db, state, and functions
     with instruments.PostgresAgentInstruments(DB_URL, "prompt-endpoint") as (
         agent_instruments,
         db,
     ):
-        # ---------------- Build Prompt ----------------
-
-        base_prompt = request.json["prompt"]
-
-        # simple word match for now - dropped embeddings for deployment size
-        similar_tables = emb.DatabaseEmbedder(db).get_similar_table_defs_for_prompt(
-            base_prompt
-        )
-
-        if len(similar_tables) == 0:
-            print(f"No similar tables found for prompt: {base_prompt}")
-            response.status_code = 400
-            response.data = "No similar tables found."
-            return response
-
-        print("similar_tables", similar_tables)
-
-        print(f"base_prompt: {base_prompt}")
+        for event, data in run_prompt_pipeline(base_prompt, agent_instruments, db):
+            if event == "error":
+                response.status_code = data["status"]
+                response.data = data["message"]
+                return response
+            if event == "result":
+                response.data = json.dumps(data)
 
-        prompt = f"Fulfill this database query: {base_prompt}. "
-        prompt = llm.add_cap_ref(
-            prompt,
-            f"Use these TABLE_DEFINITIONS to satisfy the database query.",
-            "TABLE_DEFINITIONS",
-            similar_tables,
-        )
+        return response
 
-        # ---------------- Run 2 Agent Team - Generate SQL & Results ----------------
 
-        tools = [
-            TurboTool("run_sql", llm.run_sql_tool_config, agent_instruments.run_sql),
-        ]
+# ---------------- Usage Endpoint ----------------
 
-        sql_response = llm.prompt(
-            prompt,
-            model="gpt-4-1106-preview",
-            instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
-        )
-        try:
-            llm.prompt_func(
-                "Use the run_sql function to run the SQL you've just generated: "
-                + sql_response,
-                model="gpt-4-1106-preview",
-                instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
-                turbo_tools=tools,
-            )
-            agent_instruments.validate_run_sql()
-        except PostgresError as e:
-            print(
-                f"Received PostgresError -> Running Self Correction Team To Resolve: {e}"
-            )
 
-            # ---------------- Run Self Correction Team - Diagnosis, Generate New SQL, Retry ----------------
-            self_correcting_assistant(db, agent_instruments, tools, e)
+@app.route("/usage", methods=["GET", "OPTIONS"])
+def usage():
+    """
+    The usage ledger: API reported tokens and cost overall, per session, team and model,
+    and the hedged requests with their extra spend.
+    """
+    response = make_cors_response()
+    if request.method == "OPTIONS":
+        return response
 
-            print(f"Self Correction Team Complete.")
+    response.data = json.dumps({**llm.get_usage_ledger(), "hedging": llm.get_hedge_stats()})
+    response.headers["Content-Type"] = "application/json"
+    return response
 
-        # ---------------- Read result files and respond ----------------
 
-        sql_query = open(agent_instruments.sql_query_file).read()
-        sql_query_results = open(agent_instruments.run_sql_results_file).read()
+# ---------------- Streaming Endpoint ----------------
 
-        response_obj = {
-            "prompt": base_prompt,
-            "results": sql_query_results,
-            "sql": sql_query,
-        }
 
-        print("response_obj", response_obj)
+def server_sent_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-        response.data = json.dumps(response_obj)
 
+@app.route("/prompt/stream", methods=["POST", "OPTIONS"])
+def prompt_stream():
+    """
+    /prompt as Server-Sent Events: pipeline stages and SQL tokens are pushed as they happen,
+    the last event is "result" (the /prompt response body) or "error".
+    """
+    response = make_cors_response()
+    if request.method == "OPTIONS":
         return response
 
+    base_prompt = request.json["prompt"]
+
+    def generate():
+        # first byte before connecting to the database
+        yield server_sent_event("stage", {"stage": "received"})
+
+        with instruments.PostgresAgentInstruments(DB_URL, "prompt-endpoint") as (
+            agent_instruments,
+            db,
+        ):
+            try:
+                for event, data in run_prompt_pipeline(
+                    base_prompt, agent_instruments, db, stream=True
+                ):
+                    yield server_sent_event(event, data)
+            except Exception as e:
+                print(f"Streaming prompt failed: {e}")
+                yield server_sent_event("error", {"status": 500, "message": str(e)})
+
+    stream_response = Response(generate(), mimetype="text/event-stream")
+    stream_response.headers.extend(response.headers)
+    stream_response.headers["Cache-Control"] = "no-cache"
+    # stop proxies from buffering the stream
+    stream_response.headers["X-Accel-Buffering"] = "no"
+    return stream_response
+
 
 if __name__ == "__main__":
     port = 3000
@@ -0,0 +1,87 @@
+"""
+Clone of postgres_da_ai_agent/modules/cache.py
+
+Purpose:
+    Small in-process caching helpers.
+    A bounded LRU cache with TTL and hit-rate counters, and stable hashing for cache keys.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+# returned by LRUCache.get on a miss, so None can be cached like any other value
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used cache.
+    Entries older than ttl_seconds are treated as misses and evicted. ttl_seconds=None never expires.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: Optional[float] = 3600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if self.ttl_seconds is None or time.time() - stored_at < self.ttl_seconds:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any):
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def stable_hash(*parts: Any) -> str:
+    """
+    sha256 of the JSON encoding of parts with sorted keys - equal inputs give equal hashes across processes.
+    """
+    encoded = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    '  Jobs completed   LAST week? ' -> 'jobs completed last week'
+    """
+    return " ".join(prompt.lower().split()).rstrip(".?!")
@@ -1,5 +1,6 @@
 from datetime import datetime
 import json
+import threading
 import psycopg2
 from psycopg2.sql import SQL, Identifier
 
@@ -11,35 +12,86 @@ class PostgresManager:
     """
 
     def __init__(self):
+        self.url = None
+        # libpq options of every connection, e.g. the statement_timeout
+        self.connect_options = None
         self.conn = None
         self.cur = None
+        self.owner_thread_id = None
+        # thread id -> read only autocommit connection, for run_sql calls from other threads (parallel tool calls)
+        self.map_thread_to_conn = {}
+        self.thread_conns_lock = threading.Lock()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.cur:
-            self.cur.close()
-        if self.conn:
-            self.conn.close()
+        self.close()
 
-    def connect_with_url(self, url):
-        self.conn = psycopg2.connect(url)
+    def connect_with_url(self, url, statement_timeout_seconds: float = None):
+        """
+        Connect to url. Statements running longer than statement_timeout_seconds are cancelled by postgres.
+        """
+        self.url = url
+        if statement_timeout_seconds:
+            self.connect_options = f"-c statement_timeout={int(statement_timeout_seconds * 1000)}"
+        self.conn = psycopg2.connect(url, options=self.connect_options)
         self.cur = self.conn.cursor()
+        self.owner_thread_id = threading.get_ident()
 
     def close(self):
         if self.cur:
             self.cur.close()
         if self.conn:
             self.conn.close()
+        with self.thread_conns_lock:
+            for conn in self.map_thread_to_conn.values():
+                conn.close()
+            self.map_thread_to_conn = {}
+
+    def thread_cursor(self):
+        """
+        The shared cursor on the thread that connected, else a cursor on the
+        calling thread's own connection, so queries from several threads run in parallel.
+        Those connections are read only: the shared connection never commits, so
+        writes the model generates must not stick here either. Autocommit means a
+        failed query leaves no aborted transaction behind.
+        """
+        thread_id = threading.get_ident()
+        if thread_id == self.owner_thread_id:
+            return self.cur
+        with self.thread_conns_lock:
+            conn = self.map_thread_to_conn.get(thread_id)
+            if conn is None:
+                conn = psycopg2.connect(self.url, options=self.connect_options)
+                conn.set_session(readonly=True, autocommit=True)
+                self.map_thread_to_conn[thread_id] = conn
+        return conn.cursor()
+
+    def cancel(self, thread_id: int):
+        """
+        Cancel the query running on thread_id's connection, e.g. a run_sql tool call that timed out.
+        """
+        if thread_id == self.owner_thread_id:
+            conn = self.conn
+        else:
+            with self.thread_conns_lock:
+                conn = self.map_thread_to_conn.get(thread_id)
+        if conn is not None:
+            conn.cancel()
 
     def run_sql(self, sql) -> str:
         """
         Run a SQL query against the postgres database
         """
-        self.cur.execute(sql)
-        columns = [desc[0] for desc in self.cur.description]
-        res = self.cur.fetchall()
+        cur = self.thread_cursor()
+        try:
+            cur.execute(sql)
+            columns = [desc[0] for desc in cur.description]
+            res = cur.fetchall()
+        finally:
+            if cur is not self.cur:
+                cur.close()
 
         list_of_dicts = [dict(zip(columns, row)) for row in res]
 
@@ -69,8 +121,10 @@ class PostgresManager:
         JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
         JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid
         WHERE pg_attribute.attnum > 0
+            AND NOT pg_attribute.attisdropped
             AND pg_class.relname = %s
             AND pg_namespace.nspname = 'public'  -- Assuming you're interested in public schema
+        ORDER BY pg_attribute.attnum
         """
         self.cur.execute(get_def_stmt, (table_name,))
         rows = self.cur.fetchall()
@@ -110,6 +164,30 @@ class PostgresManager:
             definitions[table_name] = self.get_table_definition(table_name)
         return definitions
 
+    def get_table_comment_map_for_embeddings(self):
+        """
+        Creates a map of table names to their table and column comments
+        """
+        get_comments_stmt = """
+        SELECT pg_class.relname as tablename,
+            obj_description(pg_class.oid, 'pg_class'),
+            string_agg(col_description(pg_class.oid, pg_attribute.attnum), ' ')
+        FROM pg_class
+        JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+        JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid
+        WHERE pg_attribute.attnum > 0
+            AND pg_class.relkind = 'r'
+            AND pg_namespace.nspname = 'public'
+        GROUP BY pg_class.oid, pg_class.relname
+        """
+        self.cur.execute(get_comments_stmt)
+        comments = {}
+        for table_name, table_comment, column_comments in self.cur.fetchall():
+            comment = " ".join(c for c in (table_comment, column_comments) if c)
+            if comment:
+                comments[table_name] = comment
+        return comments
+
     def get_related_tables(self, table_list, n=2):
         """
         Get tables that have foreign keys referencing the given table
@@ -128,6 +206,8 @@ class PostgresManager:
                     JOIN pg_class a ON a.oid = con.conrelid 
                 WHERE 
                     confrelid = (SELECT oid FROM pg_class WHERE relname = %s)
+                ORDER BY
+                    a.relname
                 LIMIT %s;
                 """,
                 (table, n),
@@ -145,6 +225,8 @@ class PostgresManager:
                     JOIN pg_class a ON a.oid = con.confrelid 
                 WHERE 
                     conrelid = (SELECT oid FROM pg_class WHERE relname = %s)
+                ORDER BY
+                    a.relname
                 LIMIT %s;
                 """,
                 (table, n),
@@ -159,7 +241,8 @@ class PostgresManager:
         for table, related_tables in related_tables_dict.items():
             related_tables_list += related_tables
 
-        related_tables_list = list(set(related_tables_list))
+        # dict.fromkeys keeps first seen order, so the result is stable between calls
+        related_tables_list = list(dict.fromkeys(related_tables_list))
 
         return related_tables_list
 
@@ -1,4 +1,15 @@
+import threading
+
 from modules.db import PostgresManager
+from modules.feedback import FeedbackStore
+from modules.table_summaries import TableSummaryStore
+from modules import context_packer, lexical, llm
+from modules.word_match import WordMatcher, column_names_from_table_def
+
+# schema fingerprint -> WordMatcher, shared by the per request embedders
+_word_matcher_cache = {}
+# requests run on a threadpool, the check and populate of _word_matcher_cache happen under this lock
+_word_matcher_cache_lock = threading.Lock()
 
 
 class DatabaseEmbedder:
@@ -7,27 +18,71 @@ class DatabaseEmbedder:
     computing similarity between user queries and table definitions.
     """
 
-    def __init__(self, db: PostgresManager):
+    def __init__(
+        self,
+        db: PostgresManager,
+        context_token_budget=None,
+        table_summaries: TableSummaryStore = None,
+        feedback: FeedbackStore = None,
+        feedback_weight=0.5,
+        feedback_extra_tables=1,
+    ):
         self.map_name_to_embeddings = {}
         self.map_name_to_table_def = {}
+        self.map_name_to_comment = {}
+        # lexical.schema_fingerprint of the loaded definitions and comments, hashed once in load_schema
+        self.fingerprint = None
+        # upper bound on table definition tokens per prompt, None packs every table in full
+        self.context_token_budget = context_token_budget
+        # llm written table descriptions, indexed with the comments - see modules/table_summaries.py
+        self.table_summaries = table_summaries
+        # tables of past successful queries per prompt word - see modules/feedback.py
+        self.feedback = feedback
+        self.feedback_weight = feedback_weight
+        self.feedback_extra_tables = feedback_extra_tables
         self.db = db
 
-    def get_similar_table_defs_for_prompt(self, prompt: str, n_similar=5, n_foreign=0):
+    def load_schema(self):
+        """
+        Read the table definitions and comments (plus table summaries) from db, once per embedder.
+        """
+        if self.map_name_to_table_def:
+            return
         map_table_name_to_table_def = self.db.get_table_definition_map_for_embeddings()
         for name, table_def in map_table_name_to_table_def.items():
             self.add_table(name, table_def)
+        self.map_name_to_comment = self.db.get_table_comment_map_for_embeddings()
+        if self.table_summaries:
+            summaries = self.table_summaries.summaries_for(self.map_name_to_table_def)
+            for table_name, summary in summaries.items():
+                comment = self.map_name_to_comment.get(table_name, "")
+                self.map_name_to_comment[table_name] = f"{comment} {summary}".strip()
+        self.fingerprint = lexical.schema_fingerprint(
+            self.map_name_to_table_def, self.map_name_to_comment
+        )
 
-        similar_tables = self.get_similar_tables(prompt, n=n_similar)
-
-        table_definitions = self.get_table_definitions_from_names(similar_tables)
+    def schema_fingerprint(self) -> str:
+        """
+        Hash of the table definitions and comments, changes whenever the schema does.
+        """
+        self.load_schema()
+        return self.fingerprint
 
-        if n_foreign > 0:
-            foreign_table_names = self.db.get_foreign_tables(similar_tables, n=3)
+    def get_similar_table_defs_for_prompt(self, prompt: str, n_similar=5, n_foreign=0):
+        self.load_schema()
 
-            table_definitions = self.get_table_definitions_from_names(
-                foreign_table_names + similar_tables
-            )
+        similar_tables = self.get_similar_tables(prompt, n=n_similar)
 
+        if n_foreign > 0:
+            foreign_table_names = self.db.get_related_tables(similar_tables, n=3)
+            similar_tables = [
+                table_name
+                for table_name, _ in context_packer.fuse_rankings(
+                    [(similar_tables, 1.0), (foreign_table_names, 0.5)]
+                )
+            ]
+
+        table_definitions, _ = self.pack_table_definitions(similar_tables)
         return table_definitions
 
     def add_table(self, table_name: str, text_representation: str):
@@ -60,30 +115,115 @@ class DatabaseEmbedder:
         """
         return []
 
-    def get_similar_table_names_via_word_match(self, query: str):
+    def get_similar_tables_via_lexical(self, query, n=3):
         """
-        if any word in our query is a table name, add the table to a list
+        Given a query, find the top 'n' tables by BM25 over table names, column names and comments.
+        The index is built once per schema and cached at module level.
         """
+        index = lexical.get_or_build_index(
+            self.map_name_to_table_def, self.map_name_to_comment, self.schema_fingerprint()
+        )
+        return index.search(query, n)
 
-        tables = []
-
-        for table_name in self.map_name_to_table_def.keys():
-            if table_name.lower() in query.lower():
-                tables.append(table_name)
-
-        return tables
+    def get_similar_table_names_via_word_match(self, query: str):
+        """
+        if any word in our query is a table name (or a distinctive column name), add the table to a list
+        """
+        fingerprint = self.schema_fingerprint()
+
+        with _word_matcher_cache_lock:
+            word_matcher = _word_matcher_cache.get(fingerprint)
+            if word_matcher is None:
+                word_matcher = WordMatcher(
+                    {
+                        table_name: column_names_from_table_def(table_def)
+                        for table_name, table_def in self.map_name_to_table_def.items()
+                    }
+                )
+                _word_matcher_cache.clear()
+                _word_matcher_cache[fingerprint] = word_matcher
+
+        return word_matcher.match(query)
 
     def get_similar_tables(self, query: str, n=3):
         """
-        combines results from get_similar_tables_via_embeddings and get_similar_table_names_via_word_match
+        combines results from get_similar_tables_via_embeddings, get_similar_tables_via_lexical
+        and get_similar_table_names_via_word_match, ranked by fused score without repeats
         """
 
         similar_tables_via_embeddings = self.get_similar_tables_via_embeddings(query, n)
+        similar_tables_via_lexical = self.get_similar_tables_via_lexical(query, n)
         similar_tables_via_word_match = self.get_similar_table_names_via_word_match(
             query
         )
 
-        return similar_tables_via_embeddings + similar_tables_via_word_match
+        return self.blend_feedback(
+            query,
+            [
+                (similar_tables_via_embeddings, 1.0),
+                (similar_tables_via_lexical, 1.0),
+                (similar_tables_via_word_match, 1.0),
+            ],
+        )
+
+    def blend_feedback(self, query: str, rankings: list) -> list:
+        """
+        Fuse the retrievers' rankings with the feedback prior into one ranking.
+        When past queries for this prompt shape agree on a table set, return that set
+        plus feedback_extra_tables retrieved tables instead of everything retrieved.
+        """
+        if self.feedback is None:
+            return [table_name for table_name, _ in context_packer.fuse_rankings(rankings)]
+
+        def known(table_names):
+            return [name for name in table_names if name in self.map_name_to_table_def]
+
+        rankings = rankings + [(known(self.feedback.rank(query)), self.feedback_weight)]
+        ranked = [table_name for table_name, _ in context_packer.fuse_rankings(rankings)]
+
+        confident = known(self.feedback.confident_tables(query))
+        if not confident:
+            return ranked
+        extra = [name for name in ranked if name not in confident]
+        return confident + extra[: self.feedback_extra_tables]
+
+    def record_feedback(self, prompt: str, sql: str) -> list:
+        """
+        Learn from a query that ran successfully for prompt. Returns the tables it used.
+        """
+        if self.feedback is None:
+            return []
+        self.load_schema()
+        return self.feedback.record(prompt, sql, self.map_name_to_table_def.keys())
+
+    def pack_table_definitions(self, table_names: list, token_budget=None):
+        """
+        Render ranked tables into at most token_budget tokens (defaults to context_token_budget).
+        Lower ranked tables are downgraded to key columns or name only, then dropped.
+        """
+        if token_budget is None:
+            token_budget = self.context_token_budget
+
+        table_definitions, report = context_packer.pack_tables(
+            table_names, self.render_table, llm.count_tokens, token_budget
+        )
+        print(
+            f"Packed {len(report['tables'])} tables into {report['tokens']:.0f} tokens (budget {token_budget}), dropped {len(report['dropped'])}"
+        )
+        return table_definitions, report
+
+    def render_table(self, table_name: str, level: str) -> str:
+        """
+        Render a table at one of context_packer.RENDER_LEVELS.
+        """
+        table_def = self.map_name_to_table_def[table_name]
+        if level == "full":
+            return table_def
+        if level == "keys":
+            return context_packer.render_key_columns_from_ddl(table_name, table_def)
+        return context_packer.render_name_only(
+            table_name, len(column_names_from_table_def(table_def))
+        )
 
     def get_table_definitions_from_names(self, table_names: list) -> str:
         """
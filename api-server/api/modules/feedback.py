@@ -0,0 +1,212 @@
+"""
+Clone of postgres_da_ai_agent/modules/feedback.py
+
+Purpose:
+    Learn retrieval from the SQL that actually ran.
+    Every successful query is parsed for the tables it references and the
+    prompt's words are counted against those tables. The decayed counts give
+    P(table | word), a cheap prior that is blended into table ranking, and
+    lets question shapes seen often enough skip unneeded context.
+"""
+
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, List
+
+from modules.word_match import split_words
+
+SQL_IDENTIFIER = r'(?:"[^"]+"|[A-Za-z_][A-Za-z0-9_$]*)'
+SQL_TABLE_RE = re.compile(
+    rf"\b(?:from|join|update|into)\s+({SQL_IDENTIFIER}(?:\s*\.\s*{SQL_IDENTIFIER})?)",
+    re.IGNORECASE,
+)
+SQL_CTE_RE = re.compile(rf"({SQL_IDENTIFIER})\s+as\s*\(", re.IGNORECASE)
+
+STOPWORDS = {
+    "a", "all", "an", "and", "are", "by", "each", "for", "from", "get", "give",
+    "how", "i", "in", "is", "list", "me", "many", "much", "of", "on", "or",
+    "per", "show", "that", "the", "their", "them", "to", "top", "what",
+    "which", "who", "with",
+}
+
+
+def unquote_identifier(identifier: str) -> str:
+    identifier = identifier.strip()
+    if identifier.startswith('"'):
+        return identifier.strip('"')
+    return identifier.lower()
+
+
+def extract_tables(sql: str, known_tables: Iterable[str] = None) -> List[str]:
+    """
+    Tables referenced by a query (FROM / JOIN / UPDATE / INTO), in first seen order.
+    CTE names are skipped. With known_tables, anything else is dropped too.
+    """
+    cte_names = {unquote_identifier(name) for name in SQL_CTE_RE.findall(sql)}
+    known = set(known_tables) if known_tables is not None else None
+
+    tables = []
+    for reference in SQL_TABLE_RE.findall(sql):
+        table_name = unquote_identifier(re.split(r"\s*\.\s*", reference)[-1])
+        if table_name in cte_names or (known is not None and table_name not in known):
+            continue
+        if table_name not in tables:
+            tables.append(table_name)
+    return tables
+
+
+def prompt_terms(prompt: str) -> List[str]:
+    return sorted({word for word in split_words(prompt) if word not in STOPWORDS})
+
+
+class FeedbackStore:
+    """
+    Json file of prompt word -> decayed count, and decayed count per table the
+    queries for prompts with that word referenced.
+
+    Counts halve every half_life_days, so the prior follows schema and usage changes.
+    version increases on every record, for cache keys.
+
+    record only marks the store dirty. The file is rewritten at most every
+    save_interval_seconds by a background thread, and once more at exit,
+    so a request never pays for writing the whole store.
+    """
+
+    def __init__(self, path: str, half_life_days: float = 30, save_interval_seconds: float = 30):
+        self.path = path
+        self.half_life_seconds = half_life_days * 24 * 3600
+        self.save_interval_seconds = save_interval_seconds
+        self.lock = threading.Lock()
+        # one writer at a time, held while writing so record isn't blocked on the file
+        self.save_lock = threading.Lock()
+        self.version = 0
+        # records not yet written to path
+        self.dirty = False
+        # word -> {"count": float, "updated": unix seconds, "tables": {table name: float}}
+        self.map_term_to_counts: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.map_term_to_counts = json.load(f)["terms"]
+
+        self.stopped = threading.Event()
+        if save_interval_seconds:
+            threading.Thread(target=self.save_periodically, daemon=True).start()
+        atexit.register(self.flush)
+
+    def decay(self, counts: dict, now: float) -> float:
+        return 0.5 ** (max(now - counts["updated"], 0) / self.half_life_seconds)
+
+    def record(self, prompt: str, sql: str, known_tables: Iterable[str] = None) -> List[str]:
+        """
+        Count the tables of a successful query against the words of its prompt.
+        Returns the tables found in sql.
+        """
+        tables = extract_tables(sql, known_tables)
+        terms = prompt_terms(prompt)
+        if not tables or not terms:
+            return tables
+
+        now = time.time()
+        with self.lock:
+            for term in terms:
+                counts = self.map_term_to_counts.setdefault(
+                    term, {"count": 0.0, "updated": now, "tables": {}}
+                )
+                factor = self.decay(counts, now)
+                counts["count"] = counts["count"] * factor + 1
+                counts["tables"] = {
+                    table_name: weight * factor
+                    for table_name, weight in counts["tables"].items()
+                    if weight * factor >= 0.01
+                }
+                for table_name in tables:
+                    counts["tables"][table_name] = counts["tables"].get(table_name, 0.0) + 1
+                counts["updated"] = now
+            self.version += 1
+            self.dirty = True
+        return tables
+
+    def score_tables(self, prompt: str) -> Dict[str, dict]:
+        """
+        table name -> {"share": mean P(table | word) over the prompt's known words,
+        "support": mean decayed number of queries behind it per word}.
+        """
+        now = time.time()
+        scores = {}
+        with self.lock:
+            matched = [
+                self.map_term_to_counts[term]
+                for term in prompt_terms(prompt)
+                if term in self.map_term_to_counts
+            ]
+            for counts in matched:
+                factor = self.decay(counts, now)
+                for table_name, weight in counts["tables"].items():
+                    score = scores.setdefault(table_name, {"share": 0.0, "support": 0.0})
+                    score["share"] += weight / counts["count"] / len(matched)
+                    score["support"] += weight * factor / len(matched)
+        return scores
+
+    def rank(self, prompt: str, n: int = 5) -> List[str]:
+        """
+        Up to 'n' tables, best first, by P(table | prompt words).
+        """
+        scores = self.score_tables(prompt)
+        return sorted(scores, key=lambda table_name: -scores[table_name]["share"])[:n]
+
+    def confident_tables(
+        self, prompt: str, min_share: float = 0.8, min_support: float = 3
+    ) -> List[str]:
+        """
+        Tables nearly every past query for this prompt shape used, once the shape has been seen min_support times.
+        """
+        scores = self.score_tables(prompt)
+        return [
+            table_name
+            for table_name in sorted(scores, key=lambda name: -scores[name]["share"])
+            if scores[table_name]["share"] >= min_share
+            and scores[table_name]["support"] >= min_support
+        ]
+
+    def save_periodically(self):
+        while not self.stopped.wait(self.save_interval_seconds):
+            self.flush()
+
+    def flush(self):
+        """
+        Write the store if anything was recorded since the last write.
+        """
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                content = json.dumps({"terms": self.map_term_to_counts})
+                self.dirty = False
+            try:
+                self.save(content)
+            except OSError as e:
+                print(f"Could not save feedback store {self.path}: {e}")
+                with self.lock:
+                    self.dirty = True
+
+    def save(self, content: str = None):
+        if content is None:
+            with self.lock:
+                content = json.dumps({"terms": self.map_term_to_counts})
+        # write then rename, readers never see a half written file.
+        # The temp file is per process and thread, so concurrent writers never share one
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, self.path)
+
+    def stop(self):
+        """
+        Stop the background writer and write what is pending.
+        """
+        self.stopped.set()
+        self.flush()
@@ -0,0 +1,177 @@
+"""
+Purpose:
+    Dependency free lexical retrieval (BM25) over table definitions.
+    Stands in for BERT embeddings in the api-server where torch was dropped for deployment size.
+"""
+
+import hashlib
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+# table names say more about a table than any single column, so they count extra
+TABLE_NAME_WEIGHT = 3
+
+IDENTIFIER_RE = re.compile(r"[A-Za-z0-9_]+")
+CAMEL_CASE_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+DDL_COLUMN_RE = re.compile(r"^\s*\"?([A-Za-z0-9_]+)\"?\s", re.MULTILINE)
+
+# ------------------ tokenization ------------------
+
+
+def normalize_token(token: str) -> str:
+    """
+    Cheap plural/stem normalisation so 'jobs', 'job' and 'jobbing' meet in the middle.
+    'categories' -> 'category', 'statuses' -> 'status', 'jobs' -> 'job', 'created' -> 'creat'
+    """
+    if len(token) <= 3:
+        return token
+    if token.endswith("ies"):
+        return token[:-3] + "y"
+    if token.endswith(("sses", "shes", "ches", "xes", "uses")):
+        return token[:-2]
+    if token.endswith("s") and not token.endswith(("ss", "us", "is")):
+        return token[:-1]
+    if token.endswith("ing") and len(token) > 5:
+        return token[:-3]
+    if token.endswith("ed") and len(token) > 4:
+        return token[:-2]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into normalised terms.
+    snake_case and camelCase identifiers produce both their parts and the whole identifier.
+    'jobStatus job_status' -> ['job', 'status', 'jobstatus', 'job', 'status', 'job_status']
+    """
+    terms = []
+    for identifier in IDENTIFIER_RE.findall(text):
+        parts = [
+            part.lower()
+            for snake_part in identifier.split("_")
+            for part in CAMEL_CASE_RE.findall(snake_part)
+        ]
+        terms += [normalize_token(part) for part in parts]
+        if len(parts) > 1:
+            terms.append(identifier.lower())
+    return terms
+
+
+def table_document(table_name: str, table_def: str, comment: str = "") -> List[str]:
+    """
+    Build the retrieval document for a table from its name, column names and comments.
+    Column types are left out - 'integer' and 'text' match every table equally.
+    """
+    body = table_def.split("(", 1)[1] if "(" in table_def else ""
+    column_names = " ".join(DDL_COLUMN_RE.findall(body))
+    return (
+        tokenize(table_name) * TABLE_NAME_WEIGHT
+        + tokenize(column_names)
+        + tokenize(comment)
+    )
+
+
+# ------------------ BM25 index ------------------
+
+
+class LexicalIndex:
+    """
+    Okapi BM25 over an inverted index of term -> [(table name, term frequency)].
+    """
+
+    def __init__(self, documents: Dict[str, List[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.inverted_index: Dict[str, List[tuple]] = {}
+        self.doc_lengths: Dict[str, int] = {}
+
+        for table_name, terms in documents.items():
+            self.doc_lengths[table_name] = len(terms)
+            for term, tf in Counter(terms).items():
+                self.inverted_index.setdefault(term, []).append((table_name, tf))
+
+        n_docs = len(documents)
+        self.avg_doc_length = (
+            sum(self.doc_lengths.values()) / n_docs if n_docs else 0.0
+        )
+        self.idf = {
+            term: math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.inverted_index.items()
+        }
+
+    def search(self, query: str, n: int = 3) -> List[str]:
+        """
+        Return the top 'n' table names for the query, best first. Tables sharing no term are never returned.
+        """
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            postings = self.inverted_index.get(term)
+            if not postings:
+                continue
+            idf = self.idf[term]
+            for table_name, tf in postings:
+                length_norm = 1 - self.b + self.b * (
+                    self.doc_lengths[table_name] / self.avg_doc_length
+                )
+                scores[table_name] = scores.get(table_name, 0.0) + idf * (
+                    tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+                )
+
+        return sorted(scores, key=lambda name: (-scores[name], name))[:n]
+
+
+# ------------------ cache ------------------
+
+# fingerprint -> LexicalIndex, only the index for the latest schema is kept
+_index_cache: Dict[str, LexicalIndex] = {}
+# requests run on a threadpool, the check and populate of _index_cache happen under this lock
+_index_cache_lock = threading.Lock()
+
+
+def schema_fingerprint(
+    map_name_to_table_def: Dict[str, str],
+    map_name_to_comment: Optional[Dict[str, str]] = None,
+) -> str:
+    """
+    Stable hash of the table definitions and comments - changes whenever the schema does.
+    """
+    map_name_to_comment = map_name_to_comment or {}
+    digest = hashlib.sha1()
+    for table_name in sorted(map_name_to_table_def):
+        digest.update(table_name.encode())
+        digest.update(map_name_to_table_def[table_name].encode())
+        digest.update(map_name_to_comment.get(table_name, "").encode())
+    return digest.hexdigest()
+
+
+def get_or_build_index(
+    map_name_to_table_def: Dict[str, str],
+    map_name_to_comment: Optional[Dict[str, str]] = None,
+    fingerprint: Optional[str] = None,
+) -> LexicalIndex:
+    """
+    Build the index once per schema and serve it from the module cache afterwards.
+    Pass the schema_fingerprint when the caller has it, so the schema isn't hashed again.
+    """
+    map_name_to_comment = map_name_to_comment or {}
+    if fingerprint is None:
+        fingerprint = schema_fingerprint(map_name_to_table_def, map_name_to_comment)
+
+    with _index_cache_lock:
+        index = _index_cache.get(fingerprint)
+        if index is None:
+            index = LexicalIndex(
+                {
+                    table_name: table_document(
+                        table_name, table_def, map_name_to_comment.get(table_name, "")
+                    )
+                    for table_name, table_def in map_name_to_table_def.items()
+                }
+            )
+            _index_cache.clear()
+            _index_cache[fingerprint] = index
+
+    return index
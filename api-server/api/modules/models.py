@@ -1,6 +1,6 @@
 from dataclasses import dataclass, field
 import time
-from typing import Callable
+from typing import Callable, Optional
 
 
 @dataclass
@@ -8,6 +8,8 @@ class TurboTool:
     name: str
     config: dict
     function: Callable
+    # called with the id of the thread running a call that timed out, to stop its work
+    cancel: Optional[Callable[[int], None]] = None
 
 
 @dataclass
@@ -0,0 +1,196 @@
+"""
+Purpose:
+    Semantic cache of generated SQL for the /prompt endpoint.
+    Prompts are embedded as bags of normalised terms (lexical.tokenize), so
+    paraphrases like "jobs completed last week" and "last week's completed jobs"
+    meet. A prompt reuses the SQL of the most similar past prompt for the same
+    schema when their cosine similarity clears the threshold and no content term
+    differs, skipping both LLM calls. Cosine alone is not enough: "customers who
+    have placed orders" vs "... have not placed orders" scores 0.926, germany vs
+    france 0.933, average vs maximum order value 0.929.
+    Every lookup is logged with its best score so the threshold can be tuned.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Set
+
+from modules.cache import normalize_prompt
+from modules.lexical import tokenize
+
+
+# words that don't change which rows a question asks for. Negations, prepositions
+# (to / from, before / after) and aggregates stay content terms.
+STOPWORDS = set(
+    "a an the of me please all any "
+    "show list give get find display return fetch what which "
+    "is are was were be been do doe did has have had that there who whose".split()
+)
+
+# normalised term -> the term it means the same as
+map_term_to_synonym = {
+    "biggest": "largest",
+    "greatest": "largest",
+    "newest": "latest",
+    "recent": "latest",
+    "client": "customer",
+    "amount": "total",
+    "sum": "total",
+}
+
+
+def embed_prompt(prompt: str) -> Dict[str, float]:
+    """
+    Unit length term count vector of a prompt. Stopwords and single character terms
+    ("s" of "week's") are dropped, synonyms are folded.
+    """
+    counts = Counter(
+        map_term_to_synonym.get(term, term)
+        for term in tokenize(normalize_prompt(prompt))
+        if len(term) > 1 and term not in STOPWORDS
+    )
+    norm = math.sqrt(sum(count * count for count in counts.values())) or 1.0
+    return {term: count / norm for term, count in counts.items()}
+
+
+def cosine_similarity(a: Dict[str, float], b: Dict[str, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(term, 0.0) for term, weight in a.items())
+
+
+def content_terms(vector: Dict[str, float]) -> Set[str]:
+    """
+    Terms of an embedded prompt that change its meaning. embed_prompt already drops
+    stopwords and folds synonyms, this also covers entries stored before it did.
+    Numbers are content terms, so 'top 5' never matches 'top 10'.
+    """
+    return {map_term_to_synonym.get(term, term) for term in vector if term not in STOPWORDS}
+
+
+class SemanticSQLCache:
+    """
+    Past (prompt, sql, schema fingerprint) entries, optionally persisted to a json file.
+    Lookups scan the entries of the current schema; at most max_entries are kept,
+    the least recently used are evicted first.
+    """
+
+    def __init__(self, path: str = None, threshold: float = 0.9, max_entries: int = 1000):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.counts = {"lookups": 0, "hits": 0, "misses": 0, "fallbacks": 0}
+        # {"prompt", "vector", "sql", "schema_fingerprint", "created_at", "last_used", "hits"}
+        self.entries: List[dict] = []
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)["entries"]
+
+    def lookup(self, prompt: str, schema_fingerprint: str) -> Optional[dict]:
+        """
+        The entry most similar to prompt for this schema, if it clears the threshold
+        and has the same content terms. A prompt with a term the entry lacks (or the other
+        way around) - 'not', 'germany' vs 'france', 'average' vs 'maximum' - never matches.
+        """
+        vector = embed_prompt(prompt)
+        terms = content_terms(vector)
+
+        with self.lock:
+            best_entry, best_score = None, 0.0
+            # most similar entry whose terms differ, logged to tune the stopwords and synonyms
+            closest_differing, closest_differing_score = None, 0.0
+            for entry in self.entries:
+                if entry["schema_fingerprint"] != schema_fingerprint:
+                    continue
+                score = cosine_similarity(vector, entry["vector"])
+                if content_terms(entry["vector"]) != terms:
+                    if score > closest_differing_score:
+                        closest_differing, closest_differing_score = entry, score
+                    continue
+                if score > best_score:
+                    best_entry, best_score = entry, score
+
+            self.counts["lookups"] += 1
+            hit = best_entry is not None and best_score >= self.threshold
+            if hit:
+                self.counts["hits"] += 1
+                best_entry["last_used"] = time.time()
+                best_entry["hits"] += 1
+            else:
+                self.counts["misses"] += 1
+
+        print(
+            f"sql cache {'hit' if hit else 'miss'}: score={best_score:.3f} threshold={self.threshold} "
+            f"prompt={prompt!r} closest={best_entry['prompt'] if best_entry else None!r}"
+        )
+        if closest_differing is not None and closest_differing_score >= self.threshold:
+            differing = sorted(terms ^ content_terms(closest_differing["vector"]))
+            print(
+                f"sql cache rejected: score={closest_differing_score:.3f} prompt={prompt!r} "
+                f"closest={closest_differing['prompt']!r} differing terms={differing}"
+            )
+        return best_entry if hit else None
+
+    def store(self, prompt: str, sql: str, schema_fingerprint: str):
+        """
+        Remember the SQL that ran successfully for prompt. Replaces an entry for the same normalised prompt.
+        """
+        now = time.time()
+        normalized = normalize_prompt(prompt)
+        with self.lock:
+            self.entries = [
+                entry
+                for entry in self.entries
+                if not (
+                    entry["schema_fingerprint"] == schema_fingerprint
+                    and normalize_prompt(entry["prompt"]) == normalized
+                )
+            ]
+            self.entries.append(
+                {
+                    "prompt": prompt,
+                    "vector": embed_prompt(prompt),
+                    "sql": sql,
+                    "schema_fingerprint": schema_fingerprint,
+                    "created_at": now,
+                    "last_used": now,
+                    "hits": 0,
+                }
+            )
+            if len(self.entries) > self.max_entries:
+                self.entries.sort(key=lambda entry: entry["last_used"])
+                self.entries = self.entries[-self.max_entries :]
+            self.save()
+
+    def record_fallback(self, entry: dict, error: Exception):
+        """
+        The cached SQL failed to run: drop the entry, the caller falls back to generating SQL.
+        """
+        with self.lock:
+            self.counts["fallbacks"] += 1
+            self.entries = [e for e in self.entries if e is not entry]
+            self.save()
+        print(f"sql cache fallback: prompt={entry['prompt']!r} error={error}")
+
+    def save(self):
+        if not self.path:
+            return
+        # write then rename, readers never see a half written file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            counts = dict(self.counts)
+            counts["entries"] = len(self.entries)
+        counts["hit_rate"] = (
+            round(counts["hits"] / counts["lookups"], 4) if counts["lookups"] else 0.0
+        )
+        return counts
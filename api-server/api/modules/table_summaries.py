@@ -0,0 +1,58 @@
+"""
+Clone of postgres_da_ai_agent/modules/table_summaries.py (reading only, descriptions
+are generated with poetry run enrich_tables)
+
+Purpose:
+    Natural language table descriptions for retrieval.
+    Descriptions are stored content-addressed by a hash of the table definition.
+    The BM25 index indexes them alongside table and column names.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+
+def ddl_hash(table_def: str) -> str:
+    return hashlib.sha256(table_def.strip().encode()).hexdigest()
+
+
+class TableSummaryStore:
+    """
+    Json file of table definition hash -> description.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.map_hash_to_summary: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.map_hash_to_summary = json.load(f)
+
+    def __len__(self):
+        return len(self.map_hash_to_summary)
+
+    def get(self, table_def: str) -> Optional[str]:
+        return self.map_hash_to_summary.get(ddl_hash(table_def))
+
+    def set(self, table_def: str, summary: str):
+        self.map_hash_to_summary[ddl_hash(table_def)] = summary.strip()
+
+    def summaries_for(self, map_name_to_table_def: Dict[str, str]) -> Dict[str, str]:
+        """
+        table name -> description, for the tables that have one.
+        """
+        summaries = {}
+        for table_name, table_def in map_name_to_table_def.items():
+            summary = self.get(table_def)
+            if summary:
+                summaries[table_name] = summary
+        return summaries
+
+    def save(self):
+        # write then rename, readers never see a half written file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.map_hash_to_summary, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,74 @@
+"""
+Clone of postgres_da_ai_agent/modules/tokenizer.py
+
+The api server doesn't ship tiktoken: tokens are estimated as len(text) / 4,
+close to cl100k_base on English and SQL, so token budgets mean the same here as in
+the agent package. The estimate is cheaper than hashing the text, so counts are not memoized.
+
+Purpose:
+    Token counting for prompts, rate limits and cost estimates.
+    ConversationTokenCount keeps a running total of an append-only
+    conversation: each new message is counted once, never the whole history.
+"""
+
+from typing import Iterable, Optional
+
+# average characters per cl100k_base token of English text and SQL
+CHARACTERS_PER_TOKEN = 4
+
+# chat format overhead - https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+class Tokenizer:
+    """
+    Estimated token counts. Same interface as the tiktoken backed Tokenizer of the agent package.
+    """
+
+    def __init__(self, model: Optional[str] = None, max_size: int = 4096):
+        self.model = model
+
+    def count(self, text: str) -> float:
+        return len(text) / CHARACTERS_PER_TOKEN
+
+    def count_messages(self, messages: Iterable[dict]) -> float:
+        """
+        Tokens of chat messages as the API counts them: each message's content plus the chat format overhead.
+        """
+        tokens = TOKENS_PER_REPLY
+        for message in messages:
+            tokens += TOKENS_PER_MESSAGE + self.count(str(message.get("content") or ""))
+        return tokens
+
+    def stats(self) -> dict:
+        return {}
+
+
+class ConversationTokenCount:
+    """
+    Running token count of an append-only list of messages joined by separator.
+    append counts only the new message, so counting a conversation of n messages is O(n)
+    instead of re-counting the growing joined text on every turn.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, separator: str = "\n"):
+        self.tokenizer = tokenizer
+        self.separator_tokens = tokenizer.count(separator)
+        self.messages = 0
+        self.total = 0
+
+    def append(self, text: str) -> float:
+        """
+        Add a message. Returns the new total.
+        """
+        if self.messages:
+            self.total += self.separator_tokens
+        self.total += self.tokenizer.count(text)
+        self.messages += 1
+        return self.total
+
+    def extend(self, texts: Iterable[str]) -> float:
+        for text in texts:
+            self.append(text)
+        return self.total
@@ -14,7 +14,7 @@ from openai.types.beta import Thread, Assistant
 from openai.types import FileObject
 from openai.types.beta.threads.thread_message import ThreadMessage
 from openai.types.beta.threads.run_submit_tool_outputs_params import ToolOutput
-from modules import llm
+from modules import llm, usage_ledger
 from modules.models import Chat, TurboTool
 
 dotenv.load_dotenv()
@@ -27,18 +27,23 @@ class Turbo4:
 
     def __init__(self):
         openai.api_key = os.environ.get("OPENAI_API_KEY")
-        self.client: openai = OpenAI()
+        self.client: openai = OpenAI(max_retries=llm.LLM_MAX_RETRIES)
 
         self.map_function_tools: Dict[str, TurboTool] = {}
         self.current_thread_id = None
         self.thread_messages: List[ThreadMessage] = []
         self.local_messages = []
+        # running token count of local_messages, each message is counted once
+        self.local_token_count = llm.make_conversation_token_count()
         self.file_ids = []
         self.assistant_id = None
         self.polling_interval = (
             0.5  # Interval in seconds to poll the API for thread run completion
         )
         self.model = "gpt-4-1106-preview"
+        self.assistant_name = None
+        # usage blocks of this assistant's runs, see get_costs_and_tokens
+        self.usage = usage_ledger.empty_totals()
 
     @property
     def chat_messages(self) -> List[Chat]:
@@ -75,33 +80,36 @@ class Turbo4:
 
     def get_costs_and_tokens(self, output_file: str) -> Tuple[float, float]:
         """
-        Get the estimated cost and token usage for the current thread.
+        Write the cost and token usage of this assistant's runs, as reported by the API.
+        Runs without a usage block fall back to estimating from the thread messages.
 
         https://openai.com/pricing
 
         Open questions - how to calculate retrieval and code interpreter costs?
         """
 
-        retrival_costs = 0
-        code_interpreter_costs = 0
+        if self.usage["prompt_tokens"] or self.usage["completion_tokens"]:
+            costs = {
+                "cost": round(self.usage["cost"], 4),
+                "tokens": self.usage["prompt_tokens"] + self.usage["completion_tokens"],
+                "prompt_tokens": self.usage["prompt_tokens"],
+                "completion_tokens": self.usage["completion_tokens"],
+                "cached_tokens": self.usage["cached_tokens"],
+                "estimated": False,
+            }
+        else:
+            msgs = [
+                llm.safe_get(msg.model_dump(), "content.0.text.value")
+                for msg in self.thread_messages
+            ]
+            joined_msgs = " ".join(msgs)
 
-        msgs = [
-            llm.safe_get(msg.model_dump(), "content.0.text.value")
-            for msg in self.thread_messages
-        ]
-        joined_msgs = " ".join(msgs)
+            msg_cost, tokens = llm.estimate_price_and_tokens(joined_msgs, self.model)
 
-        msg_cost, tokens = llm.estimate_price_and_tokens(joined_msgs, self.model)
+            costs = {"cost": msg_cost, "tokens": tokens, "estimated": True}
 
         with open(output_file, "w") as f:
-            json.dump(
-                {
-                    "cost": msg_cost,
-                    "tokens": tokens,
-                },
-                f,
-                indent=2,
-            )
+            json.dump(costs, f, indent=2)
 
         return self
 
@@ -129,6 +137,7 @@ class Turbo4:
             self.assistant_id = assistant.id
 
         self.model = model
+        self.assistant_name = name
 
         return self
 
@@ -185,6 +194,7 @@ class Turbo4:
     ):
         print(f"add_message(message={message}, file_ids={file_ids})")
         self.local_messages.append(message)
+        self.local_token_count.append(message)
         self.client.beta.threads.messages.create(
             thread_id=self.current_thread_id,
             content=message,
@@ -231,6 +241,11 @@ class Turbo4:
         # refresh current thread
         self.load_threads()
 
+        # wait for the model's rate limits, a run sends the whole thread again
+        rate_limiter = llm.get_rate_limiter(self.model)
+        estimated_tokens = self.local_token_count.total
+        time.sleep(rate_limiter.reserve(estimated_tokens))
+
         # Start the thread running
         run = self.client.beta.threads.runs.create(
             thread_id=self.current_thread_id,
@@ -247,30 +262,25 @@ class Turbo4:
                 thread_id=self.current_thread_id, run_id=self.run_id
             )
             if run_status.status == "requires_action":
-                tool_outputs: List[ToolOutput] = []
-                for (
-                    tool_call
-                ) in run_status.required_action.submit_tool_outputs.tool_calls:
-                    tool_function = tool_call.function
-                    tool_name = tool_function.name
-
-                    # Check if tool_arguments is already a dictionary, if so, proceed directly
-                    if isinstance(tool_function.arguments, dict):
-                        tool_arguments = tool_function.arguments
-                    else:
-                        # Assume the arguments are JSON string and parse them
-                        tool_arguments = json.loads(tool_function.arguments)
-
-                    print(f"run_thread() Calling {tool_name}({tool_arguments})")
-
-                    # Assuming arguments are passed as a dictionary
-                    function_output = self.map_function_tools[tool_name].function(
-                        **tool_arguments
+                tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
+                for tool_call in tool_calls:
+                    print(
+                        f"run_thread() Calling {tool_call.function.name}({tool_call.function.arguments})"
                     )
 
-                    tool_outputs.append(
-                        ToolOutput(tool_call_id=tool_call.id, output=function_output)
-                    )
+                # independent calls run concurrently, outputs come back in call order
+                function_outputs = llm.run_tool_calls(
+                    [
+                        (tool_call.function.name, tool_call.function.arguments)
+                        for tool_call in tool_calls
+                    ],
+                    self.map_function_tools,
+                )
+
+                tool_outputs: List[ToolOutput] = [
+                    ToolOutput(tool_call_id=tool_call.id, output=function_output)
+                    for tool_call, function_output in zip(tool_calls, function_outputs)
+                ]
 
                 # Submit the tool outputs back to the API
                 self.client.beta.threads.runs.submit_tool_outputs(
@@ -279,6 +289,15 @@ class Turbo4:
                     tool_outputs=[to for to in tool_outputs],
                 )
             elif run_status.status == "completed":
+                run_dump = run_status.model_dump()
+                run_usage = llm.record_usage(
+                    self.model, run_dump, team=self.assistant_name
+                )
+                usage_ledger.add_to_totals(self.usage, run_usage, run_usage["cost"])
+                rate_limiter.adjust_tokens(
+                    (llm.safe_get(run_dump, "usage.total_tokens") or estimated_tokens)
+                    - estimated_tokens
+                )
                 self.load_threads()
                 return self
 
@@ -0,0 +1,118 @@
+"""
+Clone of postgres_da_ai_agent/modules/word_match.py
+
+Purpose:
+    Find the tables whose table or column names are mentioned in a prompt.
+    Names are matched on word boundaries in a single pass over the prompt's words.
+"""
+
+import re
+from typing import Dict, Iterable, List
+
+WORD_RE = re.compile(r"[a-z0-9]+")
+DDL_COLUMN_RE = re.compile(r"^\s*\"?([A-Za-z0-9_]+)\"?\s", re.MULTILINE)
+
+# trie node key holding the (table hits, column hits) of the name ending at that node
+TERMINAL = None
+
+
+def normalize_word(word: str) -> str:
+    """
+    Strip plural suffixes so 'job', 'jobs' and 'categories'/'category' match each other.
+    """
+    if len(word) <= 3:
+        return word
+    if word.endswith("ies"):
+        return word[:-3] + "y"
+    if word.endswith(("sses", "shes", "ches", "xes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def split_words(text: str) -> List[str]:
+    """
+    'Jobs by job_status' -> ['job', 'by', 'job', 'status']
+    """
+    return [normalize_word(word) for word in WORD_RE.findall(text.lower())]
+
+
+def column_names_from_table_def(table_def: str) -> List[str]:
+    """
+    Pull the column names out of a 'create' definition.
+    """
+    body = table_def.split("(", 1)[1] if "(" in table_def else ""
+    return DDL_COLUMN_RE.findall(body)
+
+
+class WordMatcher:
+    """
+    Word trie over every table name and every distinctive column name.
+
+    Matching walks the trie from each word of the prompt, so the cost is linear
+    in the prompt length no matter how many tables the schema has. Build it once
+    per schema and reuse it for every prompt.
+    """
+
+    def __init__(
+        self,
+        map_table_to_columns: Dict[str, Iterable[str]],
+        max_tables_per_column: int = 3,
+    ):
+        self.trie = {}
+
+        map_column_to_tables: Dict[tuple, List[str]] = {}
+        for table_name, column_names in map_table_to_columns.items():
+            self.add_name(table_name, table_name, is_table=True)
+            for column_name in column_names:
+                words = tuple(split_words(column_name))
+                owners = map_column_to_tables.setdefault(words, [])
+                if table_name not in owners:
+                    owners.append(table_name)
+
+        # columns like 'id' or 'name' live everywhere and say nothing about the table
+        for words, table_names in map_column_to_tables.items():
+            if len(table_names) <= max_tables_per_column:
+                for table_name in table_names:
+                    self.add_name(" ".join(words), table_name, is_table=False)
+
+    def add_name(self, name: str, table_name: str, is_table: bool):
+        words = split_words(name)
+        if not words:
+            return
+
+        node = self.trie
+        for word in words:
+            node = node.setdefault(word, {})
+
+        table_hits, column_hits = node.setdefault(TERMINAL, ([], []))
+        hits = table_hits if is_table else column_hits
+        if table_name not in hits:
+            hits.append(table_name)
+
+    def match(self, text: str) -> List[str]:
+        """
+        Return the tables named in the text, in order of appearance.
+        Direct table name matches come before tables matched through a column name.
+        """
+        words = split_words(text)
+        table_matches = []
+        column_matches = []
+
+        for start in range(len(words)):
+            node = self.trie
+            for word in words[start:]:
+                node = node.get(word)
+                if node is None:
+                    break
+                if TERMINAL in node:
+                    table_hits, column_hits = node[TERMINAL]
+                    table_matches += table_hits
+                    column_matches += column_hits
+
+        matches = []
+        for table_name in table_matches + column_matches:
+            if table_name not in matches:
+                matches.append(table_name)
+        return matches
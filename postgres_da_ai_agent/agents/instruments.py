@@ -1,9 +1,13 @@
 from postgres_da_ai_agent.modules.db import PostgresManager
 from postgres_da_ai_agent.modules import file
 import os
+import threading
 
 BASE_DIR = os.environ.get("BASE_DIR", "./agent_results")
 
+# run_sql statements get the tool call time budget (see llm.run_tool_calls), postgres cancels them after it
+RUN_SQL_TIMEOUT_SECONDS = float(os.environ.get("LLM_TOOL_CALL_TIMEOUT_SECONDS") or 120)
+
 
 class AgentInstruments:
     """
@@ -62,6 +66,8 @@ class PostgresAgentInstruments(AgentInstruments):
         self.session_id = session_id
         self.messages = []
         self.innovation_index = 0
+        # run_sql calls may run in parallel (llm.run_tool_calls), their result files are written one at a time
+        self.files_lock = threading.Lock()
 
     def __enter__(self):
         """
@@ -69,7 +75,7 @@ class PostgresAgentInstruments(AgentInstruments):
         """
         self.reset_files()
         self.db = PostgresManager()
-        self.db.connect_with_url(self.db_url)
+        self.db.connect_with_url(self.db_url, statement_timeout_seconds=RUN_SQL_TIMEOUT_SECONDS)
         return self, self.db
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -122,15 +128,22 @@ class PostgresAgentInstruments(AgentInstruments):
 
         fname = self.run_sql_results_file
 
-        # dump these results to a file
-        with open(fname, "w") as f:
-            f.write(results_as_json)
+        with self.files_lock:
+            # dump these results to a file
+            with open(fname, "w") as f:
+                f.write(results_as_json)
 
-        with open(self.sql_query_file, "w") as f:
-            f.write(sql)
+            with open(self.sql_query_file, "w") as f:
+                f.write(sql)
 
         return "Successfully delivered results to json file"
 
+    def cancel_run_sql(self, thread_id: int):
+        """
+        Cancel the run_sql query of a tool call that timed out
+        """
+        self.db.cancel(thread_id)
+
     def validate_run_sql(self):
         """
         validate that the run_sql results file exists and has content
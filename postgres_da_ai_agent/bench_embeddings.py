@@ -0,0 +1,237 @@
+"""
+Benchmark the embedding index against your postgres database.
+
+Reports, per encoder: load time, index build time, query latency and retrieval hit rate.
+Reports memory use and retrieval accuracy of every embedding storage dtype vs float32.
+With --latency-runs, also reports p50/p99 query embedding latency of every BERT inference backend.
+With --index-workers, also reports index build time per worker process count.
+
+Retrieval hit rate is measured on --eval-file, a json list of {"prompt": ..., "tables": [...]},
+or on one synthetic "show me the <table>" prompt per table when no file is given.
+
+    poetry run bench_embeddings --eval-file eval.json --encoder bert --encoder hashing
+    poetry run bench_embeddings --latency-runs 200 --backend pytorch --backend onnx --num-threads 4
+    poetry run bench_embeddings --encoder bert --index-workers 1 --index-workers 4 --index-workers 16
+"""
+
+import argparse
+import json
+import os
+import time
+
+import dotenv
+import numpy as np
+
+from postgres_da_ai_agent.modules import encoders, inference, parallel_embed
+from postgres_da_ai_agent.modules.db import PostgresManager
+from postgres_da_ai_agent.modules.embedding_store import (
+    SUPPORTED_DTYPES,
+    EmbeddingStore,
+    compare_retrieval,
+)
+
+dotenv.load_dotenv()
+
+DB_URL = os.environ.get("DATABASE_URL")
+EMBEDDING_MODEL_PATH = os.environ.get("EMBEDDING_MODEL_PATH")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--eval-file",
+        help='Json list of {"prompt": ..., "tables": [...]}. Defaults to one prompt per table name.',
+    )
+    parser.add_argument("--n", type=int, default=5, help="Top n tables to compare")
+    parser.add_argument(
+        "--encoder",
+        action="append",
+        choices=encoders.SUPPORTED_ENCODERS,
+        help="Encoder to benchmark. Defaults to all of them (sentence needs EMBEDDING_MODEL_PATH).",
+    )
+    parser.add_argument(
+        "--latency-runs",
+        type=int,
+        default=0,
+        help="Query embeddings to time per inference backend. 0 skips the latency benchmark.",
+    )
+    parser.add_argument(
+        "--backend",
+        action="append",
+        choices=inference.SUPPORTED_BACKENDS,
+        help="Inference backend to time. Defaults to all of them.",
+    )
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument(
+        "--index-workers",
+        action="append",
+        type=int,
+        help="Worker process count to time a full index build with. Repeat to compare.",
+    )
+    args = parser.parse_args()
+
+    with PostgresManager() as db:
+        db.connect_with_url(DB_URL)
+        map_table_name_to_table_def = db.get_table_definition_map_for_embeddings()
+
+    if args.eval_file:
+        with open(args.eval_file) as f:
+            eval_set = json.load(f)
+    else:
+        eval_set = [
+            {"prompt": f"show me the {name}", "tables": [name]}
+            for name in map_table_name_to_table_def
+        ]
+
+    encoder_names = args.encoder or [
+        name
+        for name in encoders.SUPPORTED_ENCODERS
+        if name != "sentence" or EMBEDDING_MODEL_PATH
+    ]
+
+    report = {"encoders": {}, "storage": {}}
+    for encoder_name in encoder_names:
+        encoder_report, table_embeddings, query_embeddings = benchmark_encoder(
+            encoder_name, map_table_name_to_table_def, eval_set, args.n
+        )
+        report["encoders"][encoder_name] = encoder_report
+        report["storage"][encoder_name] = benchmark_storage(
+            list(map_table_name_to_table_def.keys()),
+            table_embeddings,
+            query_embeddings,
+            args.n,
+        )
+        print(encoder_name, encoder_report)
+
+    if args.latency_runs > 0:
+        report["latency"] = benchmark_latency(
+            [example["prompt"] for example in eval_set],
+            args.backend or inference.SUPPORTED_BACKENDS,
+            args.latency_runs,
+            args.num_threads,
+        )
+
+    if args.index_workers:
+        report["index_build"] = {
+            encoder_name: benchmark_index_build(
+                encoder_name,
+                list(map_table_name_to_table_def.values()),
+                args.index_workers,
+            )
+            for encoder_name in encoder_names
+        }
+
+    print(json.dumps(report, indent=2))
+
+
+def benchmark_encoder(encoder_name, map_table_name_to_table_def, eval_set, n):
+    """
+    Load time, index build time, p50 query latency and hit rate (any expected table in the top n) for one encoder.
+    """
+    start = time.perf_counter()
+    encoder = encoders.make_encoder(encoder_name, model_path=EMBEDDING_MODEL_PATH)
+    load_seconds = time.perf_counter() - start
+
+    table_names = list(map_table_name_to_table_def.keys())
+    start = time.perf_counter()
+    table_embeddings = np.vstack(
+        [encoder.encode(map_table_name_to_table_def[name]) for name in table_names]
+    )
+    build_seconds = time.perf_counter() - start
+
+    store = EmbeddingStore()
+    store.add_many(table_names, table_embeddings)
+
+    timings = []
+    query_embeddings = []
+    hits = 0
+    for example in eval_set:
+        start = time.perf_counter()
+        query_embedding = encoder.encode(example["prompt"])
+        top_tables = store.top_n(query_embedding, n)
+        timings.append((time.perf_counter() - start) * 1000)
+
+        query_embeddings.append(query_embedding)
+        hits += bool(set(top_tables) & set(example["tables"]))
+
+    return (
+        {
+            "dim": store.dim,
+            "load_seconds": round(load_seconds, 3),
+            "build_seconds": round(build_seconds, 3),
+            "query_p50_ms": round(float(np.percentile(timings, 50)), 2),
+            "hit_rate_at_n": round(hits / max(len(eval_set), 1), 4),
+        },
+        table_embeddings,
+        query_embeddings,
+    )
+
+
+def benchmark_storage(table_names, table_embeddings, query_embeddings, n):
+    """
+    Memory and retrieval accuracy of every storage dtype against float32.
+    """
+    stores = {}
+    for dtype in SUPPORTED_DTYPES:
+        stores[dtype] = EmbeddingStore(dtype)
+        stores[dtype].add_many(table_names, table_embeddings)
+
+    return {
+        dtype: {
+            "memory": store.memory_report(),
+            "accuracy": compare_retrieval(
+                store, stores["float32"], query_embeddings, n=n
+            ),
+        }
+        for dtype, store in stores.items()
+    }
+
+
+def benchmark_index_build(encoder_name, table_defs, worker_counts):
+    """
+    Seconds to embed every table definition per worker count, and speedup vs the first count.
+    """
+    encoder_config = dict(name=encoder_name, model_path=EMBEDDING_MODEL_PATH)
+    results = {}
+    for workers in worker_counts:
+        start = time.perf_counter()
+        parallel_embed.embed_texts_in_parallel(table_defs, encoder_config, workers)
+        results[workers] = {"build_seconds": round(time.perf_counter() - start, 3)}
+
+    baseline = results[worker_counts[0]]["build_seconds"]
+    for result in results.values():
+        result["speedup"] = round(baseline / max(result["build_seconds"], 1e-9), 2)
+    print(encoder_name, results)
+    return results
+
+
+def benchmark_latency(prompts, backends, runs, num_threads=None):
+    """
+    p50/p99 single query embedding latency in ms per backend, with and without int8 quantization.
+    """
+    results = {}
+    for backend in backends:
+        for quantize in (False, True):
+            runner = inference.make_bert_runner(
+                backend=backend, quantize=quantize, num_threads=num_threads
+            )
+            for prompt in prompts[:3]:
+                runner(prompt)  # warm up
+
+            timings = []
+            for i in range(runs):
+                start = time.perf_counter()
+                runner(prompts[i % len(prompts)])
+                timings.append((time.perf_counter() - start) * 1000)
+
+            name = f"{backend}{'_int8' if quantize else ''}"
+            results[name] = {
+                "p50_ms": round(float(np.percentile(timings, 50)), 2),
+                "p99_ms": round(float(np.percentile(timings, 99)), 2),
+            }
+            print(name, results[name])
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Describe every table of your postgres database with the LLM, for retrieval.
+
+Descriptions are stored in TABLE_SUMMARIES_PATH keyed by a hash of the table definition,
+so re-running only describes new or changed tables. The embedders (and the api-server's
+BM25 index) pick them up from the same file.
+
+    poetry run enrich_tables
+    poetry run enrich_tables --snapshot schema_snapshot.json.gz --model gpt-4-1106-preview
+"""
+
+import argparse
+import json
+import os
+
+import dotenv
+
+from postgres_da_ai_agent.modules import snapshot, table_summaries
+from postgres_da_ai_agent.modules.db import PostgresManager
+
+dotenv.load_dotenv()
+
+DB_URL = os.environ.get("DATABASE_URL")
+TABLE_SUMMARIES_PATH = os.environ.get("TABLE_SUMMARIES_PATH") or "table_summaries.json"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--out",
+        default=TABLE_SUMMARIES_PATH,
+        help="Descriptions file to update. Defaults to TABLE_SUMMARIES_PATH.",
+    )
+    parser.add_argument(
+        "--snapshot",
+        help="Read table definitions from a schema snapshot instead of the database.",
+    )
+    parser.add_argument("--model", default="gpt-3.5-turbo-1106")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        map_table_name_to_table_def = snapshot.load_snapshot(
+            args.snapshot
+        ).get_table_definition_map_for_embeddings()
+    else:
+        with PostgresManager() as db:
+            db.connect_with_url(DB_URL)
+            map_table_name_to_table_def = db.get_table_definition_map_for_embeddings()
+
+    store = table_summaries.TableSummaryStore(args.out)
+    report = table_summaries.enrich_tables(
+        map_table_name_to_table_def,
+        store,
+        table_summaries.make_llm_summarizer(args.model),
+    )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Export a schema snapshot of your postgres database.
+
+The snapshot holds table definitions, the foreign key graph, table stats, comments
+and the configured embedder's embeddings in one gzipped json file.
+Point SCHEMA_SNAPSHOT_PATH (turbo_main and the api-server) at it to skip schema
+introspection on start-up.
+
+    poetry run export_snapshot --out schema_snapshot.json.gz
+    poetry run export_snapshot --out schema_snapshot.json.gz --no-embeddings
+"""
+
+import argparse
+import os
+
+import dotenv
+
+from postgres_da_ai_agent.modules import embeddings, snapshot
+from postgres_da_ai_agent.modules.db import PostgresManager
+
+dotenv.load_dotenv()
+
+DB_URL = os.environ.get("DATABASE_URL")
+SCHEMA_SNAPSHOT_PATH = os.environ.get("SCHEMA_SNAPSHOT_PATH")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--out",
+        default=SCHEMA_SNAPSHOT_PATH or "schema_snapshot.json.gz",
+        help="Snapshot file to write. Defaults to SCHEMA_SNAPSHOT_PATH.",
+    )
+    parser.add_argument(
+        "--no-embeddings",
+        action="store_true",
+        help="Skip embeddings (the api-server does not use them).",
+    )
+    args = parser.parse_args()
+
+    with PostgresManager() as db:
+        db.connect_with_url(DB_URL)
+
+        embedder = None
+        if not args.no_embeddings:
+            embedder = embeddings.make_database_embedder(db)
+            embedder.refresh_schema(embedder.load_schema(db), background=False)
+
+        snapshot.export_snapshot(db, args.out, embedder)
+
+
+if __name__ == "__main__":
+    main()
@@ -87,10 +87,9 @@ def main():
 
         map_table_name_to_table_def = db.get_table_definition_map_for_embeddings()
 
-        database_embedder = embeddings.DatabaseEmbedder()
+        database_embedder = embeddings.DatabaseEmbedder(db)
 
-        for name, table_def in map_table_name_to_table_def.items():
-            database_embedder.add_table(name, table_def)
+        database_embedder.add_tables(map_table_name_to_table_def)
 
         similar_tables = database_embedder.get_similar_tables(raw_prompt, n=5)
 
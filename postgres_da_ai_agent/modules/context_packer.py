@@ -0,0 +1,116 @@
+"""
+Purpose:
+    Pack retrieved tables into a prompt context of bounded size.
+    Rankings from every retriever are fused into one deduplicated ranking,
+    then tables are added best first until the token budget runs out.
+    Tables that no longer fit in full are downgraded to their key columns,
+    then to their name only. Packed tables are emitted in name order, so the
+    same table set always renders to the same bytes (prompt prefix caching).
+"""
+
+import re
+from typing import Callable, Dict, List, Tuple
+
+# best to most compact rendering of a table
+RENDER_LEVELS = ("full", "keys", "name")
+
+DDL_LINE_RE = re.compile(r"^\s*\"?([A-Za-z0-9_]+)\"?\s+\S")
+
+
+def fuse_rankings(rankings: List[Tuple[List[str], float]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    Reciprocal rank fusion of several ranked lists of table names.
+    rankings is a list of (ranked names, weight). A table scores weight / (k + rank)
+    in every list it appears in. Returns (name, score) pairs, best first, no repeats.
+    Ties keep the order of first appearance.
+    """
+    scores: Dict[str, float] = {}
+    for ranked_names, weight in rankings:
+        seen = set()
+        for rank, name in enumerate(ranked_names):
+            if name in seen:
+                continue
+            seen.add(name)
+            scores[name] = scores.get(name, 0.0) + weight / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+def render_name_only(table_name: str, n_columns: int = None) -> str:
+    if n_columns is None:
+        return "CREATE TABLE {} (\n-- columns not shown\n);".format(table_name)
+    return "CREATE TABLE {} (\n-- {} columns not shown\n);".format(
+        table_name, n_columns
+    )
+
+
+def render_key_columns_from_ddl(table_name: str, table_def: str) -> str:
+    """
+    Keep only the id / *_id columns of a 'create' definition.
+    Used when the real primary and foreign keys are not known.
+    """
+    lines = table_def.strip().splitlines()[1:-1]
+    kept = []
+    for line in lines:
+        match = DDL_LINE_RE.match(line)
+        if not match:
+            continue
+        column_name = match.group(1).lower()
+        if column_name == "id" or column_name.endswith("_id"):
+            kept.append(line.strip().rstrip(","))
+
+    create_table_stmt = "CREATE TABLE {} (\n".format(table_name)
+    create_table_stmt += ",\n".join(kept)
+    n_omitted = len(lines) - len(kept)
+    if n_omitted > 0:
+        if kept:
+            create_table_stmt += "\n"
+        create_table_stmt += "-- {} more columns not shown".format(n_omitted)
+    return create_table_stmt + "\n);"
+
+
+def pack_tables(
+    ranked_tables: List[str],
+    render: Callable[[str, str], str],
+    count_tokens: Callable[[str], float],
+    token_budget: int,
+    separator: str = "\n\n",
+) -> Tuple[str, dict]:
+    """
+    Greedily fill token_budget with table renderings, best ranked table first.
+
+    Args:
+    - ranked_tables (list): Table names, best first, no repeats.
+    - render (callable): render(table name, level) -> text, level being one of RENDER_LEVELS.
+    - count_tokens (callable): Token count of a string, e.g. llm.count_tokens.
+    - token_budget (int): Upper bound on the packed context tokens. None or 0 packs every table in full.
+
+    Returns:
+    - str: The packed table definitions, ordered by table name.
+    - dict: Report of the budget, tokens used, the level chosen per table and the dropped tables.
+    """
+    separator_tokens = count_tokens(separator)
+    used = 0
+    map_name_to_text = {}
+    packed = []
+    dropped = []
+
+    for table_name in ranked_tables:
+        levels = RENDER_LEVELS if token_budget else RENDER_LEVELS[:1]
+        for level in levels:
+            text = render(table_name, level)
+            tokens = count_tokens(text) + (separator_tokens if packed else 0)
+            if not token_budget or used + tokens <= token_budget:
+                map_name_to_text[table_name] = text
+                packed.append((table_name, level, tokens))
+                used += tokens
+                break
+        else:
+            dropped.append(table_name)
+
+    report = {
+        "token_budget": token_budget,
+        "tokens": used,
+        "tables": packed,
+        "dropped": dropped,
+    }
+    return separator.join(map_name_to_text[name] for name in sorted(map_name_to_text)), report
@@ -0,0 +1,289 @@
+"""
+Purpose:
+    Compact storage for embeddings.
+    One contiguous array holds every vector (float32, float16 or int8 with a
+    per-vector scale) and a name <-> row index maps keys to rows.
+    Similarity scoring runs directly on the stored (quantized) data.
+"""
+
+import base64
+import sys
+from typing import Dict, Hashable, List
+
+import numpy as np
+
+SUPPORTED_DTYPES = ("float32", "float16", "int8")
+
+
+class EmbeddingStore:
+    """
+    Vectors are L2 normalised on insert, so cosine similarity is a single
+    matrix-vector product. int8 rows keep a float32 scale factor each:
+    vector ~= row * scale.
+    """
+
+    def __init__(self, dtype: str = "float32", initial_capacity: int = 64):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(
+                f"Unsupported embedding dtype: {dtype}. Use one of {SUPPORTED_DTYPES}"
+            )
+        self.dtype = dtype
+        self.initial_capacity = initial_capacity
+        self.dim = None
+        self.size = 0
+        self.data = None
+        self.scales = None
+        self.map_key_to_row: Dict[Hashable, int] = {}
+        self.row_keys: List[Hashable] = []
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return key in self.map_key_to_row
+
+    @property
+    def keys(self) -> List[Hashable]:
+        return self.row_keys
+
+    # ------------------ writes ------------------
+
+    def add(self, key: Hashable, embedding):
+        """
+        Insert or replace the embedding stored under key.
+        """
+        self.add_many([key], np.asarray(embedding).reshape(1, -1))
+
+    def add_many(self, keys: List[Hashable], embeddings):
+        """
+        Insert or replace a batch of embeddings, one row per key.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(keys), -1)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            self._allocate(self.initial_capacity)
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(
+                f"Embedding dimension {embeddings.shape[1]} does not match store dimension {self.dim}"
+            )
+
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.maximum(norms, 1e-12)
+        rows, scales = self._quantize(embeddings)
+
+        for key, row, scale in zip(keys, rows, scales):
+            idx = self.map_key_to_row.get(key)
+            if idx is None:
+                if self.size == len(self.data):
+                    self._allocate(len(self.data) * 2)
+                idx = self.size
+                self.size += 1
+                self.map_key_to_row[key] = idx
+                self.row_keys.append(key)
+            self.data[idx] = row
+            self.scales[idx] = scale
+
+    def add_from(self, other: "EmbeddingStore", keys: List[Hashable]):
+        """
+        Copy the stored rows of keys from another store of the same dtype, without re-quantizing.
+        """
+        if other.dtype != self.dtype:
+            raise ValueError(f"Cannot copy {other.dtype} rows into a {self.dtype} store")
+        if not keys:
+            return
+        if self.dim is None:
+            self.dim = other.dim
+            self._allocate(max(self.initial_capacity, len(keys)))
+
+        for key in keys:
+            other_idx = other.map_key_to_row[key]
+            idx = self.map_key_to_row.get(key)
+            if idx is None:
+                if self.size == len(self.data):
+                    self._allocate(len(self.data) * 2)
+                idx = self.size
+                self.size += 1
+                self.map_key_to_row[key] = idx
+                self.row_keys.append(key)
+            self.data[idx] = other.data[other_idx]
+            self.scales[idx] = other.scales[other_idx]
+
+    def remove(self, key: Hashable):
+        """
+        Remove a key by moving the last row into its slot.
+        """
+        idx = self.map_key_to_row.pop(key)
+        last = self.size - 1
+        if idx != last:
+            last_key = self.row_keys[last]
+            self.data[idx] = self.data[last]
+            self.scales[idx] = self.scales[last]
+            self.row_keys[idx] = last_key
+            self.map_key_to_row[last_key] = idx
+        self.row_keys.pop()
+        self.size -= 1
+
+    def _allocate(self, capacity: int):
+        data = np.zeros((capacity, self.dim), dtype=self.dtype)
+        scales = np.ones(capacity, dtype=np.float32)
+        if self.data is not None:
+            data[: self.size] = self.data[: self.size]
+            scales[: self.size] = self.scales[: self.size]
+        self.data = data
+        self.scales = scales
+
+    def _quantize(self, embeddings: np.ndarray):
+        if self.dtype != "int8":
+            return embeddings.astype(self.dtype), np.ones(len(embeddings), np.float32)
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        rows = np.round(embeddings / scales[:, None]).astype(np.int8)
+        return rows, scales
+
+    # ------------------ reads ------------------
+
+    def get(self, key: Hashable) -> np.ndarray:
+        """
+        Dequantized (unit length) embedding for key.
+        """
+        idx = self.map_key_to_row[key]
+        return self.data[idx].astype(np.float32) * self.scales[idx]
+
+    def scores(self, query_embedding) -> np.ndarray:
+        """
+        Cosine similarity between the query and every stored row, in row order.
+        """
+        if self.size == 0:
+            return np.zeros(0, dtype=np.float32)
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        if self.dtype == "float16":
+            query = query.astype(np.float16)
+        raw = self.data[: self.size] @ query
+        if self.dtype == "int8":
+            return raw.astype(np.float32) * self.scales[: self.size]
+        return raw.astype(np.float32)
+
+    def top_n(self, query_embedding, n: int = 3) -> List[Hashable]:
+        """
+        Keys of the 'n' rows most similar to the query, best first.
+        """
+        scores = self.scores(query_embedding)
+        if len(scores) == 0:
+            return []
+        n = min(n, len(scores))
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top])]
+        return [self.row_keys[idx] for idx in top]
+
+    # ------------------ serialization ------------------
+
+    def to_dict(self) -> dict:
+        """
+        JSON serializable copy of the stored rows. Tuple keys are written as lists.
+        """
+        size = self.size
+        return {
+            "dtype": self.dtype,
+            "dim": self.dim,
+            "keys": [list(key) if isinstance(key, tuple) else key for key in self.row_keys],
+            "data": base64.b64encode(self.data[:size].tobytes()).decode() if size else "",
+            "scales": base64.b64encode(self.scales[:size].tobytes()).decode() if size else "",
+        }
+
+    @classmethod
+    def from_dict(cls, store_dict: dict) -> "EmbeddingStore":
+        """
+        Inverse of to_dict. Rows are restored as stored, without re-quantizing.
+        """
+        keys = [tuple(key) if isinstance(key, list) else key for key in store_dict["keys"]]
+        store = cls(store_dict["dtype"], initial_capacity=max(len(keys), 1))
+        if not keys:
+            return store
+
+        store.dim = store_dict["dim"]
+        store.data = np.frombuffer(
+            base64.b64decode(store_dict["data"]), dtype=store.dtype
+        ).reshape(len(keys), store.dim).copy()
+        store.scales = np.frombuffer(
+            base64.b64decode(store_dict["scales"]), dtype=np.float32
+        ).copy()
+        store.size = len(keys)
+        store.row_keys = keys
+        store.map_key_to_row = {key: idx for idx, key in enumerate(keys)}
+        return store
+
+    # ------------------ reporting ------------------
+
+    def memory_report(self) -> dict:
+        """
+        Bytes used by this store vs the equivalent dict of float32 (1, dim) ndarrays.
+        """
+        if self.data is None:
+            return {"dtype": self.dtype, "rows": 0, "bytes": 0, "dict_float32_bytes": 0}
+
+        array_bytes = self.data[: self.size].nbytes
+        scale_bytes = self.scales[: self.size].nbytes if self.dtype == "int8" else 0
+        index_bytes = sys.getsizeof(self.map_key_to_row) + sys.getsizeof(
+            self.row_keys
+        )
+        total = array_bytes + scale_bytes + index_bytes
+
+        one_float32_array = np.zeros((1, self.dim), dtype=np.float32)
+        dict_float32_bytes = self.size * sys.getsizeof(
+            one_float32_array
+        ) + sys.getsizeof(dict.fromkeys(self.row_keys))
+
+        return {
+            "dtype": self.dtype,
+            "rows": self.size,
+            "dim": self.dim,
+            "array_bytes": array_bytes,
+            "scale_bytes": scale_bytes,
+            "index_bytes": index_bytes,
+            "bytes": total,
+            "dict_float32_bytes": dict_float32_bytes,
+            "compression_ratio": round(dict_float32_bytes / total, 2),
+        }
+
+
+def compare_retrieval(
+    store: EmbeddingStore,
+    reference_store: EmbeddingStore,
+    query_embeddings,
+    n: int = 5,
+) -> dict:
+    """
+    Retrieval accuracy of store against a float32 reference_store holding the same keys.
+
+    recall_at_n: share of the reference top 'n' keys the store also returns
+    top_1_agreement: share of queries where both stores rank the same key first
+    max_score_error: largest absolute cosine difference over all rows and queries
+    """
+    recalls = []
+    top_1_agreements = []
+    max_score_error = 0.0
+
+    reference_rows = [reference_store.map_key_to_row[key] for key in store.keys]
+
+    for query_embedding in query_embeddings:
+        expected = reference_store.top_n(query_embedding, n)
+        actual = store.top_n(query_embedding, n)
+        recalls.append(len(set(expected) & set(actual)) / max(len(expected), 1))
+        top_1_agreements.append(bool(expected) and expected[0] == actual[0])
+
+        score_error = np.abs(
+            store.scores(query_embedding)
+            - reference_store.scores(query_embedding)[reference_rows]
+        )
+        if len(score_error):
+            max_score_error = max(max_score_error, float(score_error.max()))
+
+    n_queries = max(len(recalls), 1)
+    return {
+        "dtype": store.dtype,
+        "queries": len(recalls),
+        "recall_at_n": sum(recalls) / n_queries,
+        "top_1_agreement": sum(top_1_agreements) / n_queries,
+        "max_score_error": max_score_error,
+    }
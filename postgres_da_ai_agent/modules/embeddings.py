@@ -1,112 +1,968 @@
-from sklearn.metrics.pairwise import cosine_similarity
-from transformers import BertTokenizer, BertModel
+import os
+import threading
+import time
 
+import numpy as np
+
+from postgres_da_ai_agent.modules import context_packer, encoders, parallel_embed
+from postgres_da_ai_agent.modules.cache import (
+    MISSING,
+    LRUCache,
+    normalize_prompt,
+    stable_hash,
+)
 from postgres_da_ai_agent.modules.db import PostgresManager
+from postgres_da_ai_agent.modules.embedding_store import EmbeddingStore
+from postgres_da_ai_agent.modules.encoders import BertEncoder, Encoder
+from postgres_da_ai_agent.modules.feedback import FeedbackStore
+from postgres_da_ai_agent.modules.table_summaries import TableSummaryStore
+from postgres_da_ai_agent.modules.word_match import (
+    WordMatcher,
+    column_names_from_table_def,
+)
+
+
+class RetrievalIndex:
+    """
+    Immutable, versioned snapshot of everything retrieval reads for one schema.
+
+    An index is never modified after it is built. Schema changes build a new
+    index and swap it in, so a reader that grabbed an index keeps a consistent
+    view for the whole request without taking a lock.
+    """
+
+    def __init__(
+        self,
+        version: int,
+        schema,
+        map_name_to_table_def: dict,
+        embedding_store: EmbeddingStore,
+        word_matcher: WordMatcher,
+        map_name_to_document: dict = None,
+    ):
+        self.version = version
+        self.schema = schema
+        self.fingerprint = stable_hash(schema)
+        self.map_name_to_table_def = map_name_to_table_def
+        self.embedding_store = embedding_store
+        self.word_matcher = word_matcher
+        # table name -> text embedded for the table, see DatabaseEmbedder.embedding_documents
+        self.map_name_to_document = map_name_to_document or {}
+
+
+class ColumnRetrievalIndex(RetrievalIndex):
+    def __init__(
+        self,
+        *args,
+        map_name_to_columns: dict,
+        map_name_to_key_columns: dict,
+        column_store: EmbeddingStore,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.map_name_to_columns = map_name_to_columns
+        self.map_name_to_key_columns = map_name_to_key_columns
+        self.column_store = column_store
 
 
 class DatabaseEmbedder:
     """
     This class is responsible for embedding database table definitions and
     computing similarity between user queries and table definitions.
+
+    Safe to share across threads: readers use the current RetrievalIndex
+    without locking, and schema changes rebuild a new index (in the background
+    once a first index exists) that is swapped in atomically.
     """
 
-    def __init__(self, db: PostgresManager):
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-        self.model = BertModel.from_pretrained("bert-base-uncased")
-        self.map_name_to_embeddings = {}
-        self.map_name_to_table_def = {}
+    def __init__(
+        self,
+        db: PostgresManager,
+        encoder: Encoder = None,
+        embedding_dtype="float32",
+        cache_size=1024,
+        cache_ttl_seconds=3600,
+        encoder_config: dict = None,
+        index_workers=1,
+        parallel_min_texts=512,
+        context_token_budget=None,
+        count_tokens=None,
+        table_summaries: TableSummaryStore = None,
+        feedback: FeedbackStore = None,
+        feedback_weight=0.5,
+        feedback_extra_tables=1,
+        schema_refresh_seconds=300,
+    ):
+        # bert, sentence or hashing - see modules/encoders.py
+        self.encoder = encoder or BertEncoder()
+        # make_encoder kwargs, lets index workers build their own copy of the encoder
+        self.encoder_config = encoder_config
+        # > 1 embeds large (re)builds in a process pool - see modules/parallel_embed.py
+        self.index_workers = index_workers
+        self.parallel_min_texts = parallel_min_texts
+        # upper bound on table definition tokens per prompt, None packs every table in full
+        self.context_token_budget = context_token_budget
+        # defaults to llm.count_tokens
+        self.count_tokens = count_tokens
+        # llm written table descriptions, indexed with the definitions - see modules/table_summaries.py
+        self.table_summaries = table_summaries
+        # prior learned from executed sql - see modules/feedback.py
+        self.feedback = feedback
+        self.feedback_weight = feedback_weight
+        # retrieved tables kept on top of a confident feedback table set
+        self.feedback_extra_tables = feedback_extra_tables
+        # float32, float16 or int8 - see modules/embedding_store.py
+        self.embedding_dtype = embedding_dtype
+        # normalized prompt -> query embedding
+        self.query_embedding_cache = LRUCache(cache_size, cache_ttl_seconds)
+        # (normalized prompt, schema fingerprint, n) -> ranked table names
+        self.retrieval_cache = LRUCache(cache_size, cache_ttl_seconds)
         self.db = db
+        # requests re-read the schema at most this often, see refresh_schema_from
+        self.schema_refresh_seconds = schema_refresh_seconds
+        self.schema_checked_at = None
 
-    def get_similar_table_defs_for_prompt(self, prompt: str, n_similar=5, n_foreign=0):
-        map_table_name_to_table_def = self.db.get_table_definition_map_for_embeddings()
-        for name, table_def in map_table_name_to_table_def.items():
-            self.add_table(name, table_def)
+        # guards building_fingerprint, readers never take a lock
+        self.rebuild_lock = threading.Lock()
+        # one index build at a time
+        self.build_lock = threading.Lock()
+        self.building_fingerprint = None
+        self.index = self.build_index(self.empty_schema(), None)
 
-        similar_tables = self.get_similar_tables(prompt, n=n_similar)
+    # ------------------ index lifecycle ------------------
 
-        table_definitions = self.get_table_definitions_from_names(similar_tables)
+    @property
+    def map_name_to_table_def(self) -> dict:
+        return self.index.map_name_to_table_def
 
-        if n_foreign > 0:
-            foreign_table_names = self.db.get_foreign_tables(similar_tables, n=3)
+    @property
+    def embedding_store(self) -> EmbeddingStore:
+        return self.index.embedding_store
+
+    @property
+    def word_matcher(self) -> WordMatcher:
+        return self.index.word_matcher
+
+    def empty_schema(self):
+        return {}
+
+    def load_schema(self, db: PostgresManager):
+        """
+        Everything the index is built from: table name -> table definition.
+        """
+        return db.get_table_definition_map_for_embeddings()
+
+    def refresh_schema_from(self, db):
+        """
+        Re-read the schema from db (a PostgresManager or a SchemaSnapshot) when it was
+        last read more than schema_refresh_seconds ago, and refresh the index if it changed.
+        One request per interval pays for the introspection, the others don't touch db.
+        """
+        now = time.monotonic()
+        with self.rebuild_lock:
+            if (
+                self.schema_checked_at is not None
+                and now - self.schema_checked_at < self.schema_refresh_seconds
+            ):
+                return
+            self.schema_checked_at = now
+        self.refresh_schema(self.load_schema(db))
+
+    def refresh_schema(self, schema, background=None):
+        """
+        Make sure the index reflects schema.
+
+        Unchanged schemas return immediately. The first build runs in the
+        caller's thread; later rebuilds run in the background while readers
+        keep using the current index until the new one is swapped in.
+        """
+        if background is None:
+            background = self.index.version > 0
+        if not background:
+            self.rebuild_index(schema)
+            return
+
+        fingerprint = stable_hash(schema)
+        with self.rebuild_lock:
+            if fingerprint in (self.index.fingerprint, self.building_fingerprint):
+                return
+            self.building_fingerprint = fingerprint
 
-            table_definitions = self.get_table_definitions_from_names(
-                foreign_table_names + similar_tables
+        threading.Thread(
+            target=self.build_and_swap, args=(schema, fingerprint), daemon=True
+        ).start()
+
+    def rebuild_index(self, schema) -> RetrievalIndex:
+        """
+        Build and swap in the index for schema in the caller's thread.
+        """
+        fingerprint = stable_hash(schema)
+        with self.rebuild_lock:
+            if fingerprint == self.index.fingerprint:
+                return self.index
+            self.building_fingerprint = fingerprint
+        return self.build_and_swap(schema, fingerprint)
+
+    def build_and_swap(self, schema, fingerprint: str) -> RetrievalIndex:
+        try:
+            # previous index is read only, the swap is a single assignment
+            with self.build_lock:
+                if fingerprint == self.index.fingerprint:
+                    return self.index
+                index = self.build_index(schema, self.index)
+                self.index = index
+            print(f"Swapped in retrieval index v{index.version}")
+            return index
+        finally:
+            with self.rebuild_lock:
+                if self.building_fingerprint == fingerprint:
+                    self.building_fingerprint = None
+
+    def build_index(self, schema, previous: RetrievalIndex) -> RetrievalIndex:
+        """
+        Build a new index for schema, reusing the embeddings of tables that did not change.
+        """
+        map_name_to_table_def = dict(schema)
+        map_name_to_document = self.embedding_documents(schema)
+        store = EmbeddingStore(self.embedding_dtype)
+
+        if previous is not None:
+            unchanged = [
+                table_name
+                for table_name, document in map_name_to_document.items()
+                if previous.map_name_to_document.get(table_name) == document
+                and table_name in previous.embedding_store
+            ]
+            store.add_from(previous.embedding_store, unchanged)
+
+        changed = [
+            table_name for table_name in map_name_to_document if table_name not in store
+        ]
+        if changed:
+            store.add_many(
+                changed,
+                self.embed_texts(
+                    [map_name_to_document[table_name] for table_name in changed]
+                ),
             )
 
-        return table_definitions
+        word_matcher = WordMatcher(
+            {
+                table_name: column_names_from_table_def(table_def)
+                for table_name, table_def in map_name_to_table_def.items()
+            }
+        )
+
+        return RetrievalIndex(
+            previous.version + 1 if previous else 0,
+            schema,
+            map_name_to_table_def,
+            store,
+            word_matcher,
+            map_name_to_document=map_name_to_document,
+        )
+
+    def embedding_documents(self, schema) -> dict:
+        """
+        table name -> text embedded for the table: its definition, followed by its
+        description when table_summaries has one for this exact definition.
+        Descriptions are read when an index is built, new ones apply to the next rebuild.
+        """
+        map_name_to_document = {}
+        for table_name, table_def in schema.items():
+            summary = self.table_summaries.get(table_def) if self.table_summaries else None
+            map_name_to_document[table_name] = (
+                f"{table_def}\n-- {summary}" if summary else table_def
+            )
+        return map_name_to_document
+
+    def export_embeddings(self) -> dict:
+        """
+        The current index's stored embeddings, tagged with the encoder and schema fingerprint
+        they were computed for. Written into schema snapshots.
+        """
+        index = self.index
+        return {
+            "encoder": self.encoder.name,
+            "fingerprint": index.fingerprint,
+            "documents": stable_hash(index.map_name_to_document),
+            "store": self.stored_embeddings(index).to_dict(),
+        }
+
+    def stored_embeddings(self, index: RetrievalIndex) -> EmbeddingStore:
+        return index.embedding_store
+
+    def seed_index(self, schema, store: EmbeddingStore, map_name_to_document: dict) -> RetrievalIndex:
+        """
+        A stand in previous index holding store, so build_index reuses its rows.
+        """
+        return RetrievalIndex(
+            self.index.version,
+            schema,
+            dict(schema),
+            store,
+            None,
+            map_name_to_document=map_name_to_document,
+        )
+
+    def load_snapshot(self, snapshot) -> RetrievalIndex:
+        """
+        Build the index from a SchemaSnapshot (see modules/snapshot.py).
+        Stored embeddings are reused when they were computed by the same encoder,
+        at the same dtype, for the same schema; anything else is embedded again.
+        """
+        schema = self.load_schema(snapshot)
+        self.schema_checked_at = time.monotonic()
+        map_name_to_document = self.embedding_documents(schema)
+        embeddings = snapshot.embeddings or {}
+        if (
+            embeddings.get("encoder") != self.encoder.name
+            or embeddings.get("fingerprint") != stable_hash(schema)
+            or embeddings.get("documents") != stable_hash(map_name_to_document)
+            or embeddings["store"]["dtype"] != self.embedding_dtype
+        ):
+            print("Snapshot embeddings do not match this embedder, embedding the schema")
+            return self.rebuild_index(schema)
+
+        with self.build_lock:
+            seeded = self.seed_index(
+                schema, EmbeddingStore.from_dict(embeddings["store"]), map_name_to_document
+            )
+            self.index = self.build_index(schema, seeded)
+        print(f"Loaded retrieval index v{self.index.version} from snapshot")
+        return self.index
 
     def add_table(self, table_name: str, text_representation: str):
         """
         Add a table to the database embedder.
         Map the table name to its embedding and text representation.
         """
-        self.map_name_to_embeddings[table_name] = self.compute_embeddings(
-            text_representation
+        self.add_tables({table_name: text_representation})
+
+    def add_tables(self, map_table_name_to_table_def: dict):
+        """
+        Add (or replace) many tables with a single synchronous index rebuild.
+        """
+        self.rebuild_index({**self.index.schema, **map_table_name_to_table_def})
+
+    # ------------------ retrieval ------------------
+
+    def get_similar_table_defs_for_prompt(
+        self,
+        prompt: str,
+        n_similar=5,
+        n_foreign=0,
+        db: PostgresManager = None,
+        token_budget=None,
+    ):
+        # pass the caller's own db (or snapshot), self.db's cursor is not safe to share across threads
+        db = db or self.db
+        self.refresh_schema_from(db)
+        index = self.index
+
+        similar_tables = self.get_similar_tables(prompt, n=n_similar, index=index)
+
+        if n_foreign > 0:
+            foreign_table_names = db.get_related_tables(similar_tables, n=3)
+            similar_tables = [
+                table_name
+                for table_name, _ in context_packer.fuse_rankings(
+                    [(similar_tables, 1.0), (foreign_table_names, 0.5)]
+                )
+            ]
+
+        table_definitions, _ = self.pack_table_definitions(
+            similar_tables, token_budget, index=index
         )
+        return table_definitions
 
-        self.map_name_to_table_def[table_name] = text_representation
+    def cache_stats(self) -> dict:
+        return {
+            "index_version": self.index.version,
+            "query_embeddings": self.query_embedding_cache.stats(),
+            "retrieval": self.retrieval_cache.stats(),
+        }
+
+    def compute_query_embedding(self, query: str):
+        """
+        Embedding of a user query. Repeat (normalized) prompts skip the model entirely.
+        """
+        key = normalize_prompt(query)
+        embedding = self.query_embedding_cache.get(key)
+        if embedding is MISSING:
+            embedding = self.compute_embeddings(key)
+            self.query_embedding_cache.set(key, embedding)
+        return embedding
 
     def compute_embeddings(self, text):
         """
-        Compute embeddings for a given text using the BERT model.
+        Compute embeddings for a given text (or list of texts) using the encoder.
         """
-        inputs = self.tokenizer(
-            text, return_tensors="pt", truncation=True, padding=True, max_length=512
-        )
-        outputs = self.model(**inputs)
-        return outputs["pooler_output"].detach().numpy()
+        return self.encoder.encode(text)
+
+    def embed_texts(self, texts: list, batch_size=1):
+        """
+        One embedding row per text, batch_size texts per encoder call.
+        Large builds are sharded across index_workers processes when encoder_config is set.
+        """
+        if (
+            self.index_workers > 1
+            and self.encoder_config
+            and len(texts) >= self.parallel_min_texts
+        ):
+            return parallel_embed.embed_texts_in_parallel(
+                texts,
+                self.encoder_config,
+                workers=self.index_workers,
+                batch_size=batch_size,
+            )
 
-    def get_similar_tables_via_embeddings(self, query, n=3):
+        batches = [
+            self.compute_embeddings(texts[i : i + batch_size])
+            for i in range(0, len(texts), batch_size)
+        ]
+        return np.vstack(batches)
+
+    def get_similar_tables_via_embeddings(self, query, n=3, index=None):
         """
         Given a query, find the top 'n' tables that are most similar to it.
 
         Args:
         - query (str): The user's natural language query.
         - n (int, optional): Number of top tables to return. Defaults to 3.
+        - index (RetrievalIndex, optional): Snapshot to read. Defaults to the current index.
 
         Returns:
         - list: Top 'n' table names ranked by their similarity to the query.
         """
+        index = index or self.index
         # Compute the embedding for the user's query
-        query_embedding = self.compute_embeddings(query)
-        # Calculate cosine similarity between the query and all tables
-        similarities = {
-            table: cosine_similarity(query_embedding, emb)[0][0]
-            for table, emb in self.map_name_to_embeddings.items()
+        query_embedding = self.compute_query_embedding(query)
+        # Score against every stored table and return the top 'n'
+        return index.embedding_store.top_n(query_embedding, n)
+
+    def get_similar_table_names_via_word_match(self, query: str, index=None):
+        """
+        if any word in our query is a table name (or a distinctive column name), add the table to a list
+        """
+        index = index or self.index
+        return index.word_matcher.match(query)
+
+    def get_similar_tables(self, query: str, n=3, index=None):
+        """
+        combines results from get_similar_tables_via_embeddings and get_similar_table_names_via_word_match
+        """
+        index = index or self.index
+        feedback_version = self.feedback.version if self.feedback else 0
+        key = ("tables", normalize_prompt(query), index.fingerprint, feedback_version, n)
+        similar_tables = self.retrieval_cache.get(key)
+        if similar_tables is MISSING:
+            similar_tables = self.rank_similar_tables(query, n, index)
+            self.retrieval_cache.set(key, similar_tables)
+        return list(similar_tables)
+
+    def rank_similar_tables(self, query: str, n, index: RetrievalIndex):
+        similar_tables_via_embeddings = self.get_similar_tables_via_embeddings(
+            query, n, index
+        )
+        similar_tables_via_word_match = self.get_similar_table_names_via_word_match(
+            query, index
+        )
+
+        # tables found by both retrievers rank first, each table once
+        return self.blend_feedback(
+            query,
+            [(similar_tables_via_embeddings, 1.0), (similar_tables_via_word_match, 1.0)],
+            index,
+        )
+
+    def blend_feedback(self, query: str, rankings: list, index: RetrievalIndex) -> list:
+        """
+        Fuse the retrievers' rankings with the feedback prior into one ranking.
+        When past queries for this prompt shape agree on a table set, return that set
+        plus feedback_extra_tables retrieved tables instead of everything retrieved.
+        """
+        if self.feedback is None:
+            return [table_name for table_name, _ in context_packer.fuse_rankings(rankings)]
+
+        def known(table_names):
+            return [name for name in table_names if name in index.map_name_to_table_def]
+
+        rankings = rankings + [(known(self.feedback.rank(query)), self.feedback_weight)]
+        ranked = [table_name for table_name, _ in context_packer.fuse_rankings(rankings)]
+
+        confident = known(self.feedback.confident_tables(query))
+        if not confident:
+            return ranked
+        extra = [name for name in ranked if name not in confident]
+        return confident + extra[: self.feedback_extra_tables]
+
+    def record_feedback(self, prompt: str, sql: str) -> list:
+        """
+        Learn from a query that ran successfully for prompt. Returns the tables it used.
+        """
+        if self.feedback is None:
+            return []
+        return self.feedback.record(prompt, sql, self.index.map_name_to_table_def.keys())
+
+    def pack_table_definitions(
+        self, table_names: list, token_budget=None, index=None, map_table_to_columns=None
+    ):
+        """
+        Render ranked tables into at most token_budget tokens (defaults to context_token_budget).
+        Lower ranked tables are downgraded to key columns or name only, then dropped.
+
+        Returns:
+        - str: The table definitions.
+        - dict: The packing report, see context_packer.pack_tables.
+        """
+        index = index or self.index
+        if token_budget is None:
+            token_budget = self.context_token_budget
+
+        count_tokens = self.count_tokens
+        if count_tokens is None:
+            # imported here: modules/llm.py requires OPENAI_API_KEY at import time
+            from postgres_da_ai_agent.modules.llm import count_tokens
+
+        table_definitions, report = context_packer.pack_tables(
+            table_names,
+            lambda table_name, level: self.render_table(
+                table_name, level, index, map_table_to_columns
+            ),
+            count_tokens,
+            token_budget,
+        )
+        print(
+            f"Packed {len(report['tables'])} tables into {report['tokens']} tokens (budget {token_budget}), dropped {len(report['dropped'])}"
+        )
+        return table_definitions, report
+
+    def render_table(
+        self, table_name: str, level: str, index: RetrievalIndex, map_table_to_columns=None
+    ) -> str:
+        """
+        Render a table at one of context_packer.RENDER_LEVELS.
+        """
+        table_def = index.map_name_to_table_def[table_name]
+        if level == "full":
+            return table_def
+        if level == "keys":
+            return context_packer.render_key_columns_from_ddl(table_name, table_def)
+        return context_packer.render_name_only(
+            table_name, len(column_names_from_table_def(table_def))
+        )
+
+    def get_table_definitions_from_names(self, table_names: list, index=None) -> str:
+        """
+        Given a list of table names, return their table definitions.
+        """
+        index = index or self.index
+        table_defs = [
+            index.map_name_to_table_def[table_name] for table_name in table_names
+        ]
+        return "\n\n".join(table_defs)
+
+
+# column index of the chunk holding a table's description
+SUMMARY_CHUNK = -1
+
+
+class ColumnDatabaseEmbedder(DatabaseEmbedder):
+    """
+    Column granular variant of the DatabaseEmbedder.
+
+    Whole table definitions are truncated at 512 BERT tokens, so wide tables
+    lose their trailing columns. Here every column is embedded as its own
+    'table column type' chunk, chunk scores are aggregated per table (max) and
+    only the matching columns plus key columns are rendered into the prompt.
+    A table's description, when there is one, is embedded as one more chunk.
+    """
+
+    def __init__(
+        self,
+        db: PostgresManager,
+        n_columns=10,
+        batch_size=64,
+        **kwargs,
+    ):
+        self.n_columns = n_columns
+        self.batch_size = batch_size
+        super().__init__(db, **kwargs)
+
+    def empty_schema(self):
+        return {"columns": {}, "key_columns": {}}
+
+    def load_schema(self, db: PostgresManager):
+        """
+        table name -> ordered [column name, column type] pairs, and table name -> sorted key column names.
+        """
+        return {
+            "columns": {
+                table_name: [list(column) for column in columns]
+                for table_name, columns in db.get_table_column_map_for_embeddings().items()
+            },
+            "key_columns": {
+                table_name: sorted(key_columns)
+                for table_name, key_columns in db.get_table_key_columns_map().items()
+            },
+        }
+
+    def build_index(self, schema, previous: ColumnRetrievalIndex) -> ColumnRetrievalIndex:
+        map_name_to_columns = schema["columns"]
+        map_name_to_key_columns = {
+            table_name: set(schema["key_columns"].get(table_name, []))
+            for table_name in map_name_to_columns
+        }
+        column_store = EmbeddingStore(self.embedding_dtype)
+
+        changed_keys = []
+        chunks = []
+        for table_name, columns in map_name_to_columns.items():
+            keys = [(table_name, idx) for idx in range(len(columns))]
+            if previous is not None and previous.map_name_to_columns.get(table_name) == columns:
+                column_store.add_from(previous.column_store, keys)
+                continue
+
+            changed_keys += keys
+            chunks += [
+                f"{table_name} {column_name} {column_type}"
+                for column_name, column_type in columns
+            ]
+
+        map_name_to_document = self.embedding_documents(schema)
+        for table_name, document in map_name_to_document.items():
+            key = (table_name, SUMMARY_CHUNK)
+            if (
+                previous is not None
+                and previous.map_name_to_document.get(table_name) == document
+                and key in previous.column_store
+            ):
+                column_store.add_from(previous.column_store, [key])
+                continue
+            changed_keys.append(key)
+            chunks.append(document)
+
+        if chunks:
+            column_store.add_many(
+                changed_keys, self.embed_texts(chunks, self.batch_size)
+            )
+
+        map_name_to_table_def = {
+            table_name: render_table_definition(
+                table_name, columns, map_name_to_key_columns[table_name]
+            )
+            for table_name, columns in map_name_to_columns.items()
         }
-        # Rank tables based on their similarity scores and return top 'n'
-        return sorted(similarities, key=similarities.get, reverse=True)[:n]
+        word_matcher = WordMatcher(
+            {
+                table_name: [column_name for column_name, _ in columns]
+                for table_name, columns in map_name_to_columns.items()
+            }
+        )
+
+        return ColumnRetrievalIndex(
+            previous.version + 1 if previous else 0,
+            schema,
+            map_name_to_table_def,
+            # whole table embeddings are not used, ranking runs on column_store
+            EmbeddingStore(self.embedding_dtype),
+            word_matcher,
+            map_name_to_columns=map_name_to_columns,
+            map_name_to_key_columns=map_name_to_key_columns,
+            column_store=column_store,
+            map_name_to_document=map_name_to_document,
+        )
 
-    def get_similar_table_names_via_word_match(self, query: str):
+    def embedding_documents(self, schema) -> dict:
         """
-        if any word in our query is a table name, add the table to a list
+        table name -> 'table description' chunk, for the tables table_summaries describes.
         """
+        if not self.table_summaries:
+            return {}
 
-        tables = []
+        map_name_to_document = {}
+        for table_name, columns in schema["columns"].items():
+            # descriptions are keyed by the PostgresManager.get_table_definition text: the same
+            # columns (no dropped ones) in the same attnum order, rendered the same way
+            table_def = render_table_definition(table_name, columns, set())
+            summary = self.table_summaries.get(table_def)
+            if summary:
+                map_name_to_document[table_name] = f"{table_name} {summary}"
+        return map_name_to_document
 
-        for table_name in self.map_name_to_table_def.keys():
-            if table_name.lower() in query.lower():
-                tables.append(table_name)
+    def stored_embeddings(self, index: ColumnRetrievalIndex) -> EmbeddingStore:
+        return index.column_store
 
-        return tables
+    def seed_index(
+        self, schema, store: EmbeddingStore, map_name_to_document: dict
+    ) -> ColumnRetrievalIndex:
+        return ColumnRetrievalIndex(
+            self.index.version,
+            schema,
+            {},
+            EmbeddingStore(self.embedding_dtype),
+            None,
+            map_name_to_columns=schema["columns"],
+            map_name_to_key_columns={},
+            column_store=store,
+            map_name_to_document=map_name_to_document,
+        )
 
-    def get_similar_tables(self, query: str, n=3):
+    def add_table_columns(self, table_name: str, columns: list, key_columns=None):
         """
-        combines results from get_similar_tables_via_embeddings and get_similar_table_names_via_word_match
+        Add a table to the embedder one column chunk at a time.
+        columns is an ordered list of (column name, column type) pairs.
         """
+        schema = self.index.schema
+        self.rebuild_index(
+            {
+                "columns": {
+                    **schema["columns"],
+                    table_name: [list(column) for column in columns],
+                },
+                "key_columns": {
+                    **schema["key_columns"],
+                    table_name: sorted(key_columns or []),
+                },
+            }
+        )
 
-        similar_tables_via_embeddings = self.get_similar_tables_via_embeddings(query, n)
-        similar_tables_via_word_match = self.get_similar_table_names_via_word_match(
-            query
+    def add_tables(self, map_table_name_to_table_def: dict):
+        """
+        Add (or replace) many tables given as 'create' definitions, with a single synchronous
+        index rebuild. Definitions don't carry keys, tables keep the key columns they had.
+        """
+        schema = self.index.schema
+        self.rebuild_index(
+            {
+                "columns": {
+                    **schema["columns"],
+                    **{
+                        table_name: [list(column) for column in columns_from_table_def(table_def)]
+                        for table_name, table_def in map_table_name_to_table_def.items()
+                    },
+                },
+                "key_columns": dict(schema["key_columns"]),
+            }
+        )
+
+    def get_similar_table_defs_for_prompt(
+        self,
+        prompt: str,
+        n_similar=5,
+        n_foreign=0,
+        db: PostgresManager = None,
+        token_budget=None,
+    ):
+        # pass the caller's own db (or snapshot), self.db's cursor is not safe to share across threads
+        db = db or self.db
+        self.refresh_schema_from(db)
+        index = self.index
+
+        map_table_to_columns = self.get_similar_columns_via_embeddings(
+            prompt, n=n_similar, index=index
+        )
+        rankings = [
+            (list(map_table_to_columns.keys()), 1.0),
+            (self.get_similar_table_names_via_word_match(prompt, index), 1.0),
+        ]
+
+        if n_foreign > 0:
+            similar_tables = [
+                table_name for table_name, _ in context_packer.fuse_rankings(rankings)
+            ]
+            rankings.append((db.get_related_tables(similar_tables, n=3), 0.5))
+
+        similar_tables = self.blend_feedback(prompt, rankings, index)
+        table_definitions, _ = self.pack_table_definitions(
+            similar_tables, token_budget, index, map_table_to_columns
         )
+        return table_definitions
 
-        return similar_tables_via_embeddings + similar_tables_via_word_match
+    def get_similar_columns_via_embeddings(self, query, n=3, index=None):
+        """
+        Given a query, find the top 'n' tables by their best matching column.
 
-    def get_table_definitions_from_names(self, table_names: list) -> str:
+        Returns:
+        - dict: table name -> up to n_columns matching column indexes, best first.
+            Ordered by table score, best table first.
+        """
+        index = index or self.index
+        if len(index.column_store) == 0:
+            return {}
+
+        key = ("columns", normalize_prompt(query), index.fingerprint, n)
+        map_table_to_columns = self.retrieval_cache.get(key)
+        if map_table_to_columns is MISSING:
+            map_table_to_columns = self.rank_similar_columns(query, n, index)
+            self.retrieval_cache.set(key, map_table_to_columns)
+        return {
+            table_name: list(column_indexes)
+            for table_name, column_indexes in map_table_to_columns.items()
+        }
+
+    def rank_similar_columns(self, query, n, index: ColumnRetrievalIndex):
+        query_embedding = self.compute_query_embedding(query)
+        scores = index.column_store.scores(query_embedding)
+
+        map_table_to_columns = {}
+        for chunk_idx in np.argsort(-scores):
+            table_name, column_idx = index.column_store.keys[chunk_idx]
+            if table_name not in map_table_to_columns:
+                if len(map_table_to_columns) == n:
+                    continue
+                map_table_to_columns[table_name] = []
+            if (
+                column_idx != SUMMARY_CHUNK
+                and len(map_table_to_columns[table_name]) < self.n_columns
+            ):
+                map_table_to_columns[table_name].append(column_idx)
+
+        return map_table_to_columns
+
+    def get_similar_tables_via_embeddings(self, query, n=3, index=None):
+        return list(self.get_similar_columns_via_embeddings(query, n, index).keys())
+
+    def render_table(
+        self,
+        table_name: str,
+        level: str,
+        index: ColumnRetrievalIndex,
+        map_table_to_columns=None,
+    ) -> str:
+        if level == "full":
+            column_indexes = (map_table_to_columns or {}).get(table_name)
+            return self.render_table_definition(table_name, column_indexes, index)
+        if level == "keys":
+            return self.render_table_definition(table_name, [], index)
+        return context_packer.render_name_only(
+            table_name, len(index.map_name_to_columns[table_name])
+        )
+
+    def render_table_definition(self, table_name: str, column_indexes=None, index=None) -> str:
+        index = index or self.index
+        return render_table_definition(
+            table_name,
+            index.map_name_to_columns[table_name],
+            index.map_name_to_key_columns[table_name],
+            column_indexes,
+        )
+
+    def get_table_definitions_from_names(
+        self, table_names: list, map_table_to_columns=None, index=None
+    ) -> str:
         """
         Given a list of table names, return their table definitions.
+        Tables found in map_table_to_columns only render their matching columns.
         """
+        index = index or self.index
+        map_table_to_columns = map_table_to_columns or {}
         table_defs = [
-            self.map_name_to_table_def[table_name] for table_name in table_names
+            self.render_table_definition(
+                table_name, map_table_to_columns.get(table_name), index
+            )
+            for table_name in table_names
         ]
         return "\n\n".join(table_defs)
+
+
+def columns_from_table_def(table_def: str) -> list:
+    """
+    (column name, column type) pairs of a 'create' definition, one column per line
+    as PostgresManager.get_table_definition and render_table_definition write them.
+    """
+    body = table_def.split("(", 1)[1] if "(" in table_def else ""
+    body = body.rsplit(")", 1)[0]
+    columns = []
+    for line in body.splitlines():
+        line = line.strip().rstrip(",")
+        if not line or line.startswith("--"):
+            continue
+        column_name, _, column_type = line.partition(" ")
+        columns.append((column_name.strip('"'), column_type.strip()))
+    return columns
+
+
+def render_table_definition(
+    table_name: str, columns: list, key_columns: set, column_indexes=None
+) -> str:
+    """
+    Render a 'create' definition holding only the given columns plus key columns.
+    All columns are rendered when column_indexes is None.
+    """
+    if column_indexes is None:
+        keep = range(len(columns))
+    else:
+        keep = sorted(
+            set(column_indexes)
+            | {
+                idx
+                for idx, (column_name, _) in enumerate(columns)
+                if column_name in key_columns
+            }
+        )
+
+    create_table_stmt = "CREATE TABLE {} (\n".format(table_name)
+    for idx in keep:
+        create_table_stmt += "{} {},\n".format(*columns[idx])
+    create_table_stmt = create_table_stmt.rstrip(",\n")
+
+    n_omitted = len(columns) - len(keep)
+    if n_omitted > 0:
+        create_table_stmt += "\n-- {} more columns not shown".format(n_omitted)
+
+    return create_table_stmt + "\n);"
+
+
+def make_database_embedder(db: PostgresManager, **kwargs) -> DatabaseEmbedder:
+    """
+    Build the embedder configured by the EMBEDDING_* and CONTEXT_TOKEN_BUDGET
+    environment variables (see .env.sample). kwargs override embedder arguments.
+    """
+    env = os.environ.get
+    # 'table' embeds whole table definitions, 'column' embeds each column (wide tables)
+    granularity = env("EMBEDDING_GRANULARITY", "table")
+    encoder_config = dict(
+        # 'bert', 'sentence' (local model at EMBEDDING_MODEL_PATH) or 'hashing' (no model download)
+        name=env("EMBEDDING_ENCODER", "bert"),
+        # 'pytorch', 'torchscript' or 'onnx' - CPU inference backend of the BERT encoder
+        backend=env("EMBEDDING_BACKEND", "pytorch"),
+        quantize=env("EMBEDDING_QUANTIZE", "false").lower() == "true",
+        num_threads=int(env("EMBEDDING_NUM_THREADS") or 0) or None,
+        model_path=env("EMBEDDING_MODEL_PATH"),
+        # memory-mapped BERT weights file, written on first load
+        weights_path=env("EMBEDDING_WEIGHTS_PATH"),
+        # unload the encoder after this many idle seconds or above this RSS, reload on demand
+        idle_unload_seconds=float(env("EMBEDDING_IDLE_UNLOAD_SECONDS") or 0),
+        max_rss_mb=float(env("EMBEDDING_MAX_RSS_MB") or 0),
+    )
+    embedder_kwargs = dict(
+        encoder=encoders.make_encoder(**encoder_config),
+        # 'float32', 'float16' or 'int8' - storage precision of the embedding index
+        embedding_dtype=env("EMBEDDING_DTYPE", "float32"),
+        encoder_config=encoder_config,
+        # > 1 embeds large schemas across this many processes on a cold start
+        index_workers=int(env("EMBEDDING_INDEX_WORKERS") or 1),
+        # upper bound on table definition tokens sent per prompt
+        context_token_budget=int(env("CONTEXT_TOKEN_BUDGET") or 4000),
+        # requests re-read the schema at most this often
+        schema_refresh_seconds=float(env("EMBEDDING_SCHEMA_REFRESH_SECONDS") or 300),
+        # llm table descriptions written by 'poetry run enrich_tables'
+        table_summaries=(
+            TableSummaryStore(env("TABLE_SUMMARIES_PATH"))
+            if env("TABLE_SUMMARIES_PATH")
+            else None
+        ),
+        # tables used by past successful queries, learned per prompt word
+        feedback=(
+            FeedbackStore(env("FEEDBACK_STORE_PATH"))
+            if env("FEEDBACK_STORE_PATH")
+            else None
+        ),
+    )
+    embedder_kwargs.update(kwargs)
+
+    if granularity == "column":
+        return ColumnDatabaseEmbedder(db, **embedder_kwargs)
+    return DatabaseEmbedder(db, **embedder_kwargs)
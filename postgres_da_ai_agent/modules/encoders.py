@@ -0,0 +1,321 @@
+"""
+Purpose:
+    Pluggable text encoders for the DatabaseEmbedder.
+
+    bert     - bert-base-uncased pooler output (most accurate, large download, needs torch)
+    sentence - small sentence-embedding model loaded from a local path, mean pooled (needs torch)
+    hashing  - pure NumPy feature hashing over character n-grams of identifiers
+               (no download, no torch, instant startup, tiny memory)
+
+    Heavy dependencies are imported inside the encoders that need them, so picking
+    the hashing encoder never imports torch.
+
+    ManagedEncoder wraps any of them to unload the model when idle or when the
+    process crosses a memory watermark, and reload it on the next request.
+"""
+
+import gc
+import threading
+import time
+import zlib
+from typing import Callable, List, Union
+
+import numpy as np
+
+from postgres_da_ai_agent.modules.word_match import WORD_RE
+
+SUPPORTED_ENCODERS = ("bert", "sentence", "hashing")
+
+
+class Encoder:
+    """
+    Turns texts into a (n_texts, dim) float32 ndarray. Similar texts give similar rows.
+    """
+
+    name = "encoder"
+
+    def encode(self, texts: Union[str, List[str]]) -> np.ndarray:
+        raise NotImplementedError
+
+
+class BertEncoder(Encoder):
+    name = "bert"
+
+    def __init__(
+        self,
+        model_name: str = "bert-base-uncased",
+        backend: str = "pytorch",
+        quantize: bool = False,
+        num_threads: int = None,
+        weights_path: str = None,
+    ):
+        from postgres_da_ai_agent.modules import inference
+
+        # pytorch, torchscript or onnx - see modules/inference.py
+        self.bert_runner = inference.make_bert_runner(
+            model_name,
+            backend=backend,
+            quantize=quantize,
+            num_threads=num_threads,
+            weights_path=weights_path,
+        )
+
+    def encode(self, texts):
+        return self.bert_runner(texts)
+
+
+class SentenceEncoder(Encoder):
+    name = "sentence"
+
+    def __init__(self, model_path: str, max_length: int = 256, num_threads: int = None):
+        if not model_path:
+            raise ValueError(
+                "The sentence encoder needs a local model directory. Set EMBEDDING_MODEL_PATH."
+            )
+
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        self.torch = torch
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True)
+        self.model = AutoModel.from_pretrained(model_path, local_files_only=True).eval()
+
+    def encode(self, texts):
+        inputs = self.tokenizer(
+            texts,
+            return_tensors="pt",
+            truncation=True,
+            padding=True,
+            max_length=self.max_length,
+        )
+        with self.torch.no_grad():
+            token_embeddings = self.model(**inputs).last_hidden_state
+
+        # mean pool over real (non padding) tokens
+        mask = inputs["attention_mask"].unsqueeze(-1).to(token_embeddings.dtype)
+        pooled = (token_embeddings * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+        return pooled.numpy()
+
+
+class HashingEncoder(Encoder):
+    """
+    Signed feature hashing of identifier words and their character n-grams.
+    'job_status' -> words 'job', 'status' -> '<job>', '<jo', 'job', 'ob>', ...
+    Shared n-grams make 'customer' and 'customers' or 'cust_id' land close together.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim: int = 1024, ngram_range=(3, 5), word_weight: float = 2.0):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.word_weight = word_weight
+
+    def add_feature(self, row: np.ndarray, feature: str, weight: float):
+        h = zlib.crc32(feature.encode())
+        sign = -1.0 if h & 0x80000000 else 1.0
+        row[h % self.dim] += sign * weight
+
+    def encode(self, texts):
+        if isinstance(texts, str):
+            texts = [texts]
+
+        min_n, max_n = self.ngram_range
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+
+        for row, text in zip(embeddings, texts):
+            for word in WORD_RE.findall(text.lower()):
+                self.add_feature(row, word, self.word_weight)
+                padded = f"<{word}>"
+                for n in range(min_n, max_n + 1):
+                    for start in range(len(padded) - n + 1):
+                        self.add_feature(row, padded[start : start + n], 1.0)
+
+        return embeddings
+
+
+class ManagedEncoder(Encoder):
+    """
+    Loads the wrapped encoder on first use and unloads it again after idle_seconds
+    without requests, or as soon as the process RSS exceeds max_rss_mb.
+    The next encode() call reloads it. Load/unload counts are kept for monitoring.
+
+    Freed memory often isn't returned to the OS, so RSS can stay above max_rss_mb
+    after an unload. The watermark is then raised to the lowest RSS seen since:
+    reloading into that memory doesn't trigger another unload, only growth beyond
+    it does. Without this every request would reload the model and the next check
+    would unload it again. The raise follows the RSS down, loaded or not, and is
+    dropped once RSS is back under max_rss_mb, so one high-RSS unload doesn't lift
+    the limit for the life of the process.
+    """
+
+    def __init__(
+        self,
+        load_encoder: Callable[[], Encoder],
+        name: str = "managed",
+        idle_seconds: float = None,
+        max_rss_mb: float = None,
+        check_interval_seconds: float = 30,
+    ):
+        self.load_encoder = load_encoder
+        self.name = name
+        self.idle_seconds = idle_seconds
+        self.max_rss_mb = max_rss_mb
+        self.check_interval_seconds = check_interval_seconds
+
+        self.encoder = None
+        self.in_flight = 0
+        self.last_used = time.time()
+        self.loads = 0
+        self.unloads = 0
+        self.last_load_seconds = None
+        self.last_unload_reason = None
+        # lowest RSS seen since the last watermark unload, None once back under max_rss_mb, see rss_watermark_mb
+        self.rss_after_unload_mb = None
+        self.lock = threading.Lock()
+
+        self.stopped = threading.Event()
+        if idle_seconds or max_rss_mb:
+            threading.Thread(target=self.monitor, daemon=True).start()
+
+    def encode(self, texts):
+        with self.lock:
+            if self.encoder is None:
+                self.load()
+            encoder = self.encoder
+            self.in_flight += 1
+        try:
+            return encoder.encode(texts)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.last_used = time.time()
+
+    def load(self):
+        """
+        Must be called holding self.lock.
+        """
+        start = time.time()
+        self.encoder = self.load_encoder()
+        self.last_load_seconds = time.time() - start
+        self.loads += 1
+        print(f"Loaded {self.name} encoder in {self.last_load_seconds:.2f}s")
+
+    def unload(self, reason: str = "manual") -> bool:
+        """
+        Drop the encoder unless a request is using it. Returns True if it was unloaded.
+        """
+        with self.lock:
+            if self.encoder is None or self.in_flight > 0:
+                return False
+            self.encoder = None
+            self.unloads += 1
+            self.last_unload_reason = reason
+        gc.collect()
+        print(f"Unloaded {self.name} encoder ({reason})")
+        return True
+
+    def rss_watermark_mb(self) -> float:
+        """
+        max_rss_mb, or the RSS left after the last watermark unload when that stayed above it.
+        """
+        if self.rss_after_unload_mb is None:
+            return self.max_rss_mb
+        return max(self.max_rss_mb, self.rss_after_unload_mb)
+
+    def lower_rss_watermark(self, rss_mb: float):
+        """
+        Follow the RSS down after a watermark unload, back to max_rss_mb once it is under it.
+        """
+        if self.rss_after_unload_mb is None or rss_mb is None:
+            return
+        if rss_mb <= self.max_rss_mb:
+            self.rss_after_unload_mb = None
+        else:
+            self.rss_after_unload_mb = min(self.rss_after_unload_mb, rss_mb)
+
+    def monitor(self):
+        while not self.stopped.wait(self.check_interval_seconds):
+            rss_mb = current_rss_mb()
+            self.lower_rss_watermark(rss_mb)
+            if self.encoder is None:
+                continue
+            if self.idle_seconds and time.time() - self.last_used > self.idle_seconds:
+                self.unload("idle")
+                continue
+            if not self.max_rss_mb or rss_mb is None:
+                continue
+            watermark_mb = self.rss_watermark_mb()
+            if rss_mb > watermark_mb and self.unload(f"rss {rss_mb:.0f}MB > {watermark_mb:.0f}MB"):
+                self.rss_after_unload_mb = current_rss_mb()
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.encoder is not None,
+            "loads": self.loads,
+            "unloads": self.unloads,
+            "last_load_seconds": self.last_load_seconds,
+            "last_unload_reason": self.last_unload_reason,
+            "idle_seconds": round(time.time() - self.last_used, 1),
+            "rss_mb": current_rss_mb(),
+            "rss_watermark_mb": self.rss_watermark_mb() if self.max_rss_mb else None,
+        }
+
+
+def current_rss_mb():
+    """
+    Resident set size of this process in MB, or None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    import resource
+
+    return resident_pages * resource.getpagesize() / (1024 * 1024)
+
+
+def make_encoder(
+    name: str = "bert",
+    backend: str = "pytorch",
+    quantize: bool = False,
+    num_threads: int = None,
+    model_path: str = None,
+    weights_path: str = None,
+    idle_unload_seconds: float = None,
+    max_rss_mb: float = None,
+) -> Encoder:
+    """
+    Build an encoder by name. backend, quantize and weights_path only apply to bert.
+    With idle_unload_seconds or max_rss_mb the encoder is wrapped in a ManagedEncoder.
+    """
+    if idle_unload_seconds or max_rss_mb:
+        return ManagedEncoder(
+            lambda: make_encoder(
+                name, backend, quantize, num_threads, model_path, weights_path
+            ),
+            name=name,
+            idle_seconds=idle_unload_seconds,
+            max_rss_mb=max_rss_mb,
+        )
+
+    if name == "bert":
+        return BertEncoder(
+            backend=backend,
+            quantize=quantize,
+            num_threads=num_threads,
+            weights_path=weights_path,
+        )
+    if name == "sentence":
+        return SentenceEncoder(model_path, num_threads=num_threads)
+    if name == "hashing":
+        return HashingEncoder()
+    raise ValueError(f"Unsupported encoder: {name}. Use one of {SUPPORTED_ENCODERS}")
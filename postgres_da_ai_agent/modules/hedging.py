@@ -0,0 +1,124 @@
+"""
+Purpose:
+    Hedged LLM requests to cut tail latency.
+    Per model latency histograms tell how long a call usually takes. A call
+    still running after the configured percentile of that latency gets a
+    duplicate (hedge) request; the first good response wins and the other is
+    cancelled. Hedges are capped at a share of calls, and the spend of the
+    losing requests is reported so the latency win can be weighed against it.
+"""
+
+import math
+import threading
+from typing import Dict, List, Optional
+
+
+class LatencyHistogram:
+    """
+    Call latencies in log spaced buckets, from min_seconds growing by factor per bucket.
+    Once max_samples are held every count is halved, so old latencies fade out
+    and the percentiles follow the model's current speed.
+    """
+
+    def __init__(
+        self,
+        min_seconds: float = 0.05,
+        factor: float = 1.2,
+        buckets: int = 60,
+        max_samples: int = 10000,
+    ):
+        self.min_seconds = min_seconds
+        self.factor = factor
+        self.bounds: List[float] = [min_seconds * factor**i for i in range(buckets)]
+        # the last count is for latencies above the last bound
+        self.counts: List[int] = [0] * (buckets + 1)
+        self.count = 0
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        index = 0
+        if seconds > self.min_seconds:
+            index = min(
+                math.ceil(math.log(seconds / self.min_seconds, self.factor)), len(self.bounds)
+            )
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            if self.count >= self.max_samples:
+                self.counts = [count // 2 for count in self.counts]
+                self.count = sum(self.counts)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        """
+        Upper bound of the bucket holding the percentile (0-100), None without samples.
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            rank = math.ceil(percentile / 100 * self.count)
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return self.bounds[min(index, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "samples": self.count,
+            "p50_seconds": self.percentile(50),
+            "p95_seconds": self.percentile(95),
+            "p99_seconds": self.percentile(99),
+        }
+
+
+class HedgeStats:
+    """
+    Hedging counters and the extra spend of the requests that lost.
+    The cost of a cancelled request is estimated from its prompt tokens,
+    a loser that completed anyway is charged its reported usage.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {
+            "calls": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "skipped_budget": 0,
+            "skipped_rate_limit": 0,
+            "skipped_saturated": 0,
+            "cancelled": 0,
+        }
+        self.extra_tokens = 0
+        self.extra_cost = 0.0
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+    def allow_hedge(self, max_ratio: float) -> bool:
+        """
+        Take a hedge from the budget: at most max_ratio hedges per call.
+        """
+        with self.lock:
+            if self.counts["hedges"] + 1 > max_ratio * self.counts["calls"]:
+                self.counts["skipped_budget"] += 1
+                return False
+            self.counts["hedges"] += 1
+            return True
+
+    def add_extra_spend(self, tokens: float, cost: float):
+        with self.lock:
+            self.extra_tokens += tokens
+            self.extra_cost += cost
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            stats = dict(self.counts)
+            stats["extra_tokens"] = round(self.extra_tokens)
+            stats["extra_cost"] = round(self.extra_cost, 6)
+        stats["hedge_ratio"] = round(stats["hedges"] / stats["calls"], 4) if stats["calls"] else 0.0
+        return stats
@@ -0,0 +1,229 @@
+"""
+Purpose:
+    CPU inference backends for the BERT encoder used by the DatabaseEmbedder.
+
+    pytorch     - eager PyTorch forward pass (default)
+    torchscript - traced TorchScript module
+    onnx        - exported ONNX graph run by onnxruntime (optional dependency)
+
+    Every backend can apply int8 dynamic quantization to the linear layers and
+    run with a fixed intra-op thread count. The pytorch and torchscript backends
+    can load weights from a memory-mapped file for fast warm-up after an unload.
+"""
+
+import os
+import threading
+
+import torch
+from transformers import BertConfig, BertModel, BertTokenizer
+
+SUPPORTED_BACKENDS = ("pytorch", "torchscript", "onnx")
+
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", "./model_cache")
+
+# BertModel.forward positional order - torchscript and onnx inputs follow it
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+
+class BertRunner:
+    """
+    Tokenize text and return BERT's pooler output as a (n_texts, 768) ndarray.
+    """
+
+    def __init__(self, model_name: str, max_length: int = 512):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.tokenizer = BertTokenizer.from_pretrained(model_name)
+
+    def tokenize(self, text, return_tensors: str = "pt"):
+        return self.tokenizer(
+            text,
+            return_tensors=return_tensors,
+            truncation=True,
+            padding=True,
+            max_length=self.max_length,
+        )
+
+    def __call__(self, text):
+        raise NotImplementedError
+
+
+class PytorchBertRunner(BertRunner):
+    def __init__(
+        self, model_name: str, quantize: bool = False, weights_path: str = None
+    ):
+        super().__init__(model_name)
+        model = load_bert_model(model_name, weights_path=weights_path)
+        if quantize:
+            model = quantize_linear_layers(model)
+        self.model = model
+
+    def __call__(self, text):
+        inputs = self.tokenize(text)
+        with torch.no_grad():
+            outputs = self.model(**inputs)
+        return outputs["pooler_output"].detach().numpy()
+
+
+class TorchScriptBertRunner(BertRunner):
+    def __init__(
+        self, model_name: str, quantize: bool = False, weights_path: str = None
+    ):
+        super().__init__(model_name)
+        # torchscript=True makes the model return tuples, which tracing requires
+        model = load_bert_model(model_name, torchscript=True, weights_path=weights_path)
+        if quantize:
+            model = quantize_linear_layers(model)
+
+        example = self.tokenize("example table definition")
+        with torch.no_grad():
+            self.model = torch.jit.freeze(
+                torch.jit.trace(
+                    model, tuple(example[name] for name in INPUT_NAMES), strict=False
+                )
+            )
+
+    def __call__(self, text):
+        inputs = self.tokenize(text)
+        with torch.no_grad():
+            _, pooler_output = self.model(*(inputs[name] for name in INPUT_NAMES))
+        return pooler_output.numpy()
+
+
+class OnnxBertRunner(BertRunner):
+    def __init__(
+        self, model_name: str, quantize: bool = False, num_threads: int = None
+    ):
+        super().__init__(model_name)
+
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError(
+                "The onnx embedding backend requires onnxruntime. Install it with: pip install onnxruntime"
+            )
+
+        model_path = export_onnx_model(model_name, quantize)
+
+        session_options = onnxruntime.SessionOptions()
+        if num_threads:
+            session_options.intra_op_num_threads = num_threads
+        session_options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            model_path, session_options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, text):
+        inputs = self.tokenize(text, return_tensors="np")
+        _, pooler_output = self.session.run(
+            ["last_hidden_state", "pooler_output"],
+            {name: inputs[name].astype("int64") for name in INPUT_NAMES},
+        )
+        return pooler_output
+
+
+def load_bert_model(model_name: str, torchscript: bool = False, weights_path: str = None):
+    """
+    Load BertModel in eval mode.
+
+    With weights_path, the first load saves the state dict there and later loads
+    memory-map it instead of deserializing the pretrained checkpoint, so the
+    pages are shared with the OS cache and reloads after an idle unload are fast.
+    """
+    if weights_path and os.path.exists(weights_path):
+        config = BertConfig.from_pretrained(model_name, torchscript=torchscript)
+        model = BertModel(config)
+        state_dict = torch.load(weights_path, mmap=True, weights_only=True)
+        model.load_state_dict(state_dict, assign=True)
+        return model.eval()
+
+    model = BertModel.from_pretrained(model_name, torchscript=torchscript).eval()
+    if weights_path:
+        os.makedirs(os.path.dirname(weights_path) or ".", exist_ok=True)
+        # write then rename, concurrent loaders never memory-map a half written file
+        tmp_path = f"{weights_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        torch.save(model.state_dict(), tmp_path)
+        os.replace(tmp_path, weights_path)
+    return model
+
+
+def quantize_linear_layers(model):
+    """
+    int8 dynamic quantization: linear weights are stored as int8, activations are quantized on the fly.
+    """
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def export_onnx_model(model_name: str, quantize: bool = False) -> str:
+    """
+    Export the model to ONNX once (and quantize it once) under MODEL_CACHE_DIR.
+    Returns the path of the model file to load.
+    """
+    model_dir = os.path.join(MODEL_CACHE_DIR, model_name.replace("/", "_"))
+    model_path = os.path.join(model_dir, "model.onnx")
+    quantized_model_path = os.path.join(model_dir, "model.int8.onnx")
+
+    if not os.path.exists(model_path):
+        os.makedirs(model_dir, exist_ok=True)
+        print(f"Exporting {model_name} to {model_path}")
+
+        model = BertModel.from_pretrained(model_name, torchscript=True).eval()
+        example = BertTokenizer.from_pretrained(model_name)(
+            "example table definition", return_tensors="pt"
+        )
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+        dynamic_axes["pooler_output"] = {0: "batch"}
+
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                tuple(example[name] for name in INPUT_NAMES),
+                model_path,
+                input_names=INPUT_NAMES,
+                output_names=["last_hidden_state", "pooler_output"],
+                dynamic_axes=dynamic_axes,
+                opset_version=14,
+            )
+
+    if not quantize:
+        return model_path
+
+    if not os.path.exists(quantized_model_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        print(f"Quantizing {model_path} to {quantized_model_path}")
+        quantize_dynamic(model_path, quantized_model_path, weight_type=QuantType.QInt8)
+
+    return quantized_model_path
+
+
+def make_bert_runner(
+    model_name: str = "bert-base-uncased",
+    backend: str = "pytorch",
+    quantize: bool = False,
+    num_threads: int = None,
+    weights_path: str = None,
+) -> BertRunner:
+    """
+    Build the BERT runner for the configured backend.
+    num_threads sets the intra-op thread count (torch is process wide, onnxruntime per session).
+    weights_path memory-maps the weights (pytorch and torchscript only).
+    """
+    if backend not in SUPPORTED_BACKENDS:
+        raise ValueError(
+            f"Unsupported embedding backend: {backend}. Use one of {SUPPORTED_BACKENDS}"
+        )
+
+    if num_threads and backend != "onnx":
+        torch.set_num_threads(num_threads)
+
+    if backend == "torchscript":
+        return TorchScriptBertRunner(model_name, quantize, weights_path)
+    if backend == "onnx":
+        return OnnxBertRunner(model_name, quantize, num_threads)
+    return PytorchBertRunner(model_name, quantize, weights_path)
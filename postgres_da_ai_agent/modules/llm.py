@@ -4,15 +4,23 @@ Purpose:
     Provide supporting prompt engineering functions.
 """
 
+import asyncio
+import contextlib
+import contextvars
 import json
 import sys
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
 import os
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import openai
-import tiktoken
 
 from postgres_da_ai_agent.types import TurboTool
+from postgres_da_ai_agent.modules import hedging, rate_limit, response_cache, tokenizer, usage_ledger
 
 # load .env file
 load_dotenv()
@@ -21,6 +29,8 @@ assert os.environ.get("OPENAI_API_KEY")
 
 # get openai api key
 openai.api_key = os.environ.get("OPENAI_API_KEY")
+# retries are handled by send_chat_completion, within the rate limits
+openai.max_retries = 0
 
 # ------------------ helpers ------------------
 
@@ -46,18 +56,644 @@ def response_parser(response: Dict[str, Any]):
     return safe_get(response, "choices.0.message.content")
 
 
+# ------------------ usage accounting ------------------
+
+# usage blocks of every completion and run, per session, team and model
+usage_ledger_store = usage_ledger.UsageLedger()
+
+# (session, team) the calls of the current thread / task are booked to, see usage_context
+current_usage_scope = contextvars.ContextVar("current_usage_scope", default=(None, None))
+# usage of the calls made inside the current track_usage block
+current_usage = contextvars.ContextVar("current_usage", default=None)
+
+
+@contextlib.contextmanager
+def usage_context(session: str = None, team: str = None):
+    """
+    Book the calls made inside the block to session and team. Unset ones are inherited.
+    """
+    parent_session, parent_team = current_usage_scope.get()
+    token = current_usage_scope.set((session or parent_session, team or parent_team))
+    try:
+        yield
+    finally:
+        current_usage_scope.reset(token)
+
+
+@contextlib.contextmanager
+def track_usage():
+    """
+    Collect the usage of the API calls made inside the block:
+        with llm.track_usage() as usage:
+            ...
+        usage -> {"calls", "estimated_calls", "prompt_tokens", "completion_tokens", "cached_tokens", "cost"}
+    """
+    usage = usage_ledger.empty_totals()
+    token = current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        current_usage.reset(token)
+
+
+def record_usage(model: str, response: Dict[str, Any], team: str = None) -> Dict[str, float]:
+    """
+    Book the usage block of an API response (or assistant run) in the usage ledger,
+    under the current usage_context (team overrides its team).
+    Inside a track_usage block, the call is also added to that block's usage.
+    Returns the call's prompt, completion and cached tokens and its cost.
+    """
+    session, scope_team = current_usage_scope.get()
+    entry = usage_ledger_store.record(
+        model, response, session=session, team=team or scope_team
+    )
+
+    usage = current_usage.get()
+    if usage is not None:
+        usage_ledger.add_to_totals(usage, entry, entry["cost"])
+    return entry
+
+
+def get_prompt_cache_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Per model: calls, prompt tokens, cached prompt tokens and the cached share of prompt tokens.
+    Cached tokens are the prompt prefix the provider served from its prompt cache.
+    """
+    return {
+        model: {
+            "calls": totals["calls"],
+            "prompt_tokens": totals["prompt_tokens"],
+            "cached_tokens": totals["cached_tokens"],
+            "cached_ratio": round(
+                totals["cached_tokens"] / max(totals["prompt_tokens"], 1), 4
+            ),
+        }
+        for model, totals in usage_ledger_store.model_totals().items()
+    }
+
+
+def get_usage_ledger() -> dict:
+    """
+    Usage and cost totals overall, per session, team and model, and per (session, team, model).
+    """
+    return usage_ledger_store.export()
+
+
+def save_usage_ledger(path: str):
+    usage_ledger_store.save(path)
+
+
+# ------------------ rate limiting and retries ------------------
+
+# per model requests and tokens per minute budgets, 0 is unlimited
+# LLM_MODEL_RATE_LIMITS overrides them per model as rpm/tpm, e.g. "gpt-4-1106-preview=500/150000"
+LLM_RPM = float(os.environ.get("LLM_RPM") or 0)
+LLM_TPM = float(os.environ.get("LLM_TPM") or 0)
+map_model_to_rate_limits = {
+    model.strip(): tuple(float(limit) for limit in limits.split("/"))
+    for model, limits in (
+        pair.split("=")
+        for pair in (os.environ.get("LLM_MODEL_RATE_LIMITS") or "").split(",")
+        if pair.strip()
+    )
+}
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES") or 5)
+LLM_RETRY_BASE_SECONDS = float(os.environ.get("LLM_RETRY_BASE_SECONDS") or 1)
+LLM_RETRY_MAX_SECONDS = float(os.environ.get("LLM_RETRY_MAX_SECONDS") or 60)
+
+map_model_to_rate_limiter: Dict[str, rate_limit.RateLimiter] = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model: str) -> rate_limit.RateLimiter:
+    with rate_limiters_lock:
+        limiter = map_model_to_rate_limiter.get(model)
+        if limiter is None:
+            requests_per_minute, tokens_per_minute = map_model_to_rate_limits.get(
+                model, (LLM_RPM, LLM_TPM)
+            )
+            limiter = rate_limit.RateLimiter(requests_per_minute, tokens_per_minute)
+            map_model_to_rate_limiter[model] = limiter
+        return limiter
+
+
+def estimate_request_tokens(request: Dict[str, Any]) -> float:
+    """
+    Tokens a chat completion request counts against the tokens per minute budget:
+    message contents, tool definitions and max_tokens.
+    """
+    model_tokenizer = get_tokenizer(request.get("model"))
+    tokens = model_tokenizer.count_messages(
+        message for message in request.get("messages", []) if isinstance(message, dict)
+    )
+    if request.get("tools"):
+        tokens += model_tokenizer.count(json.dumps(request["tools"]))
+    return tokens + (request.get("max_tokens") or 0)
+
+
+def retry_delay(
+    model: str, limiter: rate_limit.RateLimiter, attempt: int, error: Exception
+) -> Optional[float]:
+    """
+    Seconds to wait before retrying a failed call, None when it should not be retried.
+    A 429 pauses every caller of the model, not just this one.
+    """
+    if attempt >= LLM_MAX_RETRIES or not rate_limit.is_retryable(error):
+        return None
+    delay = rate_limit.backoff_seconds(
+        attempt, error, LLM_RETRY_BASE_SECONDS, LLM_RETRY_MAX_SECONDS
+    )
+    if rate_limit.is_rate_limited(error):
+        limiter.pause(delay)
+    print(
+        f"{model} call failed with {type(error).__name__}, retry {attempt + 1}/{LLM_MAX_RETRIES} in {delay:.1f}s"
+    )
+    return delay
+
+
+def finish_chat_completion(
+    model: str, limiter: rate_limit.RateLimiter, estimated_tokens: float, response
+) -> Dict[str, Any]:
+    response_dump = response.model_dump()
+    record_usage(model, response_dump)
+    # settle the token budget with the real usage
+    total_tokens = safe_get(response_dump, "usage.total_tokens") or estimated_tokens
+    limiter.adjust_tokens(total_tokens - estimated_tokens)
+    return response_dump
+
+
+def send_chat_completion(request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    openai.chat.completions.create(**request) as a dict, within the model's rate limits,
+    retrying 429s, 5xx and connection errors. Hedged when LLM_HEDGE is on.
+    """
+    if LLM_HEDGE:
+        return run_hedged_chat_completion(request)
+
+    model = request["model"]
+    limiter = get_rate_limiter(model)
+    estimated_tokens = estimate_request_tokens(request)
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        time.sleep(limiter.reserve(estimated_tokens))
+        started_at = time.monotonic()
+        try:
+            response = openai.chat.completions.create(**request)
+        except Exception as e:
+            delay = retry_delay(model, limiter, attempt, e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        observe_latency(model, time.monotonic() - started_at)
+        return finish_chat_completion(model, limiter, estimated_tokens, response)
+
+
+def send_chat_completion_stream(request: Dict[str, Any]) -> Iterator[str]:
+    """
+    Streaming send_chat_completion: yields the content tokens as they arrive.
+    Only opening the stream is retried, tokens already yielded can't be taken back.
+    The usage block of the last chunk is booked like a completion's. Without one,
+    counted tokens are booked marked as estimated. The latency runs until the stream ends.
+    """
+    model = request["model"]
+    limiter = get_rate_limiter(model)
+    estimated_tokens = estimate_request_tokens(request)
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        time.sleep(limiter.reserve(estimated_tokens))
+        started_at = time.monotonic()
+        try:
+            stream = openai.chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, **request
+            )
+            break
+        except Exception as e:
+            delay = retry_delay(model, limiter, attempt, e)
+            if delay is None:
+                raise
+            time.sleep(delay)
+
+    content = ""
+    usage = None
+    for chunk in stream:
+        chunk_dump = chunk.model_dump()
+        usage = chunk_dump.get("usage") or usage
+        token = safe_get(chunk_dump, "choices.0.delta.content")
+        if token:
+            content += token
+            yield token
+
+    observe_latency(model, time.monotonic() - started_at)
+    if usage:
+        record_usage(model, {"usage": usage})
+        total_tokens = usage.get("total_tokens") or estimated_tokens
+        limiter.adjust_tokens(total_tokens - estimated_tokens)
+        return
+
+    # no usage block, settle the token budget with the counted output
+    completion_tokens = count_tokens(content, model)
+    prompt_tokens = estimated_tokens - (request.get("max_tokens") or 0)
+    record_usage(
+        model,
+        {
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+            "estimated": True,
+        },
+    )
+    limiter.adjust_tokens(completion_tokens)
+
+
+# ------------------ hedged requests ------------------
+
+# LLM_HEDGE=1 duplicates a call still running after the LLM_HEDGE_PERCENTILE latency of its model,
+# to the alternate model of LLM_HEDGE_MODELS if one is set, e.g. "gpt-4-1106-preview=gpt-3.5-turbo-1106"
+LLM_HEDGE = os.environ.get("LLM_HEDGE") == "1"
+LLM_HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE") or 95)
+# no hedging until the model's histogram holds this many latencies
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES") or 20)
+# at most this share of calls is hedged
+LLM_HEDGE_MAX_RATIO = float(os.environ.get("LLM_HEDGE_MAX_RATIO") or 0.1)
+map_model_to_hedge_model = {
+    model.strip(): hedge_model.strip()
+    for model, hedge_model in (
+        pair.split("=")
+        for pair in (os.environ.get("LLM_HEDGE_MODELS") or "").split(",")
+        if pair.strip()
+    )
+}
+
+map_model_to_latency_histogram: Dict[str, hedging.LatencyHistogram] = {}
+latency_histograms_lock = threading.Lock()
+hedge_stats = hedging.HedgeStats()
+
+# event loop of the background thread hedged sync calls run on, see get_hedge_loop
+hedge_loop = None
+hedge_loop_lock = threading.Lock()
+
+
+def get_latency_histogram(model: str) -> hedging.LatencyHistogram:
+    with latency_histograms_lock:
+        histogram = map_model_to_latency_histogram.get(model)
+        if histogram is None:
+            histogram = hedging.LatencyHistogram()
+            map_model_to_latency_histogram[model] = histogram
+        return histogram
+
+
+def observe_latency(model: str, seconds: float):
+    get_latency_histogram(model).observe(seconds)
+
+
+def hedge_delay(model: str) -> Optional[float]:
+    """
+    Seconds after which a call to model is hedged, None until its histogram holds LLM_HEDGE_MIN_SAMPLES latencies.
+    """
+    histogram = get_latency_histogram(model)
+    if histogram.count < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return histogram.percentile(LLM_HEDGE_PERCENTILE)
+
+
+def settle_hedge_loser(request: Dict[str, Any], task: asyncio.Future):
+    """
+    Cancel the request that lost the race and add its spend to hedge_stats:
+    its reported usage when it completed anyway, else its estimated prompt tokens.
+    A request that failed costs nothing.
+    """
+    model = request["model"]
+    if not task.done():
+        task.cancel()
+        hedge_stats.count("cancelled")
+        prompt_tokens = estimate_request_tokens(request) - (request.get("max_tokens") or 0)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": 0, "cached_tokens": 0}
+    elif task.cancelled() or task.exception() is not None:
+        return
+    else:
+        usage = usage_ledger.usage_from_response(task.result())
+    hedge_stats.add_extra_spend(
+        usage["prompt_tokens"] + usage["completion_tokens"], usage_ledger.price(model, usage)
+    )
+
+
+async def asend_hedged_chat_completion(request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    asend_chat_completion, hedged: when the call is still running after its model's
+    hedge_delay, a duplicate goes to the hedge model. The first good response wins and
+    the other request is cancelled. The delay counts from when the request is sent, like
+    the latencies it is taken from, so time queued for rate limits and concurrency slots
+    never triggers a hedge. Hedges are skipped while the hedge model is rate limited or
+    has no free concurrency slot, and once LLM_HEDGE_MAX_RATIO of calls were hedged.
+    """
+    model = request["model"]
+    delay = hedge_delay(model)
+    hedge_stats.count("calls")
+    if delay is None:
+        return await asend_chat_completion(request)
+
+    sent = asyncio.Event()
+    primary = asyncio.ensure_future(asend_chat_completion(request, sent))
+    sent_waiter = asyncio.ensure_future(sent.wait())
+    hedge = None
+    try:
+        await asyncio.wait({primary, sent_waiter}, return_when=asyncio.FIRST_COMPLETED)
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        hedge_request = {**request, "model": map_model_to_hedge_model.get(model, model)}
+        hedge_limiter = get_rate_limiter(hedge_request["model"])
+        if hedge_limiter.wait_seconds(estimate_request_tokens(hedge_request)) > 0:
+            hedge_stats.count("skipped_rate_limit")
+            return await primary
+        hedge_semaphore = get_model_semaphore(hedge_request["model"])
+        if hedge_semaphore.locked() or get_async_state()["semaphore"].locked():
+            hedge_stats.count("skipped_saturated")
+            return await primary
+        if not hedge_stats.allow_hedge(LLM_HEDGE_MAX_RATIO):
+            return await primary
+
+        print(f"{model} call running for {delay:.2f}s, hedging with {hedge_request['model']}")
+        hedge = asyncio.ensure_future(asend_chat_completion(hedge_request))
+        map_task_to_request = {primary: request, hedge: hedge_request}
+
+        pending = set(map_task_to_request)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                loser = hedge if task is primary else primary
+                hedge_stats.count("primary_wins" if task is primary else "hedge_wins")
+                settle_hedge_loser(map_task_to_request[loser], loser)
+                return task.result()
+        raise error
+    finally:
+        # the caller gave up (or a request won), nothing is left running
+        for task in (primary, sent_waiter, hedge):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+def get_hedge_loop() -> asyncio.AbstractEventLoop:
+    """
+    Event loop of a background thread, started on first use. Sync callers run their
+    hedged calls on it so the losing request can be cancelled.
+    """
+    global hedge_loop
+    with hedge_loop_lock:
+        if hedge_loop is None:
+            hedge_loop = asyncio.new_event_loop()
+            threading.Thread(target=hedge_loop.run_forever, name="llm-hedge", daemon=True).start()
+        return hedge_loop
+
+
+def run_hedged_chat_completion(request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    asend_hedged_chat_completion for sync callers. The caller's usage_context and track_usage apply.
+    """
+    scope, usage = current_usage_scope.get(), current_usage.get()
+
+    async def send():
+        current_usage_scope.set(scope)
+        current_usage.set(usage)
+        return await asend_hedged_chat_completion(request)
+
+    return asyncio.run_coroutine_threadsafe(send(), get_hedge_loop()).result()
+
+
+def get_hedge_stats() -> Dict[str, Any]:
+    """
+    Hedges sent and won, the extra spend of the losing requests, and per model latency percentiles.
+    """
+    with latency_histograms_lock:
+        map_model_to_histogram = dict(map_model_to_latency_histogram)
+    return {
+        **hedge_stats.stats(),
+        "latency": {
+            model: histogram.stats() for model, histogram in map_model_to_histogram.items()
+        },
+    }
+
+
+# ------------------ response caching ------------------
+
+# repeated identical requests are answered locally, LLM_CACHE=0 turns the cache off
+response_cache_store = (
+    response_cache.ResponseCache(
+        path=os.environ.get("LLM_CACHE_PATH") or None,
+        max_size=int(os.environ.get("LLM_CACHE_MAX_SIZE") or 1024),
+        ttl_seconds=float(os.environ.get("LLM_CACHE_TTL_SECONDS") or 7 * 24 * 3600),
+    )
+    if os.environ.get("LLM_CACHE", "1") != "0"
+    else None
+)
+
+
+def response_cache_key(request: Dict[str, Any], use_cache: bool) -> Optional[str]:
+    """
+    Response cache key of request, None when the request must reach the API.
+    """
+    cacheable = response_cache_store is not None and response_cache.is_cacheable(request)
+    if cacheable and not use_cache:
+        response_cache_store.count("bypassed")
+    return response_cache.request_key(request) if cacheable and use_cache else None
+
+
+def create_chat_completion(
+    use_cache: bool = True, store_response: bool = True, **request
+) -> Dict[str, Any]:
+    """
+    openai.chat.completions.create(**request) as a dict, served from the response cache
+    when an identical deterministic request was answered before.
+    use_cache=False always calls the API (and does not store the response).
+    store_response=False leaves storing to the caller (store_chat_completion), e.g. once
+    the response's tool calls succeeded, so a response whose SQL fails is never replayed.
+    """
+    key = response_cache_key(request, use_cache)
+    if key:
+        cached_response = response_cache_store.get(key)
+        if cached_response is not None:
+            return cached_response
+
+    response_dump = send_chat_completion(request)
+
+    if key and store_response:
+        response_cache_store.set(key, response_dump)
+    return response_dump
+
+
+def store_chat_completion(
+    request: Dict[str, Any], response_dump: Dict[str, Any], use_cache: bool = True
+):
+    """
+    Store the response of a create_chat_completion(store_response=False, **request) call.
+    """
+    key = response_cache_key(request, use_cache)
+    if key:
+        response_cache_store.set(key, response_dump)
+
+
+def get_response_cache_stats() -> Dict[str, float]:
+    """
+    Memory and disk hits, misses, bypassed calls and the hit rate of the response cache.
+    """
+    if response_cache_store is None:
+        return {}
+    return response_cache_store.stats()
+
+
+# ------------------ tool calls ------------------
+
+# the tool calls of one model turn run concurrently, each given LLM_TOOL_CALL_TIMEOUT_SECONDS
+LLM_TOOL_CALL_WORKERS = int(os.environ.get("LLM_TOOL_CALL_WORKERS") or 8)
+LLM_TOOL_CALL_TIMEOUT_SECONDS = float(
+    os.environ.get("LLM_TOOL_CALL_TIMEOUT_SECONDS") or 120
+)
+tool_call_executor = ThreadPoolExecutor(
+    max_workers=LLM_TOOL_CALL_WORKERS, thread_name_prefix="tool-call"
+)
+
+
+class ToolCallTimeout(str):
+    """
+    Output of a tool call that timed out: the error message the model gets back.
+    """
+
+
+def parse_tool_arguments(arguments) -> dict:
+    # arguments are a json string, some clients already parse them
+    if isinstance(arguments, dict):
+        return arguments
+    return json.loads(arguments)
+
+
+def run_tool_call(turbo_tool: TurboTool, arguments: dict, state: dict) -> Any:
+    # the worker thread is recorded so a timed out call can be cancelled
+    state["thread_id"] = threading.get_ident()
+    return turbo_tool.function(**arguments)
+
+
+def run_tool_calls(
+    tool_calls: List[Tuple[str, Any]],
+    map_name_to_tool: Dict[str, TurboTool],
+    timeout_seconds: float = None,
+) -> List[Any]:
+    """
+    Run (tool name, arguments) calls and return their outputs in call order.
+
+    The calls run concurrently on the tool call thread pool, so a turn takes as
+    long as its slowest call. A call still running timeout_seconds after submission
+    gets an error message (a ToolCallTimeout) as its output, and is dropped from the pool queue or, once
+    started, stopped with its tool's cancel so it doesn't hold a worker.
+    When calls raise, the first exception in call order is raised once every call
+    has finished or timed out.
+    """
+    if timeout_seconds is None:
+        timeout_seconds = LLM_TOOL_CALL_TIMEOUT_SECONDS
+
+    calls = [
+        (map_name_to_tool[name], parse_tool_arguments(arguments), {})
+        for name, arguments in tool_calls
+    ]
+    futures = [
+        tool_call_executor.submit(run_tool_call, turbo_tool, arguments, state)
+        for turbo_tool, arguments, state in calls
+    ]
+    deadline = time.monotonic() + timeout_seconds
+
+    outputs = []
+    errors = []
+    for (turbo_tool, _, state), future in zip(calls, futures):
+        try:
+            outputs.append(future.result(timeout=max(deadline - time.monotonic(), 0)))
+        except FutureTimeoutError:
+            print(f"Tool call {turbo_tool.name} timed out after {timeout_seconds}s")
+            if not future.cancel() and turbo_tool.cancel and "thread_id" in state:
+                turbo_tool.cancel(state["thread_id"])
+            outputs.append(
+                ToolCallTimeout(
+                    f"Error: {turbo_tool.name} did not finish within {timeout_seconds} seconds"
+                )
+            )
+        except Exception as e:
+            outputs.append(None)
+            errors.append(e)
+
+    if errors:
+        raise errors[0]
+    return outputs
+
+
 # ------------------ content generators ------------------
 
 
+def prompt_request(
+    prompt: str, model: str, instructions: str, temperature: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    Chat completion request of a prompt and its instructions.
+    temperature None leaves the API default, only temperature=0 requests are cached.
+    """
+    request = {
+        "model": model,
+        "messages": [
+            {
+                "role": "system",
+                "content": instructions,  # Added instructions as a system message
+            },
+            {
+                "role": "user",
+                "content": prompt,
+            },
+        ],
+    }
+    if temperature is not None:
+        request["temperature"] = temperature
+    return request
+
+
+def store_prompt_response(
+    prompt: str,
+    response: str,
+    model: str = "gpt-4-1106-preview",
+    instructions: str = "You are a helpful assistant.",
+    temperature: Optional[float] = None,
+    use_cache: bool = True,
+):
+    """
+    Cache the response of a prompt(store_response=False) call, e.g. once the SQL it generated ran.
+    """
+    store_chat_completion(
+        prompt_request(prompt, model, instructions, temperature),
+        {"choices": [{"message": {"role": "assistant", "content": response}}]},
+        use_cache,
+    )
+
+
 def prompt(
     prompt: str,
     model: str = "gpt-4-1106-preview",
     instructions: str = "You are a helpful assistant.",
+    use_cache: bool = True,
+    stream: bool = False,
+    temperature: Optional[float] = None,
+    store_response: bool = True,
 ) -> str:
     """
     Generate a response from a prompt using the OpenAI API.
+    Identical calls with temperature=0 are answered from the response cache unless use_cache=False.
+    store_response=False leaves caching the response to the caller, see store_prompt_response.
+    stream=True returns an iterator of tokens instead, see prompt_stream.
     """
 
+    if stream:
+        return prompt_stream(
+            prompt, model, instructions, use_cache, temperature, store_response
+        )
+
     if not openai.api_key:
         sys.exit(
             """
@@ -67,21 +703,46 @@ Example bash command:
             """
         )
 
-    response = openai.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": instructions,  # Added instructions as a system message
-            },
-            {
-                "role": "user",
-                "content": prompt,
-            },
-        ],
+    response_dump = create_chat_completion(
+        use_cache=use_cache,
+        store_response=store_response,
+        **prompt_request(prompt, model, instructions, temperature),
     )
 
-    return response_parser(response.model_dump())
+    return response_parser(response_dump)
+
+
+def prompt_stream(
+    prompt: str,
+    model: str = "gpt-4-1106-preview",
+    instructions: str = "You are a helpful assistant.",
+    use_cache: bool = True,
+    temperature: Optional[float] = None,
+    store_response: bool = True,
+) -> Iterator[str]:
+    """
+    Generate a response from a prompt using the OpenAI API, yielding tokens as they arrive.
+    Shares the response cache with prompt: a cached response is yielded whole,
+    and a streamed response is cached once complete unless store_response=False.
+    """
+    request = prompt_request(prompt, model, instructions, temperature)
+
+    key = response_cache_key(request, use_cache)
+    if key:
+        cached_response = response_cache_store.get(key)
+        if cached_response is not None:
+            yield response_parser(cached_response)
+            return
+
+    content = ""
+    for token in send_chat_completion_stream(request):
+        content += token
+        yield token
+
+    if key and store_response:
+        response_cache_store.set(
+            key, {"choices": [{"message": {"role": "assistant", "content": content}}]}
+        )
 
 
 def prompt_func(
@@ -89,19 +750,26 @@ def prompt_func(
     turbo_tools: List[TurboTool],
     model: str = "gpt-4-1106-preview",
     instructions: str = "You are a helpful assistant.",
+    use_cache: bool = True,
+    temperature: Optional[float] = None,
 ) -> str:
     """
     Generate a response from a prompt using the OpenAI API.
     Force function calls to the provided turbo tools.
+    With temperature=0 a cached response still runs its tool calls, only the API call is skipped.
+    A response is only cached once its tool calls succeeded.
 
     :param prompt: The prompt to send to the model.
     :param turbo_tools: List of TurboTool objects each containing the tool's name, configuration, and function.
     :param model: The model version to use, default is 'gpt-4-1106-preview'.
+    :param use_cache: False always calls the API.
+    :param temperature: None leaves the API default, 0 makes the response cacheable.
     :return: The response generated by the model.
     """
 
     messages = [{"role": "user", "content": prompt}]
     tools = [turbo_tool.config for turbo_tool in turbo_tools]
+    map_name_to_tool = {turbo_tool.name: turbo_tool for turbo_tool in turbo_tools}
 
     tool_choice = (
         "auto"
@@ -112,35 +780,51 @@ def prompt_func(
     messages.insert(
         0, {"role": "system", "content": instructions}
     )  # Insert instructions as the first system message
-    response = openai.chat.completions.create(
-        model=model, messages=messages, tools=tools, tool_choice=tool_choice
+    request = {
+        "model": model,
+        "messages": list(messages),
+        "tools": tools,
+        "tool_choice": tool_choice,
+    }
+    if temperature is not None:
+        request["temperature"] = temperature
+    response_dump = create_chat_completion(
+        use_cache=use_cache, store_response=False, **request
     )
 
-    response_message = response.choices[0].message
-    tool_calls = response_message.tool_calls
+    response_message = safe_get(response_dump, "choices.0.message")
+    tool_calls = response_message.get("tool_calls")
 
     func_responses = []
 
     if tool_calls:
         messages.append(response_message)
 
-        for tool_call in tool_calls:
-            for turbo_tool in turbo_tools:
-                if tool_call.function.name == turbo_tool.name:
-                    function_response = turbo_tool.function(
-                        **json.loads(tool_call.function.arguments)
-                    )
+        # calls to unknown tools are skipped
+        tool_calls = [
+            tool_call
+            for tool_call in tool_calls
+            if tool_call["function"]["name"] in map_name_to_tool
+        ]
+        func_responses = run_tool_calls(
+            [
+                (tool_call["function"]["name"], tool_call["function"]["arguments"])
+                for tool_call in tool_calls
+            ],
+            map_name_to_tool,
+        )
 
-                    func_responses.append(function_response)
+        for tool_call, function_response in zip(tool_calls, func_responses):
+            message_to_append = {
+                "tool_call_id": tool_call["id"],
+                "role": "tool",
+                "name": tool_call["function"]["name"],
+                "content": function_response,
+            }
+            messages.append(message_to_append)
 
-                    message_to_append = {
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "name": turbo_tool.name,
-                        "content": function_response,
-                    }
-                    messages.append(message_to_append)
-                    break
+    if not any(isinstance(output, ToolCallTimeout) for output in func_responses):
+        store_chat_completion(request, response_dump, use_cache)
 
     return func_responses
 
@@ -149,9 +833,12 @@ def prompt_json_response(
     prompt: str,
     model: str = "gpt-4-1106-preview",
     instructions: str = "You are a helpful assistant.",
+    use_cache: bool = True,
+    temperature: Optional[float] = None,
 ) -> str:
     """
     Generate a response from a prompt using the OpenAI API.
+    Identical calls with temperature=0 are answered from the response cache unless use_cache=False.
 
     Example:
         res = llm.prompt_json_response(
@@ -170,22 +857,207 @@ Example bash command:
             """
         )
 
-    response = openai.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": instructions,  # Added instructions as a system message
-            },
-            {
-                "role": "user",
-                "content": prompt,
-            },
-        ],
+    response_dump = create_chat_completion(
+        use_cache=use_cache,
         response_format={"type": "json_object"},
+        **prompt_request(prompt, model, instructions, temperature),
+    )
+
+    return response_parser(response_dump)
+
+
+# ------------------ async content generators ------------------
+
+# at most LLM_MAX_CONCURRENCY async calls in flight per event loop, and per model
+# at most its LLM_MODEL_CONCURRENCY limit, e.g. "gpt-4-1106-preview=8,gpt-3.5-turbo-1106=16"
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY") or 32)
+map_model_to_max_concurrency = {
+    model.strip(): int(limit)
+    for model, limit in (
+        pair.split("=")
+        for pair in (os.environ.get("LLM_MODEL_CONCURRENCY") or "").split(",")
+        if pair.strip()
+    )
+}
+
+# event loop -> {"client", "semaphore", "map_model_to_semaphore"}
+# asyncio primitives and the async http client only work on the loop that created them
+map_loop_to_async_state = weakref.WeakKeyDictionary()
+
+
+def get_async_state() -> Dict[str, Any]:
+    loop = asyncio.get_running_loop()
+    state = map_loop_to_async_state.get(loop)
+    if state is None:
+        state = {
+            "client": openai.AsyncOpenAI(api_key=openai.api_key, max_retries=0),
+            "semaphore": asyncio.Semaphore(LLM_MAX_CONCURRENCY),
+            "map_model_to_semaphore": {},
+        }
+        map_loop_to_async_state[loop] = state
+    return state
+
+
+async def acreate_chat_completion(
+    use_cache: bool = True, store_response: bool = True, **request
+) -> Dict[str, Any]:
+    """
+    Async create_chat_completion on the shared async client. Hedged when LLM_HEDGE is on.
+    """
+    key = response_cache_key(request, use_cache)
+    if key:
+        cached_response = response_cache_store.get(key)
+        if cached_response is not None:
+            return cached_response
+
+    if LLM_HEDGE:
+        response_dump = await asend_hedged_chat_completion(request)
+    else:
+        response_dump = await asend_chat_completion(request)
+
+    if key and store_response:
+        response_cache_store.set(key, response_dump)
+    return response_dump
+
+
+def get_model_semaphore(model: str) -> asyncio.Semaphore:
+    state = get_async_state()
+    model_semaphore = state["map_model_to_semaphore"].get(model)
+    if model_semaphore is None:
+        model_semaphore = asyncio.Semaphore(
+            map_model_to_max_concurrency.get(model, LLM_MAX_CONCURRENCY)
+        )
+        state["map_model_to_semaphore"][model] = model_semaphore
+    return model_semaphore
+
+
+async def asend_chat_completion(
+    request: Dict[str, Any], sent: Optional[asyncio.Event] = None
+) -> Dict[str, Any]:
+    """
+    Async send_chat_completion on the shared async client.
+    Waits for the model's rate limits, then for a free slot under the model's
+    and the global concurrency limit. Retries like send_chat_completion.
+    sent is set when the request actually goes out, after those waits.
+    """
+    state = get_async_state()
+    model = request["model"]
+    model_semaphore = get_model_semaphore(model)
+
+    limiter = get_rate_limiter(model)
+    estimated_tokens = estimate_request_tokens(request)
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await asyncio.sleep(limiter.reserve(estimated_tokens))
+        try:
+            # model slot first, so calls queued on a busy model don't hold global slots
+            async with model_semaphore:
+                async with state["semaphore"]:
+                    started_at = time.monotonic()
+                    if sent is not None:
+                        sent.set()
+                    response = await state["client"].chat.completions.create(**request)
+        except Exception as e:
+            delay = retry_delay(model, limiter, attempt, e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        observe_latency(model, time.monotonic() - started_at)
+        return finish_chat_completion(model, limiter, estimated_tokens, response)
+
+
+async def aprompt(
+    prompt: str,
+    model: str = "gpt-4-1106-preview",
+    instructions: str = "You are a helpful assistant.",
+    use_cache: bool = True,
+    temperature: Optional[float] = None,
+) -> str:
+    """
+    Async prompt.
+    """
+    response_dump = await acreate_chat_completion(
+        use_cache=use_cache, **prompt_request(prompt, model, instructions, temperature)
+    )
+    return response_parser(response_dump)
+
+
+async def aprompt_func(
+    prompt: str,
+    turbo_tools: List[TurboTool],
+    model: str = "gpt-4-1106-preview",
+    instructions: str = "You are a helpful assistant.",
+    use_cache: bool = True,
+    temperature: Optional[float] = None,
+) -> str:
+    """
+    Async prompt_func. The (blocking) tool calls run through run_tool_calls in a worker thread.
+    A response is only cached once its tool calls succeeded.
+    """
+    messages = [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": prompt},
+    ]
+    tools = [turbo_tool.config for turbo_tool in turbo_tools]
+
+    tool_choice = (
+        "auto"
+        if len(turbo_tools) > 1
+        else {"type": "function", "function": {"name": turbo_tools[0].name}}
     )
 
-    return response_parser(response.model_dump())
+    request = {
+        "model": model,
+        "messages": messages,
+        "tools": tools,
+        "tool_choice": tool_choice,
+    }
+    if temperature is not None:
+        request["temperature"] = temperature
+    response_dump = await acreate_chat_completion(
+        use_cache=use_cache, store_response=False, **request
+    )
+
+    response_message = safe_get(response_dump, "choices.0.message")
+    tool_calls = response_message.get("tool_calls")
+
+    func_responses = []
+
+    if tool_calls:
+        map_name_to_tool = {turbo_tool.name: turbo_tool for turbo_tool in turbo_tools}
+        func_responses = await asyncio.to_thread(
+            run_tool_calls,
+            [
+                (tool_call["function"]["name"], tool_call["function"]["arguments"])
+                for tool_call in tool_calls
+                if tool_call["function"]["name"] in map_name_to_tool
+            ],
+            map_name_to_tool,
+        )
+
+    if not any(isinstance(output, ToolCallTimeout) for output in func_responses):
+        store_chat_completion(request, response_dump, use_cache)
+
+    return func_responses
+
+
+async def aprompt_json_response(
+    prompt: str,
+    model: str = "gpt-4-1106-preview",
+    instructions: str = "You are a helpful assistant.",
+    use_cache: bool = True,
+    temperature: Optional[float] = None,
+) -> str:
+    """
+    Async prompt_json_response.
+    """
+    response_dump = await acreate_chat_completion(
+        use_cache=use_cache,
+        response_format={"type": "json_object"},
+        **prompt_request(prompt, model, instructions, temperature),
+    )
+    return response_parser(response_dump)
 
 
 def add_cap_ref(
@@ -206,12 +1078,68 @@ def add_cap_ref(
     return new_prompt
 
 
-def count_tokens(text: str):
+def add_cap_ref_prefix(
+    prompt: str, prompt_suffix: str, cap_ref: str, cap_ref_content: str
+) -> str:
+    """
+    Same parts as add_cap_ref, laid out for provider prompt prefix caching:
+    the capitalized reference and the (fixed) prompt_suffix come first, the variable prompt last.
+    Calls sharing cap_ref_content then send a byte identical prefix.
+    Example
+        prompt = 'Refactor this code.'
+        prompt_suffix = 'Make it more readable using this EXAMPLE.'
+        cap_ref = 'EXAMPLE'
+        cap_ref_content = 'def foo():\n    return True'
+        returns 'EXAMPLE\n\ndef foo():\n    return True\n\nMake it more readable using this EXAMPLE.\n\nRefactor this code.'
+    """
+
+    new_prompt = f"""{cap_ref}\n\n{cap_ref_content}\n\n{prompt_suffix}\n\n{prompt}"""
+
+    return new_prompt
+
+
+# ------------------ token counting ------------------
+
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE") or 4096)
+
+map_model_to_tokenizer: Dict[Optional[str], tokenizer.Tokenizer] = {}
+tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(model: Optional[str] = None) -> tokenizer.Tokenizer:
+    """
+    The model's tokenizer, created once. Its encoder and memoized counts are shared by every caller.
+    """
+    with tokenizers_lock:
+        model_tokenizer = map_model_to_tokenizer.get(model)
+        if model_tokenizer is None:
+            model_tokenizer = tokenizer.Tokenizer(model, TOKEN_COUNT_CACHE_SIZE)
+            map_model_to_tokenizer[model] = model_tokenizer
+        return model_tokenizer
+
+
+def count_tokens(text: str, model: Optional[str] = None):
     """
     Count the number of tokens in a string.
     """
-    enc = tiktoken.get_encoding("cl100k_base")
-    return len(enc.encode(text))
+    return get_tokenizer(model).count(text)
+
+
+def make_conversation_token_count(
+    model: Optional[str] = None, separator: str = "\n"
+) -> tokenizer.ConversationTokenCount:
+    """
+    Running token count of an append-only conversation, see tokenizer.ConversationTokenCount.
+    """
+    return tokenizer.ConversationTokenCount(get_tokenizer(model), separator)
+
+
+def get_token_count_stats() -> Dict[str, dict]:
+    with tokenizers_lock:
+        return {
+            str(model): model_tokenizer.stats()
+            for model, model_tokenizer in map_model_to_tokenizer.items()
+        }
 
 
 map_model_to_cost_per_1k_tokens = {
@@ -229,7 +1157,7 @@ def estimate_price_and_tokens(text, model="gpt-4"):
     # round up to the output tokens
     COST_PER_1k_TOKENS = map_model_to_cost_per_1k_tokens[model]
 
-    tokens = count_tokens(text)
+    tokens = count_tokens(text, model)
 
     estimated_cost = (tokens / 1000) * COST_PER_1k_TOKENS
 
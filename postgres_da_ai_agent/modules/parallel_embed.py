@@ -0,0 +1,99 @@
+"""
+Purpose:
+    Parallel cold-start embedding of large schemas.
+    Texts are sharded across a process pool. Every worker builds its own
+    encoder once (from picklable make_encoder settings) and embeds whole
+    shards, the parent collects the rows and reports progress.
+"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import numpy as np
+
+from postgres_da_ai_agent.modules import encoders
+
+# set once per worker process by init_worker
+_worker_encoder = None
+
+
+def init_worker(encoder_config: dict):
+    global _worker_encoder
+    _worker_encoder = encoders.make_encoder(**encoder_config)
+
+
+def embed_shard(texts: List[str], batch_size: int) -> np.ndarray:
+    """
+    Runs in a worker: embed texts batch_size at a time with the worker's encoder.
+    """
+    return np.vstack(
+        [
+            _worker_encoder.encode(texts[i : i + batch_size])
+            for i in range(0, len(texts), batch_size)
+        ]
+    )
+
+
+def worker_encoder_config(encoder_config: dict, workers: int) -> dict:
+    """
+    Encoder settings for one worker: no idle/RSS management (workers are short lived)
+    and the cores split between workers, so torch threads do not oversubscribe the box.
+    """
+    config = dict(encoder_config)
+    config.pop("idle_unload_seconds", None)
+    config.pop("max_rss_mb", None)
+    if not config.get("num_threads"):
+        config["num_threads"] = max(1, (os.cpu_count() or 1) // workers)
+    return config
+
+
+def embed_texts_in_parallel(
+    texts: List[str],
+    encoder_config: dict,
+    workers: int = None,
+    batch_size: int = 1,
+    shard_size: int = 256,
+    progress_every_seconds: float = 5,
+) -> np.ndarray:
+    """
+    Embed texts across a process pool, one row per text, in input order.
+
+    Args:
+    - encoder_config (dict): make_encoder keyword arguments, rebuilt in every worker.
+    - workers (int, optional): Worker processes. Defaults to the number of cores.
+    - batch_size (int, optional): Texts per encoder call inside a worker.
+    - shard_size (int, optional): Texts per task sent to a worker.
+    """
+    workers = workers or os.cpu_count() or 1
+    shards = [texts[i : i + shard_size] for i in range(0, len(texts), shard_size)]
+
+    # spawn: forking a parent that already initialized torch threads can deadlock
+    context = multiprocessing.get_context("spawn")
+    start = time.time()
+    last_report = start
+    done = 0
+    results = []
+
+    print(f"Embedding {len(texts)} texts with {workers} workers")
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=init_worker,
+        initargs=(worker_encoder_config(encoder_config, workers),),
+    ) as executor:
+        futures = [executor.submit(embed_shard, shard, batch_size) for shard in shards]
+        for shard, future in zip(shards, futures):
+            results.append(future.result())
+            done += len(shard)
+            now = time.time()
+            if now - last_report >= progress_every_seconds or done == len(texts):
+                last_report = now
+                elapsed = now - start
+                print(
+                    f"Embedded {done}/{len(texts)} texts in {elapsed:.1f}s ({done / max(elapsed, 1e-9):.0f}/s)"
+                )
+
+    return np.vstack(results)
@@ -0,0 +1,150 @@
+"""
+Purpose:
+    Client side rate limiting and retries for LLM API calls.
+    Token buckets enforce a model's requests-per-minute and tokens-per-minute
+    budgets before a call is sent, so throughput stays at the quota instead of
+    collapsing into 429s. Calls that still fail with 429, 5xx or a connection
+    error are retried with exponential backoff and full jitter, honouring Retry-After.
+"""
+
+import random
+import threading
+import time
+from typing import Optional
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+class TokenBucket:
+    """
+    Refills per_minute units per minute, holds at most per_minute units.
+    reserve debits up front and may drive the level negative: the caller waits
+    until the level is back at zero, so waiting callers are served in order.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take amount units. Returns the seconds to wait before using them.
+        """
+        with self.lock:
+            self.refill()
+            self.level -= min(amount, self.capacity)
+            return max(-self.level / self.rate, 0.0)
+
+    def wait_seconds(self, amount: float) -> float:
+        """
+        Seconds a reserve of amount units would wait now, without taking them.
+        """
+        with self.lock:
+            self.refill()
+            return max((min(amount, self.capacity) - self.level) / self.rate, 0.0)
+
+    def adjust(self, amount: float):
+        """
+        Take (or give back, when negative) units after the fact, e.g. actual minus estimated tokens.
+        """
+        with self.lock:
+            self.refill()
+            self.level = min(self.capacity, self.level - amount)
+
+
+class RateLimiter:
+    """
+    Requests and tokens per minute budget of one model. 0 leaves that budget unlimited.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+
+    def reserve(self, tokens: float) -> float:
+        """
+        Reserve one request of about 'tokens' tokens. Returns the seconds to wait before sending it.
+        """
+        wait = max(self.paused_until - time.monotonic(), 0.0)
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        return wait
+
+    def wait_seconds(self, tokens: float) -> float:
+        """
+        Seconds a reserve of one request of about 'tokens' tokens would wait now, without reserving.
+        """
+        wait = max(self.paused_until - time.monotonic(), 0.0)
+        if self.requests:
+            wait = max(wait, self.requests.wait_seconds(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.wait_seconds(tokens))
+        return wait
+
+    def adjust_tokens(self, tokens: float):
+        if self.tokens:
+            self.tokens.adjust(tokens)
+
+    def pause(self, seconds: float):
+        """
+        Hold every caller of this model for 'seconds', after the API asked us to back off.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    429, 408, 409 and 5xx responses, connection errors and timeouts.
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    The Retry-After (or retry-after-ms) header of a failed response, in seconds.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After as an http date, fall back to backoff
+        return None
+    return None
+
+
+def backoff_seconds(
+    attempt: int,
+    error: Exception,
+    base_seconds: float = 1.0,
+    max_seconds: float = 60.0,
+) -> float:
+    """
+    Retry-After when the API sent one, else exponential backoff with full jitter:
+    uniform(0, base_seconds * 2 ** attempt), capped at max_seconds.
+    """
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        return min(retry_after, max_seconds)
+    return random.uniform(0, min(max_seconds, base_seconds * 2**attempt))
@@ -0,0 +1,111 @@
+"""
+Purpose:
+    Cache of LLM API responses.
+    A request is keyed by a stable hash of everything sent (model, messages,
+    tools, response format). Hits are served from an in-memory LRU, then from
+    an optional sqlite file shared across processes and restarts, and only
+    misses reach the API.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from postgres_da_ai_agent.modules.cache import MISSING, LRUCache, stable_hash
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    return stable_hash(request)
+
+
+def is_cacheable(request: Dict[str, Any]) -> bool:
+    """
+    Only deterministic requests are cached: temperature explicitly 0 (the API default is 1).
+    Sampled and streamed requests always reach the API.
+    """
+    return request.get("temperature", 1) == 0 and not request.get("stream")
+
+
+class ResponseCache:
+    """
+    Two tier response cache: LRU in memory, sqlite on disk (when path is set).
+    Entries older than ttl_seconds are misses. ttl_seconds=None never expires.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_size: int = 1024,
+        ttl_seconds: Optional[float] = 7 * 24 * 3600,
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        # key -> (response dict, created_at), expiry is checked here against created_at
+        self.memory = LRUCache(max_size, ttl_seconds=None)
+        self.lock = threading.Lock()
+        self.counts = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0}
+
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self.conn.commit()
+
+    def expired(self, created_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created_at >= self.ttl_seconds
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.memory.get(key)
+        if entry is not MISSING and not self.expired(entry[1]):
+            self.count("memory_hits")
+            return entry[0]
+
+        row = None
+        if self.conn is not None:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and self.expired(row[1]):
+                    self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.conn.commit()
+                    row = None
+
+        if row is None:
+            self.count("misses")
+            return None
+
+        response = json.loads(row[0])
+        self.memory.set(key, (response, row[1]))
+        self.count("disk_hits")
+        return response
+
+    def set(self, key: str, response: Dict[str, Any]):
+        created_at = time.time()
+        self.memory.set(key, (response, created_at))
+        if self.conn is not None:
+            with self.lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(response, default=str), created_at),
+                )
+                self.conn.commit()
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            counts = dict(self.counts)
+        hits = counts["memory_hits"] + counts["disk_hits"]
+        lookups = hits + counts["misses"]
+        return {
+            **counts,
+            "memory_size": len(self.memory),
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
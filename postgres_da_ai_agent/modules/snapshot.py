@@ -0,0 +1,166 @@
+"""
+Purpose:
+    Offline schema snapshots.
+    One gzipped json file holds everything retrieval reads from postgres:
+    table definitions, columns, key columns, the foreign key graph, table
+    stats, comments and (optionally) the embedder's stored embeddings.
+
+    A SchemaSnapshot answers the same schema questions as PostgresManager,
+    so it can be passed to the embedder as its db. Start-up then costs one
+    file read and the live database is only needed for run_sql.
+"""
+
+import gzip
+import json
+import time
+from typing import Dict, List
+
+SNAPSHOT_VERSION = 1
+
+
+class SchemaSnapshot:
+    """
+    Read only stand in for the schema introspection methods of PostgresManager.
+    """
+
+    def __init__(
+        self,
+        tables: Dict[str, dict],
+        references: Dict[str, List[str]],
+        stats: Dict[str, dict] = None,
+        comments: Dict[str, str] = None,
+        embeddings: dict = None,
+        created_at: float = None,
+    ):
+        # table name -> {"definition": str, "columns": [[name, type], ...], "key_columns": [name, ...]}
+        self.tables = tables
+        # table name -> sorted names of the tables it references
+        self.references = references
+        # table name -> sorted names of the tables referencing it
+        self.referenced_by = {}
+        for table_name, referenced_table_names in sorted(references.items()):
+            for referenced_table_name in referenced_table_names:
+                self.referenced_by.setdefault(referenced_table_name, []).append(table_name)
+        self.stats = stats or {}
+        self.comments = comments or {}
+        # see DatabaseEmbedder.export_embeddings
+        self.embeddings = embeddings
+        self.created_at = created_at
+
+    def get_all_table_names(self):
+        return list(self.tables.keys())
+
+    def get_table_definition(self, table_name):
+        return self.tables[table_name]["definition"]
+
+    def get_table_definitions_for_prompt(self):
+        return "\n\n".join(table["definition"] for table in self.tables.values())
+
+    def get_table_definition_map_for_embeddings(self):
+        return {
+            table_name: table["definition"] for table_name, table in self.tables.items()
+        }
+
+    def get_table_column_map_for_embeddings(self):
+        return {
+            table_name: [tuple(column) for column in table["columns"]]
+            for table_name, table in self.tables.items()
+        }
+
+    def get_table_key_columns_map(self):
+        return {
+            table_name: set(table["key_columns"])
+            for table_name, table in self.tables.items()
+            if table["key_columns"]
+        }
+
+    def get_table_comment_map_for_embeddings(self):
+        return dict(self.comments)
+
+    def get_table_stats_map(self):
+        return dict(self.stats)
+
+    def get_related_tables(self, table_list, n=2):
+        """
+        Same result as PostgresManager.get_related_tables, from the stored foreign key graph.
+        """
+        related_tables_list = []
+        for table in table_list:
+            related_tables_list += self.referenced_by.get(table, [])[:n]
+            related_tables_list += self.references.get(table, [])[:n]
+        return list(dict.fromkeys(related_tables_list))
+
+    def to_dict(self) -> dict:
+        return {
+            "version": SNAPSHOT_VERSION,
+            "created_at": self.created_at,
+            "tables": self.tables,
+            "references": self.references,
+            "stats": self.stats,
+            "comments": self.comments,
+            "embeddings": self.embeddings,
+        }
+
+
+def build_snapshot(db, embedder=None) -> SchemaSnapshot:
+    """
+    Read the schema of db (a connected PostgresManager) into a SchemaSnapshot.
+    With an embedder, its current embeddings are included (see DatabaseEmbedder.export_embeddings).
+    """
+    definitions = db.get_table_definition_map_for_embeddings()
+    columns = db.get_table_column_map_for_embeddings()
+    key_columns = db.get_table_key_columns_map()
+
+    tables = {
+        table_name: {
+            "definition": definitions[table_name],
+            "columns": [list(column) for column in columns.get(table_name, [])],
+            "key_columns": sorted(key_columns.get(table_name, [])),
+        }
+        for table_name in sorted(definitions)
+    }
+
+    return SchemaSnapshot(
+        tables,
+        db.get_foreign_key_map(),
+        stats=db.get_table_stats_map(),
+        comments=db.get_table_comment_map_for_embeddings(),
+        embeddings=embedder.export_embeddings() if embedder else None,
+        created_at=time.time(),
+    )
+
+
+def save_snapshot(snapshot: SchemaSnapshot, path: str):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(snapshot.to_dict(), f, separators=(",", ":"))
+
+
+def export_snapshot(db, path: str, embedder=None) -> SchemaSnapshot:
+    snapshot = build_snapshot(db, embedder)
+    save_snapshot(snapshot, path)
+    print(f"Exported schema snapshot of {len(snapshot.tables)} tables to {path}")
+    return snapshot
+
+
+def load_snapshot(path: str) -> SchemaSnapshot:
+    start = time.time()
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        snapshot_dict = json.load(f)
+
+    if snapshot_dict.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(
+            f"Unsupported schema snapshot version {snapshot_dict.get('version')} in {path}, re-export it"
+        )
+
+    snapshot = SchemaSnapshot(
+        snapshot_dict["tables"],
+        snapshot_dict["references"],
+        stats=snapshot_dict["stats"],
+        comments=snapshot_dict["comments"],
+        embeddings=snapshot_dict["embeddings"],
+        created_at=snapshot_dict["created_at"],
+    )
+    print(
+        f"Loaded schema snapshot of {len(snapshot.tables)} tables from {path} in {(time.time() - start) * 1000:.0f}ms"
+    )
+    return snapshot
@@ -0,0 +1,125 @@
+"""
+Purpose:
+    Natural language table descriptions for retrieval.
+    An offline job asks the LLM for a short description of every table and
+    stores it content-addressed by a hash of the table definition, so a table
+    is only described again after its definition changes.
+    The embedders index the descriptions alongside the definitions.
+"""
+
+import hashlib
+import json
+import os
+from typing import Callable, Dict, Optional
+
+SUMMARY_INSTRUCTIONS = "You're a data catalog expert. You describe database tables for a search index."
+
+SUMMARY_PROMPT = (
+    "Describe this table in at most two sentences: what one row represents and "
+    "which business questions it answers. Mention its most important columns by name. "
+    "Respond with the description only.\n\n{table_def}"
+)
+
+
+def ddl_hash(table_def: str) -> str:
+    return hashlib.sha256(table_def.strip().encode()).hexdigest()
+
+
+class TableSummaryStore:
+    """
+    Json file of table definition hash -> description.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.map_hash_to_summary: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.map_hash_to_summary = json.load(f)
+
+    def __len__(self):
+        return len(self.map_hash_to_summary)
+
+    def get(self, table_def: str) -> Optional[str]:
+        return self.map_hash_to_summary.get(ddl_hash(table_def))
+
+    def set(self, table_def: str, summary: str):
+        self.map_hash_to_summary[ddl_hash(table_def)] = summary.strip()
+
+    def summaries_for(self, map_name_to_table_def: Dict[str, str]) -> Dict[str, str]:
+        """
+        table name -> description, for the tables that have one.
+        """
+        summaries = {}
+        for table_name, table_def in map_name_to_table_def.items():
+            summary = self.get(table_def)
+            if summary:
+                summaries[table_name] = summary
+        return summaries
+
+    def save(self):
+        # write then rename, readers never see a half written file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.map_hash_to_summary, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def make_llm_summarizer(model: str = "gpt-3.5-turbo-1106") -> Callable[[str], str]:
+    """
+    table definition -> description, through llm.prompt.
+    """
+    # imported here: modules/llm.py requires OPENAI_API_KEY at import time
+    from postgres_da_ai_agent.modules import llm
+
+    def summarize(table_def: str) -> str:
+        return llm.prompt(
+            SUMMARY_PROMPT.format(table_def=table_def),
+            model=model,
+            instructions=SUMMARY_INSTRUCTIONS,
+        )
+
+    return summarize
+
+
+def enrich_tables(
+    map_name_to_table_def: Dict[str, str],
+    store: TableSummaryStore,
+    summarize: Callable[[str], str],
+    save_every: int = 20,
+) -> dict:
+    """
+    Describe every table whose current definition has no description yet.
+    The store is saved every save_every new descriptions, so an interrupted job resumes where it stopped.
+
+    Returns:
+    - dict: counts of generated, cached (skipped) and failed tables, and the failed table names.
+    """
+    report = {"generated": 0, "cached": 0, "failed": 0, "failed_tables": []}
+
+    for table_name, table_def in map_name_to_table_def.items():
+        if store.get(table_def):
+            report["cached"] += 1
+            continue
+
+        try:
+            summary = summarize(table_def)
+        except Exception as e:
+            print(f"Failed to describe {table_name}: {e}")
+            report["failed"] += 1
+            report["failed_tables"].append(table_name)
+            continue
+
+        if not summary:
+            report["failed"] += 1
+            report["failed_tables"].append(table_name)
+            continue
+
+        store.set(table_def, summary)
+        report["generated"] += 1
+        print(f"Described {table_name}: {summary.strip()}")
+        if report["generated"] % save_every == 0:
+            store.save()
+
+    store.save()
+    return report
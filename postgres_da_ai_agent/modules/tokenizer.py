@@ -0,0 +1,108 @@
+"""
+Purpose:
+    Token counting for prompts, rate limits and cost estimates.
+    Encoders are loaded once per model, and token counts are memoized per
+    text by content hash, so the same table definitions, instructions and
+    messages are encoded once no matter how often they are counted.
+    ConversationTokenCount keeps a running total of an append-only
+    conversation: each new message is counted once, never the whole history.
+"""
+
+import hashlib
+import threading
+from typing import Iterable, Optional
+
+import tiktoken
+
+from postgres_da_ai_agent.modules.cache import MISSING, LRUCache
+
+DEFAULT_ENCODING = "cl100k_base"
+
+# chat format overhead - https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+map_model_to_encoding = {}
+encodings_lock = threading.Lock()
+
+
+def get_encoding(model: Optional[str] = None) -> tiktoken.Encoding:
+    """
+    The model's encoding, loaded once. Unknown models (and None) use cl100k_base.
+    """
+    with encodings_lock:
+        encoding = map_model_to_encoding.get(model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except (KeyError, TypeError):
+                encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+            map_model_to_encoding[model] = encoding
+        return encoding
+
+
+def content_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode()).digest()
+
+
+class Tokenizer:
+    """
+    Memoized token counts of one model's encoding.
+    At most max_size counts are kept, the least recently used are evicted first.
+    """
+
+    def __init__(self, model: Optional[str] = None, max_size: int = 4096):
+        self.encoding = get_encoding(model)
+        self.counts = LRUCache(max_size, ttl_seconds=None)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        key = content_hash(text)
+        tokens = self.counts.get(key)
+        if tokens is MISSING:
+            tokens = len(self.encoding.encode(text, disallowed_special=()))
+            self.counts.set(key, tokens)
+        return tokens
+
+    def count_messages(self, messages: Iterable[dict]) -> int:
+        """
+        Tokens of chat messages as the API counts them: each message's content plus the chat format overhead.
+        """
+        tokens = TOKENS_PER_REPLY
+        for message in messages:
+            tokens += TOKENS_PER_MESSAGE + self.count(str(message.get("content") or ""))
+        return tokens
+
+    def stats(self) -> dict:
+        return self.counts.stats()
+
+
+class ConversationTokenCount:
+    """
+    Running token count of an append-only list of messages joined by separator.
+    append counts only the new message, so counting a conversation of n messages is O(n)
+    instead of re-encoding the growing joined text on every turn.
+    The total matches the tokens of the joined text up to merges across the separators.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, separator: str = "\n"):
+        self.tokenizer = tokenizer
+        self.separator_tokens = tokenizer.count(separator)
+        self.messages = 0
+        self.total = 0
+
+    def append(self, text: str) -> int:
+        """
+        Add a message. Returns the new total.
+        """
+        if self.messages:
+            self.total += self.separator_tokens
+        self.total += self.tokenizer.count(text)
+        self.messages += 1
+        return self.total
+
+    def extend(self, texts: Iterable[str]) -> int:
+        for text in texts:
+            self.append(text)
+        return self.total
@@ -0,0 +1,136 @@
+"""
+Purpose:
+    Usage ledger of LLM API calls.
+    Every completion and assistant run adds the usage block the API reported
+    (prompt, completion and cached prompt tokens) to running totals per
+    session, team and model. Recording is a handful of additions, nothing is
+    re-tokenized, and costs are priced per input and output token.
+"""
+
+import json
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+# model -> ($ per 1k input tokens, $ per 1k output tokens) - https://openai.com/pricing
+map_model_to_price_per_1k_tokens = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-4-1106-vision-preview": (0.01, 0.03),
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+}
+
+# cached prompt tokens are billed at this share of the input price
+CACHED_INPUT_PRICE_RATIO = 0.5
+
+
+def usage_from_response(response: Dict[str, Any]) -> Dict[str, int]:
+    """
+    prompt, completion and cached prompt tokens of a completion or run (as a dict).
+    A response marked "estimated" carries counted tokens instead of API-reported ones.
+    """
+    usage = response.get("usage") or {}
+    details = usage.get("prompt_tokens_details") or usage.get("prompt_token_details") or {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens") or 0,
+        "completion_tokens": usage.get("completion_tokens") or 0,
+        "cached_tokens": details.get("cached_tokens") or 0,
+        "estimated": bool(response.get("estimated")),
+    }
+
+
+def price(model: str, usage: Dict[str, int]) -> float:
+    input_price, output_price = map_model_to_price_per_1k_tokens.get(model, (0, 0))
+    uncached_tokens = usage["prompt_tokens"] - usage["cached_tokens"]
+    return (
+        uncached_tokens * input_price
+        + usage["cached_tokens"] * input_price * CACHED_INPUT_PRICE_RATIO
+        + usage["completion_tokens"] * output_price
+    ) / 1000
+
+
+def empty_totals() -> Dict[str, float]:
+    return {
+        "calls": 0,
+        "estimated_calls": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cached_tokens": 0,
+        "cost": 0.0,
+    }
+
+
+def add_to_totals(totals: Dict[str, float], usage: Dict[str, int], cost: float):
+    totals["calls"] += 1
+    totals["estimated_calls"] += usage["estimated"]
+    totals["prompt_tokens"] += usage["prompt_tokens"]
+    totals["completion_tokens"] += usage["completion_tokens"]
+    totals["cached_tokens"] += usage["cached_tokens"]
+    totals["cost"] += cost
+
+
+class UsageLedger:
+    """
+    Running usage totals overall, per session, per team, per model and per (session, team, model).
+    Every call updates each of them once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = empty_totals()
+        self.map_session_to_totals: Dict[str, dict] = {}
+        self.map_team_to_totals: Dict[str, dict] = {}
+        self.map_model_to_totals: Dict[str, dict] = {}
+        self.map_key_to_totals: Dict[Tuple[str, str, str], dict] = {}
+
+    def record(
+        self,
+        model: str,
+        response: Dict[str, Any],
+        session: Optional[str] = None,
+        team: Optional[str] = None,
+    ) -> Dict[str, float]:
+        """
+        Add the usage block of a response. Returns the call's usage and cost.
+        """
+        usage = usage_from_response(response)
+        cost = price(model, usage)
+        session = session or "default"
+        team = team or "default"
+
+        with self.lock:
+            add_to_totals(self.totals, usage, cost)
+            for map_to_totals, key in (
+                (self.map_session_to_totals, session),
+                (self.map_team_to_totals, team),
+                (self.map_model_to_totals, model),
+                (self.map_key_to_totals, (session, team, model)),
+            ):
+                totals = map_to_totals.get(key)
+                if totals is None:
+                    totals = map_to_totals[key] = empty_totals()
+                add_to_totals(totals, usage, cost)
+
+        return {**usage, "cost": cost}
+
+    def model_totals(self) -> Dict[str, dict]:
+        with self.lock:
+            return {model: dict(totals) for model, totals in self.map_model_to_totals.items()}
+
+    def export(self) -> dict:
+        with self.lock:
+            return {
+                "created_at": time.time(),
+                "totals": dict(self.totals),
+                "sessions": {k: dict(v) for k, v in self.map_session_to_totals.items()},
+                "teams": {k: dict(v) for k, v in self.map_team_to_totals.items()},
+                "models": {k: dict(v) for k, v in self.map_model_to_totals.items()},
+                "entries": [
+                    {"session": session, "team": team, "model": model, **totals}
+                    for (session, team, model), totals in self.map_key_to_totals.items()
+                ],
+            }
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.export(), f, indent=2)
@@ -6,10 +6,13 @@ from postgres_da_ai_agent.agents.instruments import PostgresAgentInstruments
 from postgres_da_ai_agent.modules import llm
 from postgres_da_ai_agent.modules import rand
 from postgres_da_ai_agent.modules import embeddings
+from postgres_da_ai_agent.modules import snapshot
 import argparse
 
 DB_URL = os.environ.get("DATABASE_URL")
 POSTGRES_TABLE_DEFINITIONS_CAP_REF = "TABLE_DEFINITIONS"
+# schema snapshot file (see modules/snapshot.py), skips schema introspection when it exists
+SCHEMA_SNAPSHOT_PATH = os.environ.get("SCHEMA_SNAPSHOT_PATH")
 
 
 custom_function_tool_config = {
@@ -67,14 +70,25 @@ def main():
 
     session_id = rand.generate_session_id(assistant_name + raw_prompt)
 
-    with PostgresAgentInstruments(DB_URL, session_id) as (agent_instruments, db):
-        database_embedder = embeddings.DatabaseEmbedder(db)
+    with PostgresAgentInstruments(DB_URL, session_id) as (
+        agent_instruments,
+        db,
+    ), llm.usage_context(session=session_id):
+        database_embedder = embeddings.make_database_embedder(
+            db, count_tokens=llm.count_tokens
+        )
+
+        # the live db is only needed for run_sql when a snapshot is available
+        schema_source = db
+        if SCHEMA_SNAPSHOT_PATH and os.path.exists(SCHEMA_SNAPSHOT_PATH):
+            schema_source = snapshot.load_snapshot(SCHEMA_SNAPSHOT_PATH)
+            database_embedder.load_snapshot(schema_source)
 
         table_definitions = database_embedder.get_similar_table_defs_for_prompt(
-            raw_prompt
+            raw_prompt, db=schema_source
         )
 
-        prompt = llm.add_cap_ref(
+        prompt = llm.add_cap_ref_prefix(
             prompt,
             f"Use these {POSTGRES_TABLE_DEFINITIONS_CAP_REF} to satisfy the database query.",
             POSTGRES_TABLE_DEFINITIONS_CAP_REF,
@@ -82,7 +96,12 @@ def main():
         )
 
         tools = [
-            TurboTool("run_sql", run_sql_tool_config, agent_instruments.run_sql),
+            TurboTool(
+                "run_sql",
+                run_sql_tool_config,
+                agent_instruments.run_sql,
+                agent_instruments.cancel_run_sql,
+            ),
         ]
 
         (
@@ -107,6 +126,20 @@ def main():
 
         print(f"✅ Turbo4 Assistant finished.")
 
+        sql_ran, _ = agent_instruments.validate_run_sql()
+        if sql_ran:
+            with open(agent_instruments.sql_query_file) as f:
+                database_embedder.record_feedback(raw_prompt, f.read())
+        print(f"Prompt cache usage: {llm.get_prompt_cache_stats()}")
+        print(f"Response cache: {llm.get_response_cache_stats()}")
+        print(f"Token counts: {llm.get_token_count_stats()}")
+        if llm.LLM_HEDGE:
+            print(f"Hedging: {llm.get_hedge_stats()}")
+
+        usage_ledger_file = os.path.join(agent_instruments.root_dir, "usage_ledger.json")
+        llm.save_usage_ledger(usage_ledger_file)
+        print(f"Usage: {llm.get_usage_ledger()['totals']} -> {usage_ledger_file}")
+
         # ---------- Simple Prompt Solution - Same thing, only 2 api calls instead of 8+ ------------
         # sql_response = llm.prompt(
         #     prompt,
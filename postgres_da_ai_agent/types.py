@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Callable, List
+from typing import Callable, List, Optional
 from dataclasses import dataclass, field
 import time
 
@@ -27,3 +27,5 @@ class TurboTool:
     name: str
     config: dict
     function: Callable
+    # called with the id of the thread running a call that timed out, to stop its work
+    cancel: Optional[Callable[[int], None]] = None